@@ -0,0 +1 @@
+"""Benchmarks of the pysmappee message ingestion and polling paths (python -m benchmarks.run)."""
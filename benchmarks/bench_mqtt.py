@@ -0,0 +1,71 @@
+"""MQTT ingestion benchmarks feeding synthetic messages through the _on_message callbacks."""
+from pysmappee.mqtt import SmappeeMqtt, SmappeeLocalMqtt
+from pysmappee.servicelocation import SmappeeServiceLocation
+from . import payloads
+from .harness import measure
+
+# distinct payloads per topic, cycled to avoid measuring a single cached frame
+VARIANTS = 10
+
+
+class OfflineApi:
+    """Api placeholder, service locations are created without loading anything."""
+    farm = 1
+
+
+def create_service_locations(locations, measurements, history=False):
+    service_locations = []
+    for index in range(1, locations + 1):
+        sl = SmappeeServiceLocation(device_serial_number=f'50{index:08d}',
+                                    smappee_api=OfflineApi(),
+                                    service_location_id=index,
+                                    load=False)
+        sl._load_metering_configuration(payloads.metering_configuration(index, measurements=measurements))
+        if history:
+            sl.enable_history()
+        service_locations.append(sl)
+    return service_locations
+
+
+def _calls(connections, topic, variants, messages):
+    # round robin over the connections, each with its own pre-encoded messages
+    prepared = [[payloads.message(f'{connection.topic_prefix}{topic}', payload) for payload in variants]
+                for connection in connections]
+    calls = []
+    for i in range(messages):
+        connection, msgs = connections[i % len(connections)], prepared[i % len(connections)]
+        message = msgs[(i // len(connections)) % len(msgs)]
+        calls.append(lambda c=connection, m=message: c._on_message(None, None, m))
+    return calls
+
+
+def run(locations=100, measurements=10, messages=20000, history=False):
+    service_locations = create_service_locations(locations, measurements, history=history)
+    central = [SmappeeMqtt(service_location=sl, kind='central', farm=1) for sl in service_locations]
+    local = [SmappeeMqtt(service_location=sl, kind='local', farm=1) for sl in service_locations]
+    suffix = ' +history' if history else ''
+
+    results = [
+        measure(f'central /power{suffix}',
+                _calls(central, '/power', [payloads.power_payload(measurements, step) for step in range(VARIANTS)],
+                       messages)),
+        measure(f'local /realtime{suffix}',
+                _calls(local, '/realtime', [payloads.realtime_payload(measurements, step) for step in range(VARIANTS)],
+                       messages)),
+        measure('central /plug/<id>/state',
+                _calls(central, '/plug/1/state', [payloads.plug_state_payload(step) for step in range(VARIANTS)],
+                       messages)),
+    ]
+
+    # standalone local MQTT client of a single monitor
+    standalone = SmappeeLocalMqtt(serial_number='5010000001')
+    standalone._service_location_uuid = service_locations[0].service_location_uuid
+    standalone.service_location = service_locations[0]
+    results.append(measure('standalone /channelConfigV2',
+                           _calls([standalone], '/channelConfigV2', [payloads.channel_config_payload(measurements)],
+                                  max(1, messages // 10))))
+    results.append(measure(f'standalone /realtime{suffix}',
+                           _calls([standalone], '/realtime',
+                                  [payloads.realtime_payload(measurements, step) for step in range(VARIANTS)],
+                                  messages)))
+    return results
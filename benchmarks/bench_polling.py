@@ -0,0 +1,91 @@
+"""Polling benchmarks running update_trends_and_appliance_states against a local fake cloud API."""
+import asyncio
+from pysmappee.api import SmappeeApi
+from pysmappee.config import config
+from pysmappee.servicelocation import SmappeeServiceLocation, TREND_MODE_AGGREGATED, TREND_MODE_DERIVED
+from . import payloads
+from .fakecloud import FakeCloud
+from .harness import measure
+
+# farm key of the fake cloud in config['API_URL']
+FARM = 'benchmark'
+TOKEN = {'access_token': 'benchmark', 'refresh_token': 'benchmark', 'token_type': 'Bearer', 'expires_in': 3600}
+
+
+def _configure(cloud):
+    config['API_URL'][FARM] = {
+        'token_url': cloud.servicelocation_url.replace('/servicelocation', '/oauth2/token'),
+        'servicelocation_url': cloud.servicelocation_url,
+    }
+
+
+def _poll(service_location):
+    def call():
+        # every poll starts from an empty cache, as after the cache TTL expired
+        service_location._cache.clear()
+        service_location.update_trends_and_appliance_states()
+    return call
+
+
+def run(locations=10, measurements=10, polls=5):
+    cloud = FakeCloud(locations=locations, measurements=measurements).start()
+    try:
+        _configure(cloud)
+        api = SmappeeApi(client_id='benchmark', client_secret='benchmark', token=dict(TOKEN), farm=FARM)
+
+        results = []
+        for trend_mode in (TREND_MODE_AGGREGATED, TREND_MODE_DERIVED):
+            service_locations = []
+            for index in range(1, locations + 1):
+                sl = SmappeeServiceLocation(device_serial_number=f'50{index:08d}',
+                                            smappee_api=api,
+                                            service_location_id=index,
+                                            load=False,
+                                            trend_mode=trend_mode)
+                sl._load_metering_configuration(payloads.metering_configuration(index, measurements=measurements))
+                service_locations.append(sl)
+
+            results.append(measure(f'update_trends ({trend_mode})', [_poll(sl) for sl in service_locations],
+                                   repeat=polls))
+
+        results.append(_run_async(cloud, locations, measurements, polls))
+        return results
+    finally:
+        cloud.stop()
+
+
+def _run_async(cloud, locations, measurements, polls):
+    try:
+        from pysmappee.aioapi import AsyncSmappeeApi
+    except ImportError:
+        # aiohttp is an optional dependency
+        return {'name': 'async_update_trends (skipped)', 'operations': 0, 'ops_per_second': 0, 'p50_us': 0,
+                'p99_us': 0, 'peak_kib': 0, 'retained_bytes_per_op': 0}
+
+    async def poll_all(service_locations):
+        for sl in service_locations:
+            sl._cache.clear()
+        await asyncio.gather(*[sl.async_update_trends_and_appliance_states() for sl in service_locations])
+
+    async def setup():
+        api = AsyncSmappeeApi(client_id='benchmark', client_secret='benchmark', token=dict(TOKEN), farm=FARM)
+        service_locations = []
+        for index in range(1, locations + 1):
+            sl = SmappeeServiceLocation(device_serial_number=f'50{index:08d}',
+                                        smappee_api=api,
+                                        service_location_id=index,
+                                        load=False)
+            sl._load_metering_configuration(payloads.metering_configuration(index, measurements=measurements))
+            service_locations.append(sl)
+        return api, service_locations
+
+    loop = asyncio.new_event_loop()
+    try:
+        api, service_locations = loop.run_until_complete(setup())
+        # one operation polls all service locations concurrently
+        result = measure('async_update_trends (all locations)',
+                         [lambda: loop.run_until_complete(poll_all(service_locations))], repeat=polls)
+        loop.run_until_complete(api.close())
+        return result
+    finally:
+        loop.close()
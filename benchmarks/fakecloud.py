@@ -0,0 +1,100 @@
+"""Local HTTP server answering the Smappee cloud API endpoints with synthetic data."""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from . import payloads
+
+BASE_PATH = '/dev/v3/servicelocation'
+
+
+class FakeCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are separate writes, Nagle would hold back the body of a keep-alive response
+    # until the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type='application/json'):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _consumptions(self, query, key):
+        start, end = int(query['from'][0]), int(query['to'][0])
+        step = {1: 300000, 2: 3600000}.get(int(query['aggregation'][0]), 86400000)
+        records = []
+        for ts in range(start - start % step, end, step):
+            if key == 'consumptions':
+                records.append({'timestamp': ts, 'consumption': 100.0, 'solar': 20.0, 'alwaysOn': 5.0})
+            else:
+                records.append({'timestamp': ts, 'active': 10.0, 'value1': 1.0, 'value2': 2.0,
+                                'temperature': 20.0, 'humidity': 50.0, 'battery': 90})
+        return {key: records}
+
+    def do_GET(self):
+        self.server.requests += 1
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path[len(BASE_PATH):]
+
+        if path == '':
+            return self._send({'appName': 'benchmark', 'serviceLocations': [
+                {'serviceLocationId': i, 'name': f'Benchmark {i}', 'deviceSerialNumber': f'50{i:08d}',
+                 'serviceLocationUuid': payloads.service_location_uuid(i)}
+                for i in range(1, self.server.locations + 1)]})
+
+        m = re.match(r'^/(\d+)/(.*)$', path)
+        if m is None:
+            return self.send_error(404)
+        service_location_id, resource = int(m.group(1)), m.group(2)
+
+        if resource == 'meteringconfiguration':
+            return self._send(payloads.metering_configuration(service_location_id,
+                                                              measurements=self.server.measurements))
+        if resource == 'consumption':
+            return self._send(self._consumptions(query, 'consumptions'))
+        if re.match(r'^(sensor|switch)/\d+/consumption$', resource):
+            return self._send(self._consumptions(query, 'records'))
+        if resource == 'events':
+            return self._send([{'activePower': 120.0, 'timestamp': int(time.time() * 1000)}])
+        if re.match(r'^actuator/\d+/state$', resource):
+            return self._send('ON_ON', content_type='text/plain')
+        if re.match(r'^actuator/\d+/connectionstate$', resource):
+            return self._send('CONNECTED', content_type='text/plain')
+        return self.send_error(404)
+
+
+class FakeCloud:
+    """Fake cloud API on 127.0.0.1 served from a background thread."""
+
+    def __init__(self, locations=10, measurements=10, port=0):
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), FakeCloudHandler)
+        self._server.daemon_threads = True
+        self._server.requests = 0
+        self._server.locations = locations
+        self._server.measurements = measurements
+        self._thread = threading.Thread(target=self._server.serve_forever, name='FakeCloud', daemon=True)
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    @property
+    def servicelocation_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}{BASE_PATH}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
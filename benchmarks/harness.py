@@ -0,0 +1,60 @@
+"""Timing and allocation measurement of benchmark runs."""
+import gc
+import time
+import tracemalloc
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def measure(name, calls, repeat=1):
+    """
+    Call every function of calls (repeat times) and return the throughput, latency and allocations.
+
+    Latencies are measured in a first pass, allocations in a second pass under tracemalloc.
+
+    :param calls: list of argumentless callables, one per operation
+    """
+    latencies = []
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for call in calls:
+            t = time.perf_counter_ns()
+            call()
+            latencies.append(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for call in calls:
+        call()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+    latencies.sort()
+    return {
+        'name': name,
+        'operations': len(latencies),
+        'ops_per_second': len(latencies) / elapsed if elapsed else 0,
+        'p50_us': percentile(latencies, 50) / 1000,
+        'p99_us': percentile(latencies, 99) / 1000,
+        'peak_kib': peak / 1024,
+        'retained_bytes_per_op': retained / len(calls) if calls else 0,
+    }
+
+
+def report(results):
+    header = f'{"benchmark":<40} {"ops":>8} {"ops/s":>12} {"p50 us":>10} {"p99 us":>10} {"peak KiB":>10} {"B/op":>8}'
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append(f'{r["name"]:<40} {r["operations"]:>8} {r["ops_per_second"]:>12.0f} {r["p50_us"]:>10.1f} '
+                     f'{r["p99_us"]:>10.1f} {r["peak_kib"]:>10.1f} {r["retained_bytes_per_op"]:>8.1f}')
+    return '\n'.join(lines)
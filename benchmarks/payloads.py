@@ -0,0 +1,94 @@
+"""Synthetic Smappee configurations and MQTT payloads."""
+import json
+import time
+import paho.mqtt.client as mqtt
+
+CHANNELS_PER_MEASUREMENT = 3
+
+
+def service_location_uuid(index):
+    return f'00000000-0000-0000-0000-{index:012d}'
+
+
+def metering_configuration(index, measurements=10, actuators=4, sensors=1, appliances=4):
+    """Cloud metering configuration with 3 channels per measurement."""
+    return {
+        'serviceLocationId': index,
+        'name': f'Benchmark {index}',
+        'serviceLocationUuid': service_location_uuid(index),
+        'timezone': 'Europe/Brussels',
+        'lat': 50.8,
+        'lon': 4.3,
+        'phaseType': 'THREE_PHASE_STAR',
+        'appliances': [{'id': a, 'name': f'Appliance {a}', 'type': 'Refrigerator', 'sourceType': 'NILM'}
+                       for a in range(1, appliances + 1)],
+        'actuators': [{'id': a, 'name': f'Plug {a}', 'serialNumber': f'4006{a:06d}', 'type': 'SWITCH',
+                       'connectionState': 'CONNECTED',
+                       'states': [{'id': 'ON_ON', 'name': 'on', 'current': False},
+                                  {'id': 'OFF_OFF', 'name': 'off', 'current': True}]}
+                      for a in range(1, actuators + 1)],
+        'sensors': [{'id': s, 'name': f'Sensor {s}', 'channels': [{'channel': 1, 'ppu': 1, 'name': 'gas'},
+                                                                  {'channel': 2, 'ppu': 1, 'name': 'water'}]}
+                    for s in range(1, sensors + 1)],
+        'measurements': [{'id': m, 'name': f'Measurement {m}', 'type': 'PRODUCTION' if m == 1 else 'CONSUMPTION',
+                          'channels': [{'powerTopicIndex': m * CHANNELS_PER_MEASUREMENT + c,
+                                        'consumptionIndex': m * CHANNELS_PER_MEASUREMENT + c,
+                                        'phase': c}
+                                       for c in range(CHANNELS_PER_MEASUREMENT)]}
+                         for m in range(measurements)],
+    }
+
+
+def power_payload(measurements, step=0):
+    channels = measurements * CHANNELS_PER_MEASUREMENT
+    return json.dumps({
+        'utcTimeStamp': int(time.time() * 1000),
+        'consumptionPower': 1000 + step,
+        'solarPower': 500,
+        'alwaysOn': 100,
+        'phaseVoltageData': [2300, 2310, 2320],
+        'phaseVoltageH3Data': [1, 1, 1],
+        'phaseVoltageH5Data': [2, 2, 2],
+        'activePowerData': [(i * 7 + step) % 1000 for i in range(channels)],
+        'reactivePowerData': [(i * 3 + step) % 100 for i in range(channels)],
+        'currentData': [(i + step) % 50 for i in range(channels)],
+    }).encode()
+
+
+def realtime_payload(measurements, step=0):
+    channels = measurements * CHANNELS_PER_MEASUREMENT
+    return json.dumps({
+        'totalPower': 1000 + step,
+        'totalReactivePower': 100,
+        'totalExportEnergy': 0,
+        'totalImportEnergy': 123456,
+        'monitorStatus': 0,
+        'utcTimeStamp': int(time.time() * 1000),
+        'channelPowers': [{'ctInput': i, 'publishIndex': i, 'power': (i * 7 + step) % 1000, 'current': i % 50,
+                           'exportEnergy': 0, 'importEnergy': 1000 * i, 'phaseId': i % 3}
+                          for i in range(channels)],
+        'voltages': [{'voltage': 230 + i, 'phaseId': i} for i in range(3)],
+    }).encode()
+
+
+def plug_state_payload(step=0):
+    return json.dumps({'value': 'ON' if step % 2 else 'OFF', 'since': int(time.time() * 1000)}).encode()
+
+
+def channel_config_payload(measurements):
+    return json.dumps({
+        'dataProcessingSpecification': {
+            'phaseType': 'THREE_PHASE_STAR',
+            'measurements': [{'name': f'Measurement {m}',
+                              'flow': 'PRODUCTION' if m == 1 else 'CONSUMPTION',
+                              'connectionType': 'GRID' if m < 2 else 'SUBMETER',
+                              'publishIndex': m * CHANNELS_PER_MEASUREMENT + c}
+                             for m in range(measurements) for c in range(CHANNELS_PER_MEASUREMENT)],
+        },
+    }).encode()
+
+
+def message(topic, payload):
+    msg = mqtt.MQTTMessage(topic=topic.encode())
+    msg.payload = payload
+    return msg
@@ -0,0 +1,33 @@
+"""Run the benchmarks and print a report.
+
+    $ python -m benchmarks.run --locations 100 --measurements 10 --messages 20000
+"""
+import argparse
+from .harness import report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pysmappee benchmarks')
+    parser.add_argument('--locations', type=int, default=100, help='service locations')
+    parser.add_argument('--measurements', type=int, default=10, help='measurements per service location')
+    parser.add_argument('--messages', type=int, default=20000, help='MQTT messages per benchmark')
+    parser.add_argument('--polls', type=int, default=5, help='polls per service location')
+    parser.add_argument('--polling-locations', type=int, default=10, help='service locations polled over HTTP')
+    parser.add_argument('--only', choices=['mqtt', 'polling'], help='run a single suite')
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.only in (None, 'mqtt'):
+        from . import bench_mqtt
+        results += bench_mqtt.run(locations=args.locations, measurements=args.measurements, messages=args.messages)
+        results += bench_mqtt.run(locations=args.locations, measurements=args.measurements, messages=args.messages,
+                                  history=True)[:2]
+    if args.only in (None, 'polling'):
+        from . import bench_polling
+        results += bench_polling.run(locations=args.polling_locations, measurements=args.measurements,
+                                     polls=args.polls)
+    print(report(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""Simulator of Smappee monitors for load testing the local API and local MQTT clients.
+
+Every simulated device serves the gateway/apipublic endpoints on its own HTTP port and publishes
+Genius-style topics (config, channelConfigV2, homeControlConfig, realtime and plug states) to an
+MQTT broker, e.g. a local mosquitto.
+
+    $ python -m benchmarks.simulator --devices 100 --channels 12 --rate 1
+
+Point the clients at the simulator with SmappeeLocalApi(ip='127.0.0.1:<port>') and
+SmappeeSimulator.configure_clients(), which sets the broker host and the port of every device in
+config['MQTT']['local']. SmappeeLocalMqtt(serial_number=...) only follows the service location of its own
+device, so the devices can share one broker; with --broker-per-device device N publishes to a broker on
+--broker-port + N - 1 instead, e.g. one mosquitto per device.
+"""
+import argparse
+import heapq
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import paho.mqtt.client as mqtt
+from pysmappee.config import config
+
+NOT_AUTHENTICATED = {'error': 'Error not authenticated. Use Logon first!'}
+
+
+class SimulatedDevice:
+    """State of one simulated monitor: channel powers, voltages and plugs."""
+
+    def __init__(self, index, channels=6, plugs=2, solar_channels=0, seed=None):
+        self.serial_number = f'50{index:08d}'
+        self.service_location_id = index
+        self.service_location_uuid = str(uuid.UUID(int=index))
+        self.channels = channels
+        self.solar_channels = solar_channels
+        self.authenticated = False
+        self.plugs = {node_id: False for node_id in range(1, plugs + 1)}
+        self._random = random.Random(index if seed is None else seed)
+        self._powers = [self._random.uniform(50, 500) for _ in range(channels)]
+        self._lock = threading.Lock()
+
+    @property
+    def topic_prefix(self):
+        return f'servicelocation/{self.service_location_uuid}'
+
+    def step(self):
+        # random walk of the channel powers (W)
+        with self._lock:
+            self._powers = [max(0.0, p + self._random.uniform(-25, 25)) for p in self._powers]
+            return list(self._powers)
+
+    def set_plug(self, node_id, on):
+        with self._lock:
+            if node_id in self.plugs:
+                self.plugs[node_id] = on
+                return True
+        return False
+
+    # local HTTP API responses
+
+    def instantaneous(self):
+        powers = self.step()
+        return [{'key': f'phase{i}ActivePower', 'value': str(int(p * 1000))} for i, p in enumerate(powers)] + \
+               [{'key': f'phase{i}Current', 'value': str(int(p / 230 * 1000))} for i, p in enumerate(powers)]
+
+    def config_public(self):
+        return [
+            {'key': 'emeterConfiguration', 'value': '4'},
+            {'key': 'serialNumber', 'value': self.serial_number},
+            {'key': 'firmwareVersion', 'value': '1.0.0-simulator'},
+        ]
+
+    def channels_config_public(self):
+        return {'inputChannels': [
+            {'ctInput': i,
+             'name': f'Channel {i}',
+             'inputChannelConnection': 'GRID' if i < 3 or i >= self.channels - self.solar_channels else 'SUBMETER',
+             'inputChannelType': 'PRODUCTION' if i >= self.channels - self.solar_channels else 'CONSUMPTION'}
+            for i in range(self.channels)
+        ]}
+
+    def command_control_public(self):
+        return [{'key': str(node_id), 'value': f'Plug {node_id}', 'type': '2', 'relayStatus': on,
+                 'connectionStatus': 'connected', 'serialNumber': f'4006{node_id:06d}'}
+                for node_id, on in self.plugs.items()]
+
+    # MQTT payloads
+
+    def config_payload(self):
+        return {'serviceLocationId': self.service_location_id, 'serviceLocationUuid': self.service_location_uuid,
+                'serialNumber': self.serial_number, 'timeZone': 'Europe/Brussels',
+                'firmwareVersion': '1.0.0-simulator'}
+
+    def channel_config_payload(self):
+        return {'dataProcessingSpecification': {
+            'phaseType': 'THREE_PHASE_STAR',
+            'measurements': [{'name': f'Channel {i}',
+                              'flow': 'PRODUCTION' if i >= self.channels - self.solar_channels else 'CONSUMPTION',
+                              'connectionType': 'GRID' if i < 3 or i >= self.channels - self.solar_channels
+                              else 'SUBMETER',
+                              'publishIndex': i}
+                             for i in range(self.channels)],
+        }}
+
+    def home_control_config_payload(self):
+        return {'switchActuators': [],
+                'smartplugActuators': [{'nodeId': node_id, 'name': f'Plug {node_id}'} for node_id in self.plugs]}
+
+    def realtime_payload(self):
+        powers = self.step()
+        consumption = [p for i, p in enumerate(powers) if i < self.channels - self.solar_channels]
+        return {'totalPower': int(sum(consumption)),
+                'totalReactivePower': int(sum(consumption) * 0.1),
+                'totalExportEnergy': 0,
+                'totalImportEnergy': 0,
+                'monitorStatus': 0,
+                'utcTimeStamp': int(time.time() * 1000),
+                'channelPowers': [{'ctInput': i, 'publishIndex': i, 'power': int(p), 'current': int(p / 23),
+                                   'exportEnergy': 0, 'importEnergy': 0, 'phaseId': i % 3}
+                                  for i, p in enumerate(powers)],
+                'voltages': [{'voltage': 230 + self._random.randint(-3, 3), 'phaseId': i} for i in range(3)]}
+
+
+class SimulatedApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are separate writes, Nagle would hold back the body of a keep-alive response
+    # until the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        device = self.server.device
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+
+        if endpoint == 'logon':
+            device.authenticated = True
+            return self._send({'success': 'Logon successful!', 'header': 'Logon successful!'})
+        if endpoint == 'instantaneous':
+            return self._send(device.instantaneous() if device.authenticated else NOT_AUTHENTICATED)
+        if endpoint == 'configPublic':
+            return self._send(device.config_public())
+        if endpoint == 'channelsConfigPublic':
+            return self._send(device.channels_config_public())
+        if endpoint == 'advancedConfigPublic':
+            return self._send([])
+        if endpoint == 'commandControlPublic':
+            if body == 'load':
+                return self._send(device.command_control_public())
+            m = re.match(r'^control,(.*)$', body)
+            if m is not None:
+                command = json.loads(m.group(1))
+                self.server.simulator.set_plug(device, int(command['controllableNodeId']), command['action'] == 'ON')
+                return self._send({})
+        return self.send_error(404)
+
+
+class SmappeeSimulator:
+    """Run simulated devices with an HTTP server each and an MQTT publisher per broker."""
+
+    def __init__(self, devices=10, channels=6, plugs=2, solar_channels=0, rate=1.0,
+                 broker_host='127.0.0.1', broker_port=1883, http_host='127.0.0.1', http_port=0, mqtt_enabled=True,
+                 broker_per_device=False):
+        """
+        :param devices: number of simulated monitors
+        :param channels: CT channels per monitor
+        :param rate: realtime messages per second per monitor
+        :param http_port: port of the first device, consecutive ports for the others (0 for any free port)
+        :param broker_per_device: publish every device to its own broker on consecutive ports from broker_port
+        """
+        self.devices = [SimulatedDevice(index=i, channels=channels, plugs=plugs, solar_channels=solar_channels)
+                        for i in range(1, devices + 1)]
+        self._rate = rate
+        self._servers = []
+        for i, device in enumerate(self.devices):
+            server = ThreadingHTTPServer((http_host, http_port + i if http_port else 0), SimulatedApiHandler)
+            server.daemon_threads = True
+            server.device = device
+            server.simulator = self
+            self._servers.append(server)
+
+        # broker port per device and an MQTT client per broker port
+        self._broker_host = broker_host
+        self.broker_ports = {device.serial_number: broker_port + i if broker_per_device else broker_port
+                             for i, device in enumerate(self.devices)}
+        self._clients = {}
+        if mqtt_enabled:
+            for port in sorted(set(self.broker_ports.values())):
+                client = mqtt.Client(client_id=f'smappee-simulator-{uuid.uuid4()}')
+                client.on_connect = self._on_connect
+                client.on_message = self._on_message
+                self._clients[port] = client
+
+        self._running = False
+        self._threads = []
+        self.published = 0
+
+    def address(self, device):
+        """ip:port to pass to SmappeeLocalApi."""
+        host, port = self._servers[self.devices.index(device)].server_address[:2]
+        return f'{host}:{port}'
+
+    def configure_clients(self):
+        """Point the local MQTT clients of this process (config['MQTT']['local']) at the simulated brokers."""
+        config['MQTT']['local']['host'] = self._broker_host
+        config['MQTT']['local']['ports'] = dict(config['MQTT']['local']['ports'], **self.broker_ports)
+
+    def _devices(self, client):
+        # devices publishing through a client
+        port = next(port for port, c in self._clients.items() if c is client)
+        return [device for device in self.devices if self.broker_ports[device.serial_number] == port]
+
+    def _publish(self, device, topic, payload, retain=False):
+        self._clients[self.broker_ports[device.serial_number]].publish(
+            f'{device.topic_prefix}/{topic}', json.dumps(payload), retain=retain
+        )
+        self.published += 1
+
+    def _publish_configuration(self, device):
+        self._publish(device, 'config', device.config_payload(), retain=True)
+        self._publish(device, 'channelConfigV2', device.channel_config_payload(), retain=True)
+        self._publish(device, 'homeControlConfig', device.home_control_config_payload(), retain=True)
+        for node_id, on in device.plugs.items():
+            self._publish_plug(device, node_id, on)
+
+    def _publish_plug(self, device, node_id, on):
+        since = int(time.time() * 1000)
+        self._publish(device, f'plug/{node_id}/state', {'value': 'ON' if on else 'OFF', 'since': since}, retain=True)
+        self._publish(device, f'plug/{node_id}/connectionState', {'value': 'CONNECTED', 'since': since}, retain=True)
+
+    def set_plug(self, device, node_id, on):
+        if device.set_plug(node_id, on) and self._clients:
+            self._publish_plug(device, node_id, on)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        client.subscribe('servicelocation/+/plug/+/setstate')
+        for device in self._devices(client):
+            self._publish_configuration(device)
+
+    def _on_message(self, client, userdata, message):
+        # plug commands of SmappeeLocalMqtt.set_actuator_state
+        levels = message.topic.split('/')
+        device = next((d for d in self._devices(client) if d.service_location_uuid == levels[1]), None)
+        if device is not None:
+            value = json.loads(message.payload.decode().replace("'", '"')).get('value')
+            self.set_plug(device, int(levels[3]), value == 'ON')
+
+    def _publish_realtime(self):
+        # one scheduler for all devices, spread evenly over the publish interval
+        interval = 1 / self._rate
+        queue = [(time.monotonic() + interval * i / len(self.devices), i) for i in range(len(self.devices))]
+        heapq.heapify(queue)
+        while self._running and queue:
+            due, i = heapq.heappop(queue)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._publish(self.devices[i], 'realtime', self.devices[i].realtime_payload())
+            heapq.heappush(queue, (due + interval, i))
+
+    def start(self):
+        self._running = True
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever, name='SmappeeSimulatorHttp', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        for port, client in self._clients.items():
+            client.connect(host=self._broker_host, port=port)
+            client.loop_start()
+        if self._clients:
+            if self._rate:
+                thread = threading.Thread(target=self._publish_realtime, name='SmappeeSimulatorMqtt', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._running = False
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        for client in self._clients.values():
+            client.disconnect()
+            client.loop_stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate Smappee monitors')
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=6, help='CT channels per device')
+    parser.add_argument('--plugs', type=int, default=2, help='comfort plugs per device')
+    parser.add_argument('--solar-channels', type=int, default=0, help='production channels per device')
+    parser.add_argument('--rate', type=float, default=1.0, help='realtime messages per second per device')
+    parser.add_argument('--broker', default='127.0.0.1', help='MQTT broker host')
+    parser.add_argument('--broker-port', type=int, default=1883, help='MQTT broker port (of the first device)')
+    parser.add_argument('--broker-per-device', action='store_true',
+                        help='publish every device to its own broker on consecutive ports')
+    parser.add_argument('--http-port', type=int, default=0, help='HTTP port of the first device')
+    parser.add_argument('--no-mqtt', action='store_true', help='only serve the local HTTP API')
+    args = parser.parse_args(argv)
+
+    simulator = SmappeeSimulator(devices=args.devices, channels=args.channels, plugs=args.plugs,
+                                 solar_channels=args.solar_channels, rate=args.rate, broker_host=args.broker,
+                                 broker_port=args.broker_port, http_port=args.http_port,
+                                 mqtt_enabled=not args.no_mqtt, broker_per_device=args.broker_per_device).start()
+    for device in simulator.devices:
+        print(device.serial_number, device.service_location_uuid, simulator.address(device),
+              simulator.broker_ports[device.serial_number])
+
+    try:
+        while True:
+            time.sleep(10)
+            print(f'{simulator.published} MQTT messages published')
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Support for the asynchronous Smappee cloud API."""
+import asyncio
+import functools
+import random
+import time
+import aiohttp
+from .api import SmappeeApi, scale_always_on, token_expiring
+from .config import config
+from .helper import urljoin
+from .metrics import metrics
+
+# methods retried on connection errors and server errors, as by the urllib3 Retry of SmappeeApi
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+def async_authenticated(func):
+    # Decorator to renew access tokens before they expire and to refresh rejected access tokens
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        self = args[0]
+        if token_expiring(self._token):
+            await self.refresh_tokens(expired_access_token=self._access_token, reason='proactive')
+
+        access_token = self._access_token
+        try:
+            return await func(*args, **kwargs)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 401:
+                raise
+            await self.refresh_tokens(expired_access_token=access_token)
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class AsyncSmappeeApi:
+    """Public Smappee cloud API wrapper for asyncio."""
+
+    def __init__(
+            self,
+            client_id,
+            client_secret,
+            token=None,
+            token_updater=None,
+            farm=1,
+            session=None,
+            connection_limit=100,
+            consumption_store=None
+    ):
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._token = token
+        self._token_updater = token_updater
+        self._farm = farm
+
+        # single-flight token refresh, created on first use to bind to the running loop
+        self._token_lock = None
+
+        # an externally provided session is shared and not closed by this instance
+        self._session = session
+        self._close_session = session is None
+        self._connection_limit = connection_limit
+
+        # optional SmappeeConsumptionStore serving completed consumption buckets
+        self._consumption_store = consumption_store
+
+    @property
+    def farm(self):
+        return self._farm
+
+    @property
+    def token(self):
+        return self._token
+
+    @property
+    def _access_token(self):
+        return (self._token or {}).get('access_token')
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self._access_token}"}
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._connection_limit),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and self._close_session:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _url(self, *parts):
+        return urljoin(config['API_URL'][self._farm]['servicelocation_url'], *parts)
+
+    @staticmethod
+    def _timeout(endpoint):
+        # the (connect, read) timeouts of SmappeeApi
+        connect, read = SmappeeApi._timeout(endpoint)
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def _request(self, method, url, params=None, json=None, text=False, endpoint='default'):
+        if params is not None:
+            # aiohttp does not drop empty query parameters
+            params = {k: v for k, v in params.items() if v is not None}
+
+        # retry server errors, connection errors and timeouts with jittered exponential backoff
+        retries = config['HTTP']['retries'] if method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                return await self._request_once(method, url, params, json, text, endpoint)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in config['HTTP']['retry_status'] or attempt == retries:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+
+            if metrics.enabled:
+                metrics.inc('smappee_api_retries_total', api='async', endpoint=endpoint)
+            await asyncio.sleep(random.uniform(0, config['HTTP']['backoff_factor'] * 2 ** attempt))
+
+    async def _request_once(self, method, url, params, json, text, endpoint):
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            async with self._get_session().request(method, url, headers=self.headers, params=params, json=json,
+                                                   timeout=self._timeout(endpoint)) as r:
+                if start is not None:
+                    body = await r.read()
+                    metrics.observe('smappee_api_request_seconds', time.perf_counter() - start,
+                                    api='async', endpoint=endpoint)
+                    metrics.inc('smappee_api_requests_total', api='async', endpoint=endpoint, status=r.status)
+                    metrics.inc('smappee_api_response_bytes_total', len(body), api='async', endpoint=endpoint)
+                r.raise_for_status()
+                if text:
+                    return await r.text()
+                return await r.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if start is not None:
+                metrics.inc('smappee_api_requests_total', api='async', endpoint=endpoint, status='error')
+            raise
+
+    @async_authenticated
+    async def get_service_locations(self):
+        return await self._request('GET', config['API_URL'][self._farm]['servicelocation_url'],
+                                   endpoint='service_locations')
+
+    @async_authenticated
+    async def get_metering_configuration(self, service_location_id):
+        return await self._request('GET', self._url(service_location_id, "meteringconfiguration"),
+                                   endpoint='metering_configuration')
+
+    @async_authenticated
+    async def get_service_location_info(self, service_location_id):
+        return await self._request('GET', self._url(service_location_id, "info"), endpoint='service_location_info')
+
+    @async_authenticated
+    async def get_consumption(self, service_location_id, start, end, aggregation):
+        url = self._url(service_location_id, "consumption")
+        d = await self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                        service_location_id=service_location_id, entity='location')
+        return scale_always_on(d)
+
+    @async_authenticated
+    async def get_sensor_consumption(self, service_location_id, sensor_id, start, end, aggregation):
+        url = self._url(service_location_id, "sensor", sensor_id, "consumption")
+        return await self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                           service_location_id=service_location_id, entity=f'sensor/{sensor_id}')
+
+    @async_authenticated
+    async def get_switch_consumption(self, service_location_id, switch_id, start, end, aggregation):
+        url = self._url(service_location_id, "switch", switch_id, "consumption")
+        return await self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                           service_location_id=service_location_id, entity=f'switch/{switch_id}')
+
+    async def _get_consumption(self, url, start, end, aggregation, service_location_id=None, entity=None):
+        start, end = self._to_milliseconds(start), self._to_milliseconds(end)
+
+        async def fetch(fetch_start, fetch_end):
+            params = {
+                "aggregation": aggregation,
+                "from": fetch_start,
+                "to": fetch_end
+            }
+            return await self._request('GET', url, params=params, endpoint='consumption')
+
+        if self._consumption_store is None or entity is None:
+            return await fetch(start, end)
+
+        return await self._consumption_store.async_fetch(service_location_id=service_location_id,
+                                                         entity=entity,
+                                                         aggregation=aggregation,
+                                                         start=start,
+                                                         end=end,
+                                                         records_key='consumptions' if entity == 'location' else 'records',
+                                                         fetch=fetch)
+
+    @async_authenticated
+    async def get_events(self, service_location_id, appliance_id, start, end, max_number=None):
+        start, end = self._to_milliseconds(start), self._to_milliseconds(end)
+
+        params = {
+            "from": start,
+            "to": end,
+            "applianceId": appliance_id,
+            "maxNumber": max_number
+        }
+        return await self._request('GET', self._url(service_location_id, "events"), params=params, endpoint='events')
+
+    @async_authenticated
+    async def get_actuator_state(self, service_location_id, actuator_id):
+        url = self._url(service_location_id, "actuator", actuator_id, "state")
+        return await self._request('GET', url, text=True, endpoint='actuator_state')
+
+    @async_authenticated
+    async def set_actuator_state(self, service_location_id, actuator_id, state_id, duration=None):
+        url = self._url(service_location_id, "actuator", actuator_id, state_id)
+        data = {} if duration is None else {"duration": duration}
+        return await self._request('POST', url, json=data, text=True, endpoint='set_actuator_state')
+
+    @async_authenticated
+    async def get_actuator_connection_state(self, service_location_id, actuator_id):
+        url = self._url(service_location_id, "actuator", actuator_id, "connectionstate")
+        return await self._request('GET', url, text=True, endpoint='actuator_connection_state')
+
+    _to_milliseconds = SmappeeApi._to_milliseconds
+
+    async def refresh_tokens(self, expired_access_token=None, reason='expired'):
+        """
+        :param expired_access_token: access token that needs to be replaced, the refresh is skipped when
+         another task already replaced it
+        :param reason: metrics label of the refresh (expired or proactive)
+        """
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+
+        async with self._token_lock:
+            # another task replaced the token while this one waited
+            if expired_access_token is not None and self._access_token != expired_access_token:
+                return self._token
+            if reason == 'proactive' and not token_expiring(self._token):
+                return self._token
+
+            if metrics.enabled:
+                metrics.inc('smappee_api_token_refreshes_total', api='async', reason=reason)
+            data = {
+                "grant_type": "refresh_token",
+                "refresh_token": self._token.get('refresh_token'),
+                "client_id": self._client_id,
+                "client_secret": self._client_secret,
+            }
+            async with self._get_session().post(config['API_URL'][self._farm]['token_url'], data=data,
+                                                timeout=self._timeout('token')) as r:
+                r.raise_for_status()
+                token = await r.json(content_type=None)
+
+            # the refresh token is kept when the server does not rotate it
+            token.setdefault('refresh_token', self._token.get('refresh_token'))
+
+            if 'expires_in' in token:
+                token['expires_at'] = time.time() + int(token['expires_in'])
+            self._token = token
+
+        if self._token_updater is not None:
+            self._token_updater(token)
+
+        return token
@@ -2,26 +2,94 @@
 import datetime as dt
 import functools
 import numbers
+import random
+import re
+import threading
+import time
 import pytz
 import requests
-from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, ConnectTimeout, ReadTimeout, \
     ConnectionError as RequestsConnectionError
 from requests_oauthlib import OAuth2Session
+from urllib3.util.retry import Retry
 from .config import config
 from .helper import urljoin
+from .metrics import metrics, InstrumentedTTLCache
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff retry with full jitter."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff else 0
+
+
+def create_session():
+    """Create a keep-alive HTTP session with retries for server errors and timeouts."""
+    retry = JitteredRetry(
+        total=config['HTTP']['retries'],
+        backoff_factor=config['HTTP']['backoff_factor'],
+        status_forcelist=config['HTTP']['retry_status'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config['HTTP']['pool_connections'],
+        pool_maxsize=config['HTTP']['pool_maxsize'],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(farm):
+    """Return the HTTP session shared by all cloud API instances of a farm."""
+    with _sessions_lock:
+        if farm not in _sessions:
+            _sessions[farm] = create_session()
+        return _sessions[farm]
+
+
+def scale_always_on(consumption):
+    # Convert the alwaysOn values of a consumption response in place
+    for block in consumption['consumptions']:
+        if 'alwaysOn' not in block.keys():
+            break
+        block.update({'alwaysOn': block.get('alwaysOn') / 12})
+    return consumption
+
+
+def token_expiring(token):
+    # whether a token expires within the refresh margin, tokens without expires_at are refreshed on a 401
+    expires_at = (token or {}).get('expires_at')
+    return (expires_at is not None and 'refresh_token' in token
+            and float(expires_at) - config['HTTP']['token_refresh_margin'] <= time.time())
 
 
 def authenticated(func):
-    # Decorator to refresh expired access tokens
+    # Decorator to renew access tokens before they expire and to refresh rejected access tokens
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         self = args[0]
+        if token_expiring(self._oauth.token):
+            self.refresh_tokens(expired_access_token=self._oauth.access_token, reason='proactive')
+
+        access_token = self._oauth.access_token
         try:
             return func(*args, **kwargs)
         except HTTPError as e:
-            if e.response.status_code == 401:
-                self._oauth.token = self.refresh_tokens()
+            if e.response is None or e.response.status_code != 401:
+                raise
+            self.refresh_tokens(expired_access_token=access_token)
             return func(*args, **kwargs)
     return wrapper
 
@@ -36,13 +104,24 @@ class SmappeeApi:
             redirect_uri=None,
             token=None,
             token_updater=None,
-            farm=1
+            farm=1,
+            session=None,
+            consumption_store=None
     ):
         self._client_id = client_id
         self._client_secret = client_secret
         self._token_updater = token_updater
         self._farm = farm
 
+        # single-flight token refresh, threads with the same expired access token wait for one refresh
+        self._token_lock = threading.Lock()
+
+        # pooled keep-alive session, shared per farm unless one is provided
+        self._session = session if session is not None else get_session(farm)
+
+        # optional SmappeeConsumptionStore serving completed consumption buckets
+        self._consumption_store = consumption_store
+
         extra = {"client_id": self._client_id, "client_secret": self._client_secret}
 
         self._oauth = OAuth2Session(
@@ -57,15 +136,49 @@ class SmappeeApi:
     def farm(self):
         return self._farm
 
+    @property
+    def token(self):
+        return self._oauth.token
+
+    @token.setter
+    def token(self, token):
+        # a token refreshed elsewhere (e.g. by another fleet shard)
+        with self._token_lock:
+            self._oauth.token = token
+
     @property
     def headers(self):
         return {"Authorization": f"Bearer {self._oauth.access_token}"}
 
-    @authenticated
-    def get_service_locations(self):
-        r = requests.get(config['API_URL'][self._farm]['servicelocation_url'], headers=self.headers)
+    @staticmethod
+    def _timeout(endpoint):
+        timeouts = config['HTTP']['timeouts']
+        return timeouts.get(endpoint, timeouts['default'])
+
+    def _request(self, method, url, endpoint='default', **kwargs):
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            r = self._session.request(method, url, headers=self.headers, timeout=self._timeout(endpoint), **kwargs)
+        except Exception:
+            if start is not None:
+                metrics.inc('smappee_api_requests_total', api='cloud', endpoint=endpoint, status='error')
+            raise
+
+        if start is not None:
+            metrics.observe('smappee_api_request_seconds', time.perf_counter() - start, api='cloud', endpoint=endpoint)
+            metrics.inc('smappee_api_requests_total', api='cloud', endpoint=endpoint, status=r.status_code)
+            metrics.inc('smappee_api_response_bytes_total', len(r.content), api='cloud', endpoint=endpoint)
+            retries = getattr(getattr(r.raw, 'retries', None), 'history', ())
+            if retries:
+                metrics.inc('smappee_api_retries_total', len(retries), api='cloud', endpoint=endpoint)
+
         r.raise_for_status()
+        return r
 
+    @authenticated
+    def get_service_locations(self):
+        r = self._request('GET', config['API_URL'][self._farm]['servicelocation_url'],
+                          endpoint='service_locations')
         return r.json()
 
     @authenticated
@@ -75,8 +188,7 @@ class SmappeeApi:
             service_location_id,
             "meteringconfiguration"
         )
-        r = requests.get(url, headers=self.headers)
-        r.raise_for_status()
+        r = self._request('GET', url, endpoint='metering_configuration')
         return r.json()
 
     @authenticated
@@ -86,8 +198,7 @@ class SmappeeApi:
             service_location_id,
             "info"
         )
-        r = requests.get(url, headers=self.headers)
-        r.raise_for_status()
+        r = self._request('GET', url, endpoint='service_location_info')
         return r.json()
 
     @authenticated
@@ -108,12 +219,9 @@ class SmappeeApi:
             service_location_id,
             "consumption"
         )
-        d = self._get_consumption(url=url, start=start, end=end, aggregation=aggregation)
-        for block in d['consumptions']:
-            if 'alwaysOn' not in block.keys():
-                break
-            block.update({'alwaysOn': block.get('alwaysOn') / 12})
-        return d
+        d = self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                  service_location_id=service_location_id, entity='location')
+        return scale_always_on(d)
 
     @authenticated
     def get_sensor_consumption(self, service_location_id, sensor_id, start, end, aggregation):
@@ -124,7 +232,8 @@ class SmappeeApi:
             sensor_id,
             "consumption"
         )
-        return self._get_consumption(url=url, start=start, end=end, aggregation=aggregation)
+        return self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                     service_location_id=service_location_id, entity=f'sensor/{sensor_id}')
 
     @authenticated
     def get_switch_consumption(self, service_location_id, switch_id, start, end, aggregation):
@@ -135,19 +244,31 @@ class SmappeeApi:
             switch_id,
             "consumption"
         )
-        return self._get_consumption(url=url, start=start, end=end, aggregation=aggregation)
+        return self._get_consumption(url=url, start=start, end=end, aggregation=aggregation,
+                                     service_location_id=service_location_id, entity=f'switch/{switch_id}')
 
-    def _get_consumption(self, url, start, end, aggregation):
+    def _get_consumption(self, url, start, end, aggregation, service_location_id=None, entity=None):
         start, end = self._to_milliseconds(start), self._to_milliseconds(end)
 
-        params = {
-            "aggregation": aggregation,
-            "from": start,
-            "to": end
-        }
-        r = requests.get(url, headers=self.headers, params=params)
-        r.raise_for_status()
-        return r.json()
+        def fetch(fetch_start, fetch_end):
+            params = {
+                "aggregation": aggregation,
+                "from": fetch_start,
+                "to": fetch_end
+            }
+            r = self._request('GET', url, endpoint='consumption', params=params)
+            return r.json()
+
+        if self._consumption_store is None or entity is None:
+            return fetch(start, end)
+
+        return self._consumption_store.fetch(service_location_id=service_location_id,
+                                             entity=entity,
+                                             aggregation=aggregation,
+                                             start=start,
+                                             end=end,
+                                             records_key='consumptions' if entity == 'location' else 'records',
+                                             fetch=fetch)
 
     @authenticated
     def get_events(self, service_location_id, appliance_id, start, end, max_number=None):
@@ -164,8 +285,7 @@ class SmappeeApi:
             "applianceId": appliance_id,
             "maxNumber": max_number
         }
-        r = requests.get(url, headers=self.headers, params=params)
-        r.raise_for_status()
+        r = self._request('GET', url, endpoint='events', params=params)
         return r.json()
 
     @authenticated
@@ -177,8 +297,7 @@ class SmappeeApi:
             actuator_id,
             "state"
         )
-        r = requests.get(url, headers=self.headers)
-        r.raise_for_status()
+        r = self._request('GET', url, endpoint='actuator_state')
         return r.text
 
     @authenticated
@@ -191,9 +310,7 @@ class SmappeeApi:
             state_id
         )
         data = {} if duration is None else {"duration": duration}
-        r = requests.post(url, headers=self.headers, json=data)
-        r.raise_for_status()
-        return r
+        return self._request('POST', url, endpoint='set_actuator_state', json=data)
 
     @authenticated
     def get_actuator_connection_state(self, service_location_id, actuator_id):
@@ -204,8 +321,7 @@ class SmappeeApi:
             actuator_id,
             "connectionstate"
         )
-        r = requests.get(url, headers=self.headers)
-        r.raise_for_status()
+        r = self._request('GET', url, endpoint='actuator_connection_state')
         return r.text
 
     def _to_milliseconds(self, time):
@@ -227,18 +343,76 @@ class SmappeeApi:
             token_url=config['API_URL'][self._farm]['token_url'],
             authorization_response=authorization_response,
             code=code,
-            client_secret=self.client_secret,
+            client_secret=self._client_secret,
         )
 
-    def refresh_tokens(self):
-        token = self._oauth.refresh_token(token_url=config['API_URL'][self._farm]['token_url'])
-
-        if self.token_updater is not None:
-            self.token_updater(token)
+    def refresh_tokens(self, expired_access_token=None, reason='expired'):
+        """
+        :param expired_access_token: access token that needs to be replaced, the refresh is skipped when
+         another thread already replaced it
+        :param reason: metrics label of the refresh (expired or proactive)
+        """
+        with self._token_lock:
+            # another thread replaced the token while this one waited
+            if expired_access_token is not None and self._oauth.access_token != expired_access_token:
+                return self._oauth.token
+            if reason == 'proactive' and not token_expiring(self._oauth.token):
+                return self._oauth.token
+
+            if metrics.enabled:
+                metrics.inc('smappee_api_token_refreshes_total', api='cloud', reason=reason)
+            token = self._oauth.refresh_token(token_url=config['API_URL'][self._farm]['token_url'],
+                                              timeout=self._timeout('token'))
+            self._oauth.token = token
+
+        if self._token_updater is not None:
+            self._token_updater(token)
 
         return token
 
 
+# instantaneous keys per phase, e.g. phase0ActivePower, phase1Current
+PHASE_KEY = re.compile(r'^phase(\d+)(\w+)$')
+
+
+class SmappeeInstantaneous:
+    """Instantaneous values of a local Smappee device, parsed once into dicts by key and by phase."""
+
+    def __init__(self, values, consumption_indices=(), production_indices=()):
+        # all numeric values by key and the per phase values by phase and field (ActivePower, Current, ...)
+        self.values = {}
+        self.phases = {}
+
+        consumption_keys, production_keys = set(consumption_indices), set(production_indices)
+        consumption, production = 0.0, 0.0
+        for item in values:
+            try:
+                key, value = item['key'], float(item['value'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.values[key] = value
+
+            if key in consumption_keys:
+                consumption += value
+            elif key in production_keys:
+                production += value
+
+            m = PHASE_KEY.match(key)
+            if m is not None:
+                self.phases.setdefault(int(m.group(1)), {})[m.group(2)] = value
+
+        # active power totals in W (the device reports mW)
+        self.consumption_power = int(consumption / 1000)
+        self.production_power = int(production / 1000)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def phase_values(self, field):
+        """Values of a field (ActivePower, ReactivePower, Current, Voltage, ...) by phase."""
+        return {phase: values[field] for phase, values in sorted(self.phases.items()) if field in values}
+
+
 class SmappeeLocalApi:
     """Smappee local API wrapper."""
 
@@ -253,8 +427,9 @@ class SmappeeLocalApi:
         self.consumption_indices = ['phase0ActivePower', 'phase1ActivePower', 'phase2ActivePower']
         self.production_indices = ['phase3ActivePower', 'phase4ActivePower', 'phase5ActivePower']
 
-        # cache instantaneous load
-        self.load_cache = TTLCache(maxsize=2, ttl=5)
+        # cache the parsed instantaneous values, one request serves all callers within the ttl
+        self.load_cache = InstrumentedTTLCache(maxsize=2, ttl=5, name='local_api')
+        self._instantaneous_lock = threading.Lock()
 
     @property
     def host(self):
@@ -265,22 +440,31 @@ class SmappeeLocalApi:
         return {"Content-Type": "application/json"}
 
     def _post(self, url, data=None, retry=False):
+        start = time.perf_counter() if metrics.enabled else None
         try:
             _url = urljoin(self.host, url)
             r = self.session.post(_url,
                                   data=data,
                                   headers=self.headers,
                                   timeout=2)
+            if start is not None:
+                metrics.observe('smappee_api_request_seconds', time.perf_counter() - start, api='local', endpoint=url)
+                metrics.inc('smappee_api_requests_total', api='local', endpoint=url, status=r.status_code)
+                metrics.inc('smappee_api_response_bytes_total', len(r.content), api='local', endpoint=url)
             r.raise_for_status()
 
             msg = r.json()
             if not retry and 'error' in msg \
                     and msg['error'] == 'Error not authenticated. Use Logon first!':
+                if start is not None:
+                    metrics.inc('smappee_api_token_refreshes_total', api='local')
                 self.logon()
                 return self._post(url=url, data=data, retry=True)
 
             return msg
-        except (ConnectTimeout, ReadTimeout, RequestsConnectionError, HTTPError):
+        except (ConnectTimeout, ReadTimeout, RequestsConnectionError, HTTPError) as e:
+            if start is not None and not isinstance(e, HTTPError):
+                metrics.inc('smappee_api_requests_total', api='local', endpoint=url, status='error')
             return None
 
     def logon(self):
@@ -292,8 +476,9 @@ class SmappeeLocalApi:
     def load_channels_config(self):
         # Method only available on Smappee2-series devices
 
-        # reset consumption and production indices
+        # reset consumption and production indices (and the totals of the cached instantaneous values)
         self.consumption_indices, self.production_indices = [], []
+        self.load_cache.pop('instantaneous', None)
 
         cc = self._post(url='channelsConfigPublic', data='load')
         for input_channel in cc['inputChannels']:
@@ -333,6 +518,7 @@ class SmappeeLocalApi:
             self.consumption_indices = ['phase0ActivePower', 'phase1ActivePower']
             self.production_indices = ['phase2ActivePower', 'phase3ActivePower']
 
+        self.load_cache.pop('instantaneous', None)
         return c
 
     def load_command_control_config(self):
@@ -341,6 +527,26 @@ class SmappeeLocalApi:
     def load_instantaneous(self):
         return self._post(url='instantaneous', data='loadInstantaneous')
 
+    def instantaneous(self):
+        """
+        Get the parsed instantaneous values. Result is cached.
+
+        :return: SmappeeInstantaneous or None if the device is unreachable
+        """
+        with self._instantaneous_lock:
+            if 'instantaneous' in self.load_cache:
+                return self.load_cache['instantaneous']
+
+            inst = self.load_instantaneous()
+            if inst is None:
+                return None
+
+            snapshot = SmappeeInstantaneous(values=inst,
+                                            consumption_indices=self.consumption_indices,
+                                            production_indices=self.production_indices)
+            self.load_cache['instantaneous'] = snapshot
+            return snapshot
+
     def active_power(self, solar=False):
         """
         Get the current active power consumption or solar production. Result is cached.
@@ -348,30 +554,11 @@ class SmappeeLocalApi:
         :param solar:
         :return:
         """
-        if solar and 'instantaneous_solar' in self.load_cache:
-            return self.load_cache['instantaneous_solar']
-        elif not solar and 'instantaneous_load' in self.load_cache:
-            return self.load_cache['instantaneous_load']
-
-        inst = self.load_instantaneous()
-
-        if inst is None:
+        snapshot = self.instantaneous()
+        if snapshot is None:
             return None
 
-        power_keys = self.production_indices if solar else self.consumption_indices
-
-        values = [float(i['value']) for i in inst if i['key'] in power_keys]
-        if values:
-            power = int(sum(values) / 1000)
-        else:
-            power = 0
-
-        if solar:
-            self.load_cache['instantaneous_solar'] = power
-        else:
-            self.load_cache['instantaneous_load'] = power
-
-        return power
+        return snapshot.production_power if solar else snapshot.consumption_power
 
     def set_actuator_state(self, service_location_id, actuator_id, state_id, duration=None):
         if state_id == 'ON_ON':
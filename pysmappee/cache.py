@@ -0,0 +1,154 @@
+"""Support for caching the polled values of a service location until they can change."""
+import threading
+import time
+import pytz
+from datetime import datetime, timedelta
+from .config import config
+from .metrics import metrics
+
+# the bucket a cached value belongs to, a value expires at the latest when its bucket ends
+BOUNDARY_5_MINUTES = '5_minutes'
+BOUNDARY_HOUR = 'hour'
+BOUNDARY_DAY = 'day'
+
+# bucket boundary per resource and id (trend), None for values that are not bound to a bucket
+BOUNDARIES = {
+    ('trend', 'today'): BOUNDARY_DAY,
+    ('trend', 'current_hour'): BOUNDARY_HOUR,
+    ('trend', 'last_5_minutes'): BOUNDARY_5_MINUTES,
+    ('trend', 'buckets'): BOUNDARY_5_MINUTES,
+    'actuator_consumption': BOUNDARY_DAY,
+    'sensor_consumption': BOUNDARY_DAY,
+}
+
+
+class SmappeeResourceCache:
+    """Cache of extracted values by (resource, id) with a TTL per resource aligned to bucket boundaries.
+
+    Hourly values expire at the hour rollover and daily values at local midnight, even when their TTL
+    has not passed yet. The capacity is meant to be sized from the number of entities of the service
+    location (see resize) so entries are not evicted before they expire.
+    """
+
+    def __init__(self, name, maxsize=None, timezone=None):
+        """
+        :param name: cache label of the metrics
+        :param maxsize: maximum number of entries, unbounded when None
+        :param timezone: timezone name of the daily and hourly boundaries, UTC when None
+        """
+        self._name = name
+        self._maxsize = maxsize
+        self.timezone = timezone
+        self._lock = threading.Lock()
+
+        # (resource, id) -> (expires, value)
+        self._entries = {}
+
+        # stats
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def resize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict(time.time())
+
+    def _boundary(self, boundary, now):
+        if boundary == BOUNDARY_5_MINUTES:
+            return (now // 300 + 1) * 300
+
+        tz = pytz.timezone(self.timezone) if self.timezone else pytz.UTC
+        local = datetime.fromtimestamp(now, tz)
+        if boundary == BOUNDARY_HOUR:
+            return now - local.minute * 60 - local.second - local.microsecond / 1e6 + 3600
+        # localize the next day to get the midnight of daylight saving time changes right
+        midnight = tz.localize(datetime(local.year, local.month, local.day) + timedelta(days=1))
+        return midnight.timestamp()
+
+    def expires(self, resource, id=None, now=None):
+        """Expiry timestamp of a value stored now."""
+        now = time.time() if now is None else now
+        expires = now + config['CACHE']['ttl'].get(resource, config['CACHE']['default_ttl'])
+        boundary = BOUNDARIES.get((resource, id), BOUNDARIES.get(resource))
+        if boundary is not None:
+            expires = min(expires, self._boundary(boundary, now))
+        return expires
+
+    def _expire(self, key, now):
+        # remove the entry of a key if it expired, returns whether the key is present
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry[0] <= now:
+            del self._entries[key]
+            self._expirations += 1
+            return False
+        return True
+
+    def _evict(self, now):
+        if self._maxsize is None or len(self._entries) <= self._maxsize:
+            return
+        for key in [key for key, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+            self._expirations += 1
+
+        # the entries expiring first are evicted first
+        while len(self._entries) > self._maxsize:
+            del self._entries[min(self._entries, key=lambda key: self._entries[key][0])]
+            self._evictions += 1
+            if metrics.enabled:
+                metrics.inc('smappee_cache_evictions_total', cache=self._name)
+
+    def __contains__(self, key):
+        """Test for a (resource, id) key that did not expire, counted as a hit or miss."""
+        with self._lock:
+            found = self._expire(key, time.time())
+            if found:
+                self._hits += 1
+            else:
+                self._misses += 1
+        if metrics.enabled:
+            metrics.inc('smappee_cache_requests_total', cache=self._name, result='hit' if found else 'miss')
+        return found
+
+    def get(self, resource, id=None, default=None):
+        with self._lock:
+            if not self._expire((resource, id), time.time()):
+                return default
+            return self._entries[(resource, id)][1]
+
+    def set(self, resource, id=None, value=True, now=None):
+        """Store the value extracted from a response, only what is used afterwards should be stored."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._entries[(resource, id)] = (self.expires(resource, id=id, now=now), value)
+            self._evict(now)
+
+    def pop(self, resource, id=None):
+        with self._lock:
+            entry = self._entries.pop((resource, id), None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self._maxsize,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+            }
@@ -17,6 +17,56 @@ config['API_URL'] = {
     },
 }
 
+# cloud api http session
+config['HTTP'] = {
+    'pool_connections': 4,  # connection pools (hosts) per session
+    'pool_maxsize': 32,  # keep-alive connections per host
+    'max_workers': 8,  # concurrent requests per service location
+    'retries': 3,
+    'backoff_factor': 0.5,  # seconds, doubled on every retry and jittered
+    'retry_status': [500, 502, 503, 504],
+    'timeouts': {  # (connect, read) in seconds per endpoint
+        'default': (5, 30),
+        'consumption': (5, 60),
+        'events': (5, 60),
+        'token': (5, 30),
+    },
+    'token_refresh_margin': 60,  # seconds before expires_at an access token is renewed
+}
+
+# historical consumption downloads
+config['HISTORY'] = {
+    'chunk_days': {  # days per request for each aggregation
+        1: 1,
+        2: 14,
+        3: 366,
+    },
+    'default_chunk_days': 3660,
+    'max_age_days': {  # history kept by the cloud for each aggregation
+        1: 14,
+    },
+    'max_workers': 4,
+    'requests_per_second': 5,
+    'checkpoint_interval': 5,  # seconds between checkpoint file writes
+}
+
+# polled values of a service location (pysmappee.cache)
+config['CACHE'] = {
+    'ttl': {  # seconds per resource, capped at the end of the bucket holding the value
+        'trend': 300,  # aggregated trends and the 5 minute trend buckets
+        'appliance': 300,
+        'actuator_consumption': 300,
+        'sensor_consumption': 300,
+    },
+    'default_ttl': 300,
+}
+
+# counters and latency histograms (pysmappee.metrics)
+config['METRICS'] = {
+    'enabled': False,
+    'buckets': (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10),  # seconds
+}
+
 config['MQTT'] = {
     1: {
         'host': 'mqtt.smappee.net',
@@ -31,7 +81,9 @@ config['MQTT'] = {
         'port': 443,
     },
     'local': {  # only accessible from same network
+        'host': 'smappee{serial_number}.local',
         'port': 1883,
+        'ports': {},  # port by serial number for devices not using the default port
     },
     'discovery': False,
 }
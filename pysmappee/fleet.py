@@ -0,0 +1,370 @@
+"""Support for running large numbers of service locations sharded over worker processes."""
+import bisect
+import hashlib
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .api import SmappeeApi
+from .servicelocation import SmappeeServiceLocation
+
+
+class ConsistentHashRing:
+    """Map keys on shards so adding or removing a shard only moves the keys of that shard."""
+
+    def __init__(self, shards=(), replicas=100):
+        self._replicas = replicas
+        self._hashes = []
+        self._shards = {}
+        for shard in shards:
+            self.add(shard)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    @property
+    def shards(self):
+        return sorted(set(self._shards.values()))
+
+    def add(self, shard):
+        for replica in range(self._replicas):
+            h = self._hash(f'{shard}:{replica}')
+            if h not in self._shards:
+                bisect.insort(self._hashes, h)
+                self._shards[h] = shard
+
+    def remove(self, shard):
+        hashes = [h for h, s in self._shards.items() if s == shard]
+        for h in hashes:
+            del self._shards[h]
+        self._hashes = [h for h in self._hashes if h in self._shards]
+
+    def get(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._shards[self._hashes[i]]
+
+
+def service_location_state(service_location):
+    """Flat dict of the values of a service location exposed by the fleet coordinator."""
+    state = {
+        'total_power': service_location.total_power,
+        'total_reactive_power': service_location.total_reactive_power,
+        'solar_power': service_location.solar_power,
+        'alwayson': service_location.alwayson,
+        'phase_voltages': service_location.phase_voltages,
+        'line_voltages': service_location.line_voltages,
+        'is_present': service_location.is_present,
+        'aggregated_values': dict(service_location.aggregated_values or {}),
+    }
+    for actuator_id, actuator in service_location.actuators.items():
+        state[f'actuator/{actuator_id}/state'] = actuator.state
+        state[f'actuator/{actuator_id}/connection_state'] = actuator.connection_state
+    for measurement_id, measurement in service_location.measurements.items():
+        state[f'measurement/{measurement_id}/active'] = measurement.active_total
+        state[f'measurement/{measurement_id}/current'] = measurement.current_total
+    return state
+
+
+def _stop_connections(service_location):
+    for connection in (service_location.mqtt_connection_central, service_location.mqtt_connection_local):
+        if connection is not None:
+            connection.stop()
+
+
+def _run_shard(shard, api_class, api_kwargs, options, commands, deltas, delta_interval, poll_interval,
+               start_workers):
+    # worker process entry point, owns the api, the service locations and their MQTT connections
+    api = api_class(token_updater=lambda token: deltas.put(('token', shard, token)), **api_kwargs)
+
+    # service locations are created lazily and started in a pool, they are only part of the state once started
+    executor = ThreadPoolExecutor(max_workers=start_workers, thread_name_prefix=f'SmappeeFleetShard-{shard}')
+    service_locations, starting, states = {}, {}, {}
+    next_poll = time.monotonic() + poll_interval if poll_interval else None
+
+    def stop(service_location_id):
+        states.pop(service_location_id, None)
+        sl = service_locations.pop(service_location_id, None)
+        if sl is not None:
+            _stop_connections(sl)
+        sl, future = starting.pop(service_location_id, (None, None))
+        if future is not None:
+            # stop a service location removed while starting once its connections are up
+            future.add_done_callback(lambda _: _stop_connections(sl))
+
+    def handle(command):
+        action, service_location_id, data = command
+        if action == 'stop':
+            for sl_id in list(service_locations) + list(starting):
+                stop(sl_id)
+            executor.shutdown(wait=False)
+            return False
+        if action == 'token':
+            if data != api.token:
+                api.token = data
+        elif action == 'add':
+            stop(service_location_id)
+            sl = SmappeeServiceLocation(
+                service_location_id=service_location_id,
+                device_serial_number=data,
+                smappee_api=api,
+                **dict(options, lazy=True)
+            )
+            starting[service_location_id] = (sl, executor.submit(sl.start))
+        elif action == 'remove':
+            stop(service_location_id)
+            deltas.put(('removed', shard, service_location_id))
+        return True
+
+    while True:
+        # handle all pending commands before computing the deltas
+        try:
+            command = commands.get(timeout=delta_interval)
+            while True:
+                if not handle(command):
+                    return
+                command = commands.get_nowait()
+        except queue.Empty:
+            pass
+
+        for service_location_id, (sl, future) in list(starting.items()):
+            if not future.done():
+                continue
+            del starting[service_location_id]
+            error = future.exception()
+            if error is None:
+                service_locations[service_location_id] = sl
+                deltas.put(('added', shard, service_location_id))
+            else:
+                traceback.print_exception(type(error), error, error.__traceback__)
+                _stop_connections(sl)
+                deltas.put(('failed', shard, (service_location_id, repr(error))))
+
+        if next_poll is not None and time.monotonic() >= next_poll:
+            next_poll += poll_interval
+            for sl in list(service_locations.values()):
+                try:
+                    sl.update_trends_and_appliance_states()
+                except Exception:
+                    traceback.print_exc()
+
+        # only changed values are sent to the coordinator
+        changes = {}
+        for service_location_id, sl in service_locations.items():
+            state = service_location_state(sl)
+            previous = states.get(service_location_id, {})
+            delta = {k: v for k, v in state.items() if k not in previous or previous[k] != v}
+            if delta:
+                changes[service_location_id] = delta
+                states[service_location_id] = state
+        if changes:
+            deltas.put(('delta', shard, changes))
+
+
+class SmappeeFleet:
+    """Coordinator running service locations in worker processes sharded by consistent hash.
+
+    Every shard process creates its own SmappeeApi and SmappeeServiceLocation objects, keeps the MQTT
+    connections and polling of its service locations and streams changed values back. The combined
+    view is available through state() in the coordinating process.
+
+    A token refreshed by a shard is sent to all other shards and used by shards started later, so a
+    rotated refresh token does not lock the other shards out.
+    """
+
+    def __init__(self, api_kwargs, shards=4, token_updater=None, delta_interval=1, poll_interval=None,
+                 mp_context='spawn', start_workers=4, api_class=SmappeeApi, **options):
+        """
+        :param api_kwargs: SmappeeApi arguments (client_id, client_secret, token, farm, ...), without token_updater
+        :param shards: number of worker processes
+        :param token_updater: called in the coordinator with tokens refreshed by a shard
+        :param delta_interval: seconds between two state deltas of a shard
+        :param poll_interval: seconds between two update_trends_and_appliance_states calls, None to disable
+        :param mp_context: multiprocessing start method
+        :param start_workers: number of service locations started in parallel by a shard
+        :param api_class: SmappeeApi or a compatible class, instantiated in every shard
+        :param options: passed to every SmappeeServiceLocation (hydrate_actuators, trend_mode, mqtt_features)
+        """
+        self._api_kwargs = api_kwargs
+        self._token = api_kwargs.get('token')
+        self._token_updater = token_updater
+        self._start_workers = start_workers
+        self._api_class = api_class
+        self._delta_interval = delta_interval
+        self._poll_interval = poll_interval
+        self._options = options
+        self._context = multiprocessing.get_context(mp_context)
+
+        self._lock = threading.Lock()
+        self._ring = ConsistentHashRing()
+        self._next_shard = 0
+        self._processes = {}
+        self._commands = {}
+        self._deltas = self._context.Queue()
+
+        # service locations as id -> (device serial number, shard)
+        self._service_locations = {}
+        self._states = {}
+        self._failed_service_locations = {}
+
+        self._receiver = None
+        self._running = False
+        for _ in range(shards):
+            self._add_shard()
+
+    @property
+    def shards(self):
+        return self._ring.shards
+
+    @property
+    def service_locations(self):
+        with self._lock:
+            return {sl_id: shard for sl_id, (_, shard) in self._service_locations.items()}
+
+    @property
+    def failed_service_locations(self):
+        return self._failed_service_locations
+
+    def state(self, service_location_id=None):
+        with self._lock:
+            if service_location_id is not None:
+                return dict(self._states.get(service_location_id, {}))
+            return {sl_id: dict(state) for sl_id, state in self._states.items()}
+
+    def _add_shard(self):
+        shard = self._next_shard
+        self._next_shard += 1
+        self._commands[shard] = self._context.Queue()
+        self._ring.add(shard)
+        if self._running:
+            self._start_shard(shard)
+        return shard
+
+    def _start_shard(self, shard):
+        process = self._context.Process(
+            target=_run_shard,
+            args=(shard, self._api_class, dict(self._api_kwargs, token=self._token), self._options,
+                  self._commands[shard], self._deltas, self._delta_interval, self._poll_interval,
+                  self._start_workers),
+            name=f'SmappeeFleetShard-{shard}',
+            daemon=True,
+        )
+        process.start()
+        self._processes[shard] = process
+
+    def start(self, service_locations=None):
+        """
+        :param service_locations: service location id -> device serial number, all service locations of the
+         account with a known serial number by default
+        """
+        if service_locations is None:
+            api = self._api_class(token_updater=self._on_token, **dict(self._api_kwargs, token=self._token))
+            service_locations = {sl.get('serviceLocationId'): sl.get('deviceSerialNumber')
+                                 for sl in api.get_service_locations()['serviceLocations']
+                                 if 'deviceSerialNumber' in sl}
+
+        self._running = True
+        for shard in self._ring.shards:
+            self._start_shard(shard)
+        self._receiver = threading.Thread(target=self._receive, name='SmappeeFleetReceiver', daemon=True)
+        self._receiver.start()
+
+        for service_location_id, device_serial_number in service_locations.items():
+            self.add_service_location(service_location_id, device_serial_number)
+
+    def stop(self):
+        self._running = False
+        for commands in self._commands.values():
+            commands.put(('stop', None, None))
+        for process in self._processes.values():
+            process.join(timeout=10)
+        self._processes = {}
+        self._deltas.put(None)
+        if self._receiver is not None:
+            self._receiver.join()
+            self._receiver = None
+
+    def _receive(self):
+        while True:
+            message = self._deltas.get()
+            if message is None:
+                return
+            kind, shard, data = message
+
+            with self._lock:
+                if kind == 'delta':
+                    for service_location_id, delta in data.items():
+                        # drop late deltas of a service location that moved to another shard
+                        if self._service_locations.get(service_location_id, (None, None))[1] == shard:
+                            self._states.setdefault(service_location_id, {}).update(delta)
+                elif kind == 'added':
+                    self._failed_service_locations.pop(data, None)
+                elif kind == 'failed':
+                    self._failed_service_locations[data[0]] = data[1]
+                elif kind == 'removed':
+                    # keep the state of a service location that moved to another shard
+                    if self._service_locations.get(data, (None, None))[1] in (None, shard):
+                        self._states.pop(data, None)
+                        self._failed_service_locations.pop(data, None)
+
+            if kind == 'token':
+                self._on_token(data, shard)
+
+    def _on_token(self, token, shard=None):
+        # keep the latest token for new shards and hand it to the running ones
+        with self._lock:
+            self._token = token
+            commands = [shard_commands for s, shard_commands in self._commands.items()
+                        if s != shard and s in self._processes]
+        for shard_commands in commands:
+            shard_commands.put(('token', None, token))
+        if self._token_updater is not None:
+            self._token_updater(token)
+
+    def add_service_location(self, service_location_id, device_serial_number):
+        shard = self._ring.get(service_location_id)
+        with self._lock:
+            self._service_locations[service_location_id] = (device_serial_number, shard)
+        self._commands[shard].put(('add', service_location_id, device_serial_number))
+
+    def remove_service_location(self, service_location_id):
+        with self._lock:
+            _, shard = self._service_locations.pop(service_location_id, (None, None))
+            self._states.pop(service_location_id, None)
+        if shard is not None:
+            self._commands[shard].put(('remove', service_location_id, None))
+
+    def _rebalance(self):
+        # move the service locations of which the shard changed on the ring
+        with self._lock:
+            moves = [(sl_id, serial, shard, self._ring.get(sl_id))
+                     for sl_id, (serial, shard) in self._service_locations.items()
+                     if self._ring.get(sl_id) != shard]
+            for sl_id, serial, _, new_shard in moves:
+                self._service_locations[sl_id] = (serial, new_shard)
+
+        for sl_id, serial, shard, new_shard in moves:
+            if shard in self._commands:
+                self._commands[shard].put(('remove', sl_id, None))
+            self._commands[new_shard].put(('add', sl_id, serial))
+        return len(moves)
+
+    def add_shard(self):
+        """Start an additional shard, returns the number of moved service locations."""
+        self._add_shard()
+        return self._rebalance()
+
+    def remove_shard(self, shard):
+        """Stop a shard, returns the number of moved service locations."""
+        self._ring.remove(shard)
+        moved = self._rebalance()
+        commands = self._commands.pop(shard)
+        commands.put(('stop', None, None))
+        process = self._processes.pop(shard, None)
+        if process is not None:
+            process.join(timeout=10)
+        return moved
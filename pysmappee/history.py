@@ -0,0 +1,192 @@
+"""Support for downloading historical Smappee consumption data."""
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .config import config
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class RateLimiter:
+    """Spread calls evenly over time, shared between threads."""
+
+    def __init__(self, rate):
+        self._interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SmappeeHistoryDownloader:
+    """Download long consumption ranges in chunks, concurrently and resumable.
+
+    A resumed download continues after the last finished chunk without repeating the records yielded
+    for it, records of a chunk that was not finished are yielded again.
+    """
+
+    def __init__(self, smappee_api, max_workers=None, requests_per_second=None, checkpoint_path=None):
+        """
+        :param smappee_api: SmappeeApi instance
+        :param max_workers: number of chunks downloaded at the same time
+        :param requests_per_second: rate limit shared by all workers
+        :param checkpoint_path: json file to keep track of finished chunks, used to resume downloads
+        """
+        self._smappee_api = smappee_api
+        self._max_workers = max_workers or config['HISTORY']['max_workers']
+        self._rate_limiter = RateLimiter(requests_per_second or config['HISTORY']['requests_per_second'])
+
+        self._checkpoint_path = checkpoint_path
+        self._checkpoints = {}
+        self._checkpoints_lock = threading.Lock()
+        self._checkpoints_dirty = False
+        self._checkpoints_written = time.monotonic()
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                self._checkpoints = json.load(f)
+
+    def consumption(self, service_location_id, start, end, aggregation):
+        def fetch(chunk_start, chunk_end):
+            return self._smappee_api.get_consumption(service_location_id=service_location_id,
+                                                     start=chunk_start,
+                                                     end=chunk_end,
+                                                     aggregation=aggregation)
+
+        return self._download(key=f'{service_location_id}/location',
+                              fetch=fetch,
+                              records_key='consumptions',
+                              start=start,
+                              end=end,
+                              aggregation=aggregation)
+
+    def sensor_consumption(self, service_location_id, sensor_id, start, end, aggregation):
+        def fetch(chunk_start, chunk_end):
+            return self._smappee_api.get_sensor_consumption(service_location_id=service_location_id,
+                                                            sensor_id=sensor_id,
+                                                            start=chunk_start,
+                                                            end=chunk_end,
+                                                            aggregation=aggregation)
+
+        return self._download(key=f'{service_location_id}/sensor/{sensor_id}',
+                              fetch=fetch,
+                              records_key='records',
+                              start=start,
+                              end=end,
+                              aggregation=aggregation)
+
+    def switch_consumption(self, service_location_id, switch_id, start, end, aggregation):
+        def fetch(chunk_start, chunk_end):
+            return self._smappee_api.get_switch_consumption(service_location_id=service_location_id,
+                                                            switch_id=switch_id,
+                                                            start=chunk_start,
+                                                            end=chunk_end,
+                                                            aggregation=aggregation)
+
+        return self._download(key=f'{service_location_id}/switch/{switch_id}',
+                              fetch=fetch,
+                              records_key='records',
+                              start=start,
+                              end=end,
+                              aggregation=aggregation)
+
+    @staticmethod
+    def chunks(start, end, aggregation):
+        """Split a range in milliseconds in server friendly (start, end) chunks."""
+        chunk_days = config['HISTORY']['chunk_days'].get(aggregation, config['HISTORY']['default_chunk_days'])
+        chunk_ms = chunk_days * DAY_MS
+
+        chunks = []
+        while start < end:
+            chunks.append((start, min(start + chunk_ms, end)))
+            start += chunk_ms
+        return chunks
+
+    def _download(self, key, fetch, records_key, start, end, aggregation):
+        start = self._smappee_api._to_milliseconds(start)
+        end = self._smappee_api._to_milliseconds(end)
+        checkpoint_key = f'{key}/{aggregation}/{start}-{end}'
+
+        # the cloud only keeps a limited history for the finest aggregations
+        max_age_days = config['HISTORY']['max_age_days'].get(aggregation)
+        if max_age_days is not None:
+            start = max(start, int(time.time() * 1e3) - max_age_days * DAY_MS)
+
+        # resume after the last finished chunk (chunk ends are inclusive), the bucket overlapping the
+        # start of the next chunk is skipped by the last yielded timestamp
+        last_timestamp = None
+        checkpoint = self._checkpoints.get(checkpoint_key)
+        if checkpoint is not None:
+            start = max(start, checkpoint['end'] + 1)
+            last_timestamp = checkpoint['last_timestamp']
+
+        return self._iter_records(checkpoint_key=checkpoint_key,
+                                  fetch=fetch,
+                                  records_key=records_key,
+                                  chunks=self.chunks(start, end, aggregation),
+                                  last_timestamp=last_timestamp)
+
+    def _fetch_chunk(self, fetch, records_key, chunk):
+        self._rate_limiter.wait()
+        result = fetch(*chunk)
+        return sorted(result.get(records_key) or [], key=lambda record: record.get('timestamp'))
+
+    def _iter_records(self, checkpoint_key, fetch, records_key, chunks, last_timestamp=None):
+        executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='SmappeeHistoryDownloader')
+        pending, chunks = deque(), deque(chunks)
+        try:
+            while chunks or pending:
+                # keep a bounded number of chunks in flight, yield them in order
+                while chunks and len(pending) < 2 * self._max_workers:
+                    chunk = chunks.popleft()
+                    pending.append((chunk, executor.submit(self._fetch_chunk, fetch, records_key, chunk)))
+
+                chunk, future = pending.popleft()
+                records = future.result()
+
+                for record in records:
+                    # chunk boundaries are inclusive, skip records already yielded
+                    if last_timestamp is not None and record.get('timestamp') <= last_timestamp:
+                        continue
+                    last_timestamp = record.get('timestamp')
+                    yield record
+
+                self._save_checkpoint(checkpoint_key, chunk[1], last_timestamp)
+        finally:
+            # an error, an early break or close() should not wait for the chunks still queued
+            for _, f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
+            self._write_checkpoints()
+
+    def _save_checkpoint(self, checkpoint_key, end, last_timestamp):
+        with self._checkpoints_lock:
+            self._checkpoints[checkpoint_key] = {'end': end, 'last_timestamp': last_timestamp}
+            self._checkpoints_dirty = True
+
+        if time.monotonic() - self._checkpoints_written >= config['HISTORY']['checkpoint_interval']:
+            self._write_checkpoints()
+
+    def _write_checkpoints(self):
+        with self._checkpoints_lock:
+            if self._checkpoint_path is None or not self._checkpoints_dirty:
+                return
+
+            tmp_path = f'{self._checkpoint_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._checkpoints, f)
+            os.replace(tmp_path, self._checkpoint_path)
+            self._checkpoints_written = time.monotonic()
+            self._checkpoints_dirty = False
@@ -0,0 +1,117 @@
+"""Support for change notifications of Smappee values."""
+import numbers
+import threading
+import time
+import traceback
+
+_UNSET = object()
+
+
+class SmappeeListener:
+    """Callback fired when a value changes, with optional deadband and minimum interval."""
+
+    def __init__(self, callback, min_interval=0, deadband=0):
+        """
+        :param callback: called with the new value
+        :param min_interval: minimum seconds between two calls, changes in between are coalesced
+        :param deadband: minimum change of numeric values (or any element of a list of numbers)
+        """
+        self._callback = callback
+        self._min_interval = min_interval
+        self._deadband = deadband
+
+        self._lock = threading.Lock()
+        self._value = _UNSET
+        self._last_fired = 0
+        self._pending = _UNSET
+        self._timer = None
+
+    def _changed(self, old, new):
+        if old is _UNSET:
+            return True
+        if isinstance(old, numbers.Number) and isinstance(new, numbers.Number) \
+                and not isinstance(old, bool) and not isinstance(new, bool):
+            return abs(new - old) > self._deadband if self._deadband else new != old
+        if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+            return any(self._changed(o, n) for o, n in zip(old, new))
+        return new != old
+
+    def notify(self, value):
+        with self._lock:
+            if not self._changed(self._value, value):
+                self._pending = _UNSET
+                return
+
+            if self._min_interval:
+                wait = self._last_fired + self._min_interval - time.monotonic()
+                if wait > 0:
+                    # coalesce, the last value is fired when the interval has passed
+                    self._pending = value
+                    if self._timer is None:
+                        self._timer = threading.Timer(wait, self._fire_pending)
+                        self._timer.daemon = True
+                        self._timer.start()
+                    return
+
+            self._value = value
+            self._last_fired = time.monotonic()
+
+        self._fire(value)
+
+    def _fire_pending(self):
+        with self._lock:
+            self._timer = None
+            value, self._pending = self._pending, _UNSET
+            if value is _UNSET or not self._changed(self._value, value):
+                return
+            self._value = value
+            self._last_fired = time.monotonic()
+
+        self._fire(value)
+
+    def _fire(self, value):
+        try:
+            self._callback(value)
+        except Exception:
+            traceback.print_exc()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = _UNSET
+
+
+class SmappeeListeners:
+    """Listeners by key, e.g. ('realtime', 'total_power') or ('actuator', 1, 'state')."""
+
+    def __init__(self):
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self._listeners)
+
+    def add(self, key, callback, min_interval=0, deadband=0):
+        listener = SmappeeListener(callback=callback, min_interval=min_interval, deadband=deadband)
+        with self._lock:
+            self._listeners = {**self._listeners, key: self._listeners.get(key, ()) + (listener,)}
+
+        def remove():
+            listener.cancel()
+            with self._lock:
+                listeners = {k: v for k, v in self._listeners.items() if k != key}
+                remaining = tuple(l for l in self._listeners.get(key, ()) if l is not listener)
+                if remaining:
+                    listeners[key] = remaining
+                self._listeners = listeners
+        return remove
+
+    def keys(self):
+        return list(self._listeners)
+
+    def notify(self, key, value):
+        # the listeners dict is replaced on changes, no lock needed to iterate
+        for listener in self._listeners.get(key, ()):
+            listener.notify(value)
@@ -1,4 +1,5 @@
 """Support for all kinds of Smappee measurements."""
+from .ringbuffer import SmappeeRingBuffer
 
 
 class SmappeeMeasurement:
@@ -17,6 +18,9 @@ class SmappeeMeasurement:
         self._reactive_total = None
         self._current_total = None
 
+        # optional history of the totals
+        self._history = None
+
         for c in self.channels:
             c['active'] = None
             c['reactive'] = None
@@ -74,3 +78,47 @@ class SmappeeMeasurement:
             if index in channel:
                 channel['current'] = current[channel.get(index)]
         self._current_total = sum([c.get('current') for c in self.channels if index in c])
+
+    def _set_total(self, field, total, timestamp=None):
+        if field == 'active':
+            self._active_total = total
+        elif field == 'reactive':
+            self._reactive_total = total
+        elif field == 'current':
+            self._current_total = total
+
+        if self._history is not None:
+            self._history[field].append(total, timestamp=timestamp)
+
+    def enable_history(self, depth):
+        self._history = {field: SmappeeRingBuffer(depth=depth) for field in ['active', 'reactive', 'current']}
+
+    def disable_history(self):
+        self._history = None
+
+    def history(self, field='active'):
+        """Ring buffer of the active, reactive or current total (None if history is disabled)."""
+        if self._history is None:
+            return None
+        return self._history.get(field)
+
+
+class SmappeeChannelIndex:
+    """Precomputed map of incoming value indices to the channels of all measurements."""
+
+    def __init__(self, measurements, source='CENTRAL'):
+        index = 'powerTopicIndex' if source == 'CENTRAL' else 'consumptionIndex'
+        self._slots = [
+            (measurement, tuple((channel, channel.get(index)) for channel in measurement.channels if index in channel))
+            for measurement in measurements
+        ]
+
+    def update(self, field, values, timestamp=None):
+        # update the channel values and totals of all measurements in one pass
+        for measurement, slots in self._slots:
+            total = 0
+            for channel, index in slots:
+                value = values[index]
+                channel[field] = value
+                total += value
+            measurement._set_total(field, total, timestamp=timestamp)
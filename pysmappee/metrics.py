@@ -0,0 +1,127 @@
+"""Support for counters and latency histograms of API calls and MQTT processing."""
+import bisect
+import threading
+from cachetools import TTLCache
+from .config import config
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SmappeeMetrics:
+    """Registry of labelled counters and histograms, disabled by default.
+
+    Instrumented code checks `enabled` before measuring anything, so a disabled registry costs one
+    attribute lookup per call.
+    """
+
+    def __init__(self, enabled=False, buckets=None):
+        self.enabled = enabled
+        self._buckets = tuple(buckets if buckets is not None else config['METRICS']['buckets'])
+        self._lock = threading.Lock()
+
+        # values by name and sorted label items
+        self._counters = {}
+        self._histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                # counts per bucket (the last one is +Inf), sum and count
+                histogram = histograms[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self._buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _label_string(key):
+        return ','.join(f'{k}={v}' for k, v in key)
+
+    def _copy(self):
+        with self._lock:
+            counters = {name: dict(values) for name, values in self._counters.items()}
+            histograms = {name: {key: (list(counts), total, count) for key, (counts, total, count) in values.items()}
+                          for name, values in self._histograms.items()}
+        return counters, histograms
+
+    def _cumulative(self, counts):
+        cumulative, buckets = 0, {}
+        for le, c in zip(self._buckets + ('+Inf',), counts):
+            cumulative += c
+            buckets[le] = cumulative
+        return buckets
+
+    def snapshot(self):
+        """Dict of counters and histograms by name and label string (e.g. 'endpoint=consumption,status=200')."""
+        counters, histograms = self._copy()
+        return {
+            'counters': {name: {self._label_string(key): value for key, value in values.items()}
+                         for name, values in counters.items()},
+            'histograms': {name: {self._label_string(key): {'count': count,
+                                                            'sum': total,
+                                                            'buckets': self._cumulative(counts)}
+                                  for key, (counts, total, count) in values.items()}
+                           for name, values in histograms.items()},
+        }
+
+    @staticmethod
+    def _prometheus_labels(key, extra=()):
+        items = [f'{k}="{escape_label_value(v)}"' for k, v in tuple(key) + tuple(extra)]
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        counters, histograms = self._copy()
+
+        lines = []
+        for name, values in sorted(counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for key, value in values.items():
+                lines.append(f'{name}{self._prometheus_labels(key)} {value}')
+        for name, values in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, (counts, total, count) in values.items():
+                for le, cumulative in self._cumulative(counts).items():
+                    lines.append(f'{name}_bucket{self._prometheus_labels(key, [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{self._prometheus_labels(key)} {total}')
+                lines.append(f'{name}_count{self._prometheus_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# registry used by all pysmappee instances
+metrics = SmappeeMetrics(enabled=config['METRICS']['enabled'])
+
+
+class InstrumentedTTLCache(TTLCache):
+    """TTLCache counting hits and misses of membership tests when metrics are enabled."""
+
+    def __init__(self, maxsize, ttl, name, **kwargs):
+        TTLCache.__init__(self, maxsize=maxsize, ttl=ttl, **kwargs)
+        self._name = name
+
+    def __contains__(self, key):
+        found = TTLCache.__contains__(self, key)
+        if metrics.enabled:
+            metrics.inc('smappee_cache_requests_total', cache=self._name, result='hit' if found else 'miss')
+        return found
@@ -4,85 +4,253 @@ import threading
 import socket
 import time
 import traceback
-import schedule
 import uuid
-from functools import wraps
 import paho.mqtt.client as mqtt
 from .config import config
+from .metrics import metrics
+from .scheduler import get_scheduler
 
 
 TRACKING_INTERVAL = 60 * 5
 HEARTBEAT_INTERVAL = 60 * 1
+TRACKING_RESTORE_DELAY = 2
 
+# topics of a local broker (relative to servicelocation/<uuid>) per feature
+LOCAL_FEATURE_TOPICS = {
+    'realtime': ['/realtime'],
+    'config': ['/config', '/channelConfigV2', '/homeControlConfig', '/sensorConfig'],
+    'actuators': ['/plug/+/state', '/plug/+/connectionState', '/plug/+/setstate'],
+    'presence': ['/presence'],
+}
 
-def tracking(func):
-    # Decorator to reactivate trackers
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        self = args[0]
-        if self._kind == 'central':
-            if time.time() - self._last_tracking > TRACKING_INTERVAL:
-                self._publish_tracking()
-            if time.time() - self._last_heartbeat > HEARTBEAT_INTERVAL:
-                self._publish_heartbeat()
-        return func(*args, **kwargs)
-    return wrapper
+
+def local_topics(prefix, features=None):
+    """Topics to subscribe to on a local broker for the enabled features (all by default)."""
+    features = LOCAL_FEATURE_TOPICS.keys() if features is None else features
+    topics = []
+    for feature in features:
+        if feature not in LOCAL_FEATURE_TOPICS:
+            raise ValueError(f'Unknown MQTT feature {feature}')
+        topics += [f'{prefix}{topic}' for topic in LOCAL_FEATURE_TOPICS[feature]]
+    return topics
+
+
+def local_host(serial_number):
+    """Host name of the broker of a local Smappee device."""
+    return config['MQTT']['local']['host'].format(serial_number=serial_number)
+
+
+def local_port(serial_number):
+    """Port of the broker of a local Smappee device."""
+    return config['MQTT']['local']['ports'].get(serial_number, config['MQTT']['local']['port'])
+
+
+# config topic of any service location, subscribed until the config of the device is received
+LOCAL_DISCOVERY_TOPIC = 'servicelocation/+/config'
+
+
+def topic_label(topic):
+    """Topic below servicelocation/<uuid> with numeric levels (e.g. plug ids) replaced by +."""
+    levels = topic.split('/')[2:] if topic.startswith('servicelocation/') else topic.split('/')
+    return '/' + '/'.join('+' if level.isdigit() else level for level in levels)
+
+
+def record_message_metrics(kind, message, start, failed):
+    topic = topic_label(message.topic)
+    metrics.observe('smappee_mqtt_handle_seconds', time.perf_counter() - start, kind=kind, topic=topic)
+    metrics.inc('smappee_mqtt_messages_total', kind=kind, topic=topic)
+    metrics.inc('smappee_mqtt_message_bytes_total', len(message.payload), kind=kind, topic=topic)
+    if failed:
+        metrics.inc('smappee_mqtt_errors_total', kind=kind, topic=topic)
+
+
+class TopicDispatcher:
+    """Lookup table of MQTT topic handlers."""
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = []
+        self._wildcards = []
+
+    def register(self, topic, handler, match='exact'):
+        self.unregister(topic, match=match)
+        if match == 'exact':
+            self._exact[topic] = handler
+        elif match == 'prefix':
+            # longest prefix first
+            self._prefixes.append((topic, handler))
+            self._prefixes.sort(key=lambda p: len(p[0]), reverse=True)
+        elif match == 'wildcard':
+            self._wildcards.append((topic, handler))
+        else:
+            raise ValueError(f'Unknown topic match type {match}')
+
+    def unregister(self, topic, match='exact'):
+        if match == 'exact':
+            self._exact.pop(topic, None)
+        elif match == 'prefix':
+            self._prefixes = [p for p in self._prefixes if p[0] != topic]
+        elif match == 'wildcard':
+            self._wildcards = [w for w in self._wildcards if w[0] != topic]
+
+    def resolve(self, topic):
+        handler = self._exact.get(topic)
+        if handler is not None:
+            return handler
+
+        for prefix, handler in self._prefixes:
+            if topic.startswith(prefix):
+                return handler
+
+        for pattern, handler in self._wildcards:
+            if mqtt.topic_matches_sub(pattern, topic):
+                return handler
+
+        return None
+
+
+class TopicSubscriptions:
+    """Subscribed topics of a connection, extendable at runtime."""
+
+    def __init__(self):
+        self._topics = []
+        self._client = None
+
+    @property
+    def topics(self):
+        return list(self._topics)
+
+    def connect(self, client, topics):
+        # (re)subscribe to the given topics and the ones added at runtime
+        self._client = client
+        for topic in topics:
+            if topic not in self._topics:
+                self._topics.append(topic)
+        if self._topics:
+            client.subscribe([(topic, 0) for topic in self._topics])
+
+    def add(self, topic):
+        if topic in self._topics:
+            return
+        self._topics.append(topic)
+        if self._client is not None:
+            self._client.subscribe(topic)
+
+    def remove(self, topic):
+        if topic not in self._topics:
+            return
+        self._topics.remove(topic)
+        if self._client is not None:
+            self._client.unsubscribe(topic)
 
 
 class SmappeeMqtt(threading.Thread):
     """Smappee MQTT wrapper."""
 
-    def __init__(self, service_location, kind, farm):
+    def __init__(self, service_location, kind, farm, features=None, scheduler=None, pool=None, work_queue=None):
+        """
+        :param features: subscribed features of a local broker (realtime, config, actuators, presence), all by default
+        :param scheduler: SmappeeScheduler renewing tracking and heartbeats, a shared one by default
+        :param pool: SmappeeMqttPool to share broker connections with other service locations
+        :param work_queue: SmappeeWorkQueue handling messages off the network thread, inline by default
+        """
         self._client = None
         self._service_location = service_location
         self._kind = kind
         self._farm = farm
+        self._features = features
+        self._subscriptions = TopicSubscriptions()
         self._client_id = f"pysmappee-{self._service_location.service_location_uuid}-{self._kind}-{uuid.uuid4()}"
         self._last_tracking = 0
         self._last_heartbeat = 0
+
+        # tracking and heartbeat jobs, registered on connect (network thread) and by the tracking job
+        # (scheduler thread)
+        self._scheduler = scheduler
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._jobs_cancelled = False
+
+        # shared broker connection
+        self._pool = pool
+        self._work_queue = work_queue
         threading.Thread.__init__(
             self,
             name=f'SmappeeMqttListener_{self._service_location.service_location_uuid}'
         )
 
+        # incoming messages are matched against the prefix of the subscription
+        self._topic_prefix = self.topic_prefix
+        self._dispatcher = TopicDispatcher()
+        self._register_handlers()
+
     @property
     def topic_prefix(self):
         return f'servicelocation/{self._service_location.service_location_uuid}'
 
-    @tracking
     def _on_connect(self, client, userdata, flags, rc):
+        if metrics.enabled:
+            metrics.inc('smappee_mqtt_connection_events_total', kind=self._kind, event='connect')
+        self._topic_prefix = self.topic_prefix
         if self._kind == 'local':
-            self._client.subscribe(topic='#')
+            self._subscriptions.connect(self._client, local_topics(self._topic_prefix, self._features))
         else:
-            self._client.subscribe(topic=f'{self.topic_prefix}/#')
+            self._subscriptions.connect(self._client, [f'{self._topic_prefix}/#'])
             self._schedule_tracking_and_heartbeat()
 
+    @property
+    def topics(self):
+        return self._subscriptions.topics
+
+    def add_topic(self, topic):
+        """Subscribe to an extra (absolute) topic, also after reconnecting."""
+        self._subscriptions.add(topic)
+
+    def remove_topic(self, topic):
+        self._subscriptions.remove(topic)
+
     def _schedule_tracking_and_heartbeat(self):
-        schedule.every(60).seconds.do(lambda: self._publish_tracking())
-        schedule.every(60).seconds.do(lambda: self._publish_heartbeat())
+        # (re)start tracking and heartbeats right away, replacing the jobs of a previous connection
+        self._cancel_jobs()
+
+        if self._scheduler is None:
+            self._scheduler = get_scheduler()
+        with self._jobs_lock:
+            self._jobs_cancelled = False
+            self._jobs = {
+                'tracking': self._scheduler.call_every(TRACKING_INTERVAL, self._publish_tracking),
+                'heartbeat': self._scheduler.call_every(HEARTBEAT_INTERVAL, self._publish_heartbeat),
+            }
+
+    def _cancel_jobs(self):
+        with self._jobs_lock:
+            jobs, self._jobs = self._jobs, {}
+            self._jobs_cancelled = True
+        for job in jobs.values():
+            job.cancel()
 
     def _publish_tracking(self):
-        # turn OFF current tracking and restore
-        self._client.publish(
-            topic=f"{self.topic_prefix}/tracking",
-            payload=json.dumps({
-                "value": "OFF",
-                "clientId": self._client_id,
-                "serialNumber": self._service_location.device_serial_number,
-                "type": "RT_VALUES",
-            })
-        )
-        time.sleep(2)
+        # turn OFF current tracking and restore after a short delay
+        self._publish_tracking_value('OFF')
+        with self._jobs_lock:
+            # a tracking run that started before the jobs were cancelled does not schedule the restore
+            if self._jobs_cancelled:
+                return
+            self._jobs['tracking_restore'] = self._scheduler.call_later(TRACKING_RESTORE_DELAY,
+                                                                        lambda: self._publish_tracking_value('ON'))
+
+    def _publish_tracking_value(self, value):
         self._client.publish(
             topic=f"{self.topic_prefix}/tracking",
             payload=json.dumps({
-                "value": "ON",
+                "value": value,
                 "clientId": self._client_id,
                 "serialNumber": self._service_location.device_serial_number,
                 "type": "RT_VALUES",
             })
         )
-        self._last_tracking = time.time()
+        if value == 'ON':
+            self._last_tracking = time.time()
 
     def _publish_heartbeat(self):
         self._client.publish(
@@ -94,154 +262,199 @@ class SmappeeMqtt(threading.Thread):
         self._last_heartbeat = time.time()
 
     def _on_disconnect(self, client, userdata, rc):
-        pass
+        if metrics.enabled:
+            metrics.inc('smappee_mqtt_connection_events_total', kind=self._kind, event='disconnect')
 
-    @tracking
-    def _on_message(self, client, userdata, message):
-        try:
-            #print('{0} - Processing {1} MQTT message from topic {2} with value {3}'.format(self._service_location.service_location_id, self._kind, message.topic, message.payload))
-            # realtime central power values
-            if message.topic == f'{self.topic_prefix}/power':
-                power_data = json.loads(message.payload)
-                self._service_location._update_power_data(power_data=power_data)
-            # realtime local power values
-            elif message.topic == f'{self.topic_prefix}/realtime':
-                realtime_data = json.loads(message.payload)
-                self._service_location._update_realtime_data(realtime_data=realtime_data)
-            # powerquality
-            elif message.topic == f'{self.topic_prefix}/powerquality':
-                pass
+    def _register_handlers(self):
+        # topics below the service location prefix, matched exactly, by prefix or as MQTT wildcard
+        d = self._dispatcher
 
-            # tracking and heartbeat
-            elif message.topic == f'{self.topic_prefix}/tracking':
-                pass
-            elif message.topic == f'{self.topic_prefix}/homeassistant/heartbeat':
-                pass
+        # realtime central and local power values
+        d.register('/power', self._handle_power)
+        d.register('/realtime', self._handle_realtime)
 
-            # config topics
-            elif message.topic == f'{self.topic_prefix}/config':
-                config_details = json.loads(message.payload)
-                self._service_location.firmware_version = config_details.get('firmwareVersion')
-                self._service_location._service_location_uuid = config_details.get('serviceLocationUuid')
-                self._service_location._service_location_id = config_details.get('serviceLocationId')
-            elif message.topic == f'{self.topic_prefix}/sensorConfig':
-                pass
-            elif message.topic == f'{self.topic_prefix}/homeControlConfig':
-                pass
+        # config and presence topics
+        d.register('/config', self._handle_config)
+        d.register('/presence', self._handle_presence)
 
-            # aggregated consumption values
-            elif message.topic == f'{self.topic_prefix}/aggregated':
-                pass
+        # controllable nodes (general messages)
+        d.register('', self._handle_controllable_node)
 
-            # presence topic
-            elif message.topic == f'{self.topic_prefix}/presence':
-                presence = json.loads(message.payload)
-                self._service_location.is_present = presence.get('value')
+        # actuator topics
+        d.register('/plug/', self._handle_plug, match='prefix')
 
-            # trigger topic
-            elif message.topic == f'{self.topic_prefix}/trigger':
-                pass
-            elif message.topic == f'{self.topic_prefix}/trigger/appliance':
-                pass
-            elif message.topic == f'{self.topic_prefix}/triggerpush':
-                pass
-            elif message.topic == f'{self.topic_prefix}/triggervalue':
-                pass
+        # known topics without a handler
+        for topic in ['/powerquality', '/tracking', '/homeassistant/heartbeat', '/sensorConfig',
+                      '/homeControlConfig', '/aggregated', '/trigger', '/trigger/appliance', '/triggerpush',
+                      '/triggervalue', '/h1vector', '/nilm', '/homeassistant/event',
+                      '/homeassistant/trigger/etc', '/scheduler']:
+            d.register(topic, self._ignore)
+        for topic in ['/etc/', '/outputmodule/']:
+            d.register(topic, self._ignore, match='prefix')
 
-            # harmonic vectors
-            elif message.topic == f'{self.topic_prefix}/h1vector':
-                pass
+    def add_topic_handler(self, topic, handler, match='exact'):
+        """
+        Handle messages of a topic below the service location prefix (e.g. '/aggregated').
 
-            # nilm
-            elif message.topic == f'{self.topic_prefix}/nilm':
-                pass
+        :param topic: topic relative to servicelocation/<uuid>
+        :param handler: called with the MQTT message, replaces the default handling of the topic
+        :param match: 'exact', 'prefix' or 'wildcard' (MQTT + and # wildcards)
+        """
+        self._dispatcher.register(topic, handler, match=match)
 
-            # controllable nodes (general messages)
-            elif message.topic == f'{self.topic_prefix}':
-                msg = json.loads(message.payload)
-
-                # turn ON/OFF comfort plug
-                if msg.get('messageType') == 1283:
-                    id = msg['content']['controllableNodeId']
-                    plug_state = msg['content']['action']
-                    plug_state_since = int(msg['content']['timestamp'] / 1000)
-                    self._service_location.set_actuator_state(id=id,
-                                                              state=plug_state,
-                                                              since=plug_state_since,
-                                                              api=False)
-
-            # smart device and ETC topics
-            elif message.topic.startswith(f'{self.topic_prefix}/etc/'):
-                pass
+    def remove_topic_handler(self, topic, match='exact'):
+        self._dispatcher.unregister(topic, match=match)
 
-            # specific HASS.io topics
-            elif message.topic == f'{self.topic_prefix}/homeassistant/event':
-                pass
-            elif message.topic == f'{self.topic_prefix}/homeassistant/trigger/etc':
-                pass
-            elif message.topic.startswith(f'{self.topic_prefix}/outputmodule/'):
-                pass
-            elif message.topic == f'{self.topic_prefix}/scheduler':
-                pass
+    def _on_message(self, client, userdata, message):
+        if self._work_queue is not None:
+            # decode and apply on a worker thread, keeping the network thread free for keepalives
+            self._work_queue.put(self._handle_message, message)
+        else:
+            self._handle_message(message)
 
-            # actuator topics
-            elif message.topic.startswith(f'{self.topic_prefix}/plug/'):
-                plug_id = int(message.topic.split('/')[-2])
-                payload = json.loads(message.payload)
-                plug_state, plug_state_since = payload.get('value'), payload.get('since')
-
-                state_type = message.topic.split('/')[-1]
-                if state_type == 'state' and self._kind == 'central':  # todo: remove and condition
-                    self._service_location.set_actuator_state(id=plug_id,
-                                                              state=plug_state,
-                                                              since=plug_state_since,
-                                                              api=False)
-                elif state_type == 'connectionState':
-                    self._service_location.set_actuator_connection_state(id=plug_id,
-                                                                         connection_state=plug_state,
-                                                                         since=plug_state_since)
+    def _handle_message(self, message):
+        # decode and apply time of the handler when metrics are enabled
+        start, failed = time.perf_counter() if metrics.enabled else None, False
+        try:
+            handler = None
+            if message.topic.startswith(self._topic_prefix):
+                handler = self._dispatcher.resolve(message.topic[len(self._topic_prefix):])
+
+            if handler is not None:
+                handler(message)
             elif config['MQTT']['discovery']:
                 print(message.topic, message.payload)
         except Exception:
+            failed = True
             traceback.print_exc()
 
-    def start(self):
-        self._client = mqtt.Client(client_id=self._client_id)
-        if self._kind == 'central':
-            self._client.username_pw_set(username=self._service_location.service_location_uuid,
-                                         password=self._service_location.service_location_uuid)
-        self._client.on_connect = lambda client, userdata, flags, rc: self._on_connect(client, userdata, flags, rc)
-        self._client.on_message = lambda client, userdata, message: self._on_message(client, userdata, message)
-        self._client.on_disconnect = lambda client, userdata, rc: self._on_disconnect(client, userdata, rc)
+        if start is not None:
+            record_message_metrics(self._kind, message, start, failed)
 
-        #  self._client.tls_set(None, cert_reqs=ssl.CERT_NONE, tls_version=ssl.PROTOCOL_TLSv1)
+    def _ignore(self, message):
+        pass
+
+    def _handle_power(self, message):
+        power_data = json.loads(message.payload)
+        self._service_location._update_power_data(power_data=power_data)
+
+    def _handle_realtime(self, message):
+        realtime_data = json.loads(message.payload)
+        self._service_location._update_realtime_data(realtime_data=realtime_data)
+
+    def _handle_config(self, message):
+        config_details = json.loads(message.payload)
+        self._service_location.firmware_version = config_details.get('firmwareVersion')
+        self._service_location._service_location_uuid = config_details.get('serviceLocationUuid')
+        self._service_location._service_location_id = config_details.get('serviceLocationId')
+
+        # dispatch on the prefix of the (possibly changed) service location uuid
+        self._topic_prefix = self.topic_prefix
+
+    def _handle_presence(self, message):
+        presence = json.loads(message.payload)
+        self._service_location.is_present = presence.get('value')
+
+    def _handle_controllable_node(self, message):
+        msg = json.loads(message.payload)
+
+        # turn ON/OFF comfort plug
+        if msg.get('messageType') == 1283:
+            id = msg['content']['controllableNodeId']
+            plug_state = msg['content']['action']
+            plug_state_since = int(msg['content']['timestamp'] / 1000)
+            self._service_location.set_actuator_state(id=id,
+                                                      state=plug_state,
+                                                      since=plug_state_since,
+                                                      api=False)
+
+    def _handle_plug(self, message):
+        plug_id = int(message.topic.split('/')[-2])
+        payload = json.loads(message.payload)
+        plug_state, plug_state_since = payload.get('value'), payload.get('since')
+
+        state_type = message.topic.split('/')[-1]
+        if state_type == 'state' and self._kind == 'central':  # todo: remove and condition
+            self._service_location.set_actuator_state(id=plug_id,
+                                                      state=plug_state,
+                                                      since=plug_state_since,
+                                                      api=False)
+        elif state_type == 'connectionState':
+            self._service_location.set_actuator_connection_state(id=plug_id,
+                                                                 connection_state=plug_state,
+                                                                 since=plug_state_since)
+
+    @property
+    def broker(self):
         if self._kind == 'central':
-            self._client.tls_set()
-            self._client.connect(host=config['MQTT'][self._farm]['host'],
-                                 port=config['MQTT'][self._farm]['port'])
-        elif self._kind == 'local':
-            try:
-                self._client.connect(host=f'smappee{self._service_location.device_serial_number}.local',
-                                     port=config['MQTT']['local']['port'])
-            except socket.gaierror as _:
-                # unable to connect to local Smappee device (host unavailable)
-                return
-            except socket.timeout as _:
+            return {
+                'host': config['MQTT'][self._farm]['host'],
+                'port': config['MQTT'][self._farm]['port'],
+                'tls': True,
+                'username': self._service_location.service_location_uuid,
+                'password': self._service_location.service_location_uuid,
+            }
+        return {
+            'host': local_host(self._service_location.device_serial_number),
+            'port': local_port(self._service_location.device_serial_number),
+            'tls': False,
+            'username': None,
+            'password': None,
+        }
+
+    def start(self):
+        broker = self.broker
+        try:
+            if self._pool is not None:
+                # share a connection of the pool, messages are routed by topic prefix
+                self._pool.attach(self)
                 return
 
+            self._client = mqtt.Client(client_id=self._client_id)
+            if broker['username'] is not None:
+                self._client.username_pw_set(username=broker['username'],
+                                             password=broker['password'])
+            self._client.on_connect = lambda client, userdata, flags, rc: self._on_connect(client, userdata, flags, rc)
+            self._client.on_message = lambda client, userdata, message: self._on_message(client, userdata, message)
+            self._client.on_disconnect = lambda client, userdata, rc: self._on_disconnect(client, userdata, rc)
+
+            #  self._client.tls_set(None, cert_reqs=ssl.CERT_NONE, tls_version=ssl.PROTOCOL_TLSv1)
+            if broker['tls']:
+                self._client.tls_set()
+            self._client.connect(host=broker['host'], port=broker['port'])
+        except (socket.gaierror, socket.timeout):
+            if metrics.enabled:
+                metrics.inc('smappee_mqtt_connection_events_total', kind=self._kind, event='connect_failed')
+            if self._kind == 'central':
+                raise
+            # unable to connect to local Smappee device (host unavailable)
+            return
+
         self._client.loop_start()
 
     def stop(self):
-        self._client.loop_stop()
+        self._cancel_jobs()
+        if self._pool is not None:
+            self._pool.detach(self)
+        elif self._client is not None:
+            self._client.loop_stop()
 
 
 class SmappeeLocalMqtt(threading.Thread):
     """Smappee local MQTT wrapper."""
 
-    def __init__(self, serial_number=None):
+    def __init__(self, serial_number=None, features=None, work_queue=None):
+        """
+        :param serial_number:
+        :param features: subscribed features (realtime, config, actuators, presence), all by default
+        :param work_queue: SmappeeWorkQueue handling messages off the network thread, inline by default
+        """
         self._client = None
         self.service_location = None
         self._serial_number = serial_number
+        self._features = features
+        self._work_queue = work_queue
+        self._subscriptions = TopicSubscriptions()
         self._service_location_id = None
         self._service_location_uuid = None
         threading.Thread.__init__(
@@ -265,18 +478,63 @@ class SmappeeLocalMqtt(threading.Thread):
         return f'servicelocation/{self._service_location_uuid}'
 
     def _on_connect(self, client, userdata, flags, rc):
-        self._client.subscribe(topic='#')
+        if metrics.enabled:
+            metrics.inc('smappee_mqtt_connection_events_total', kind='local_standalone', event='connect')
+        # the service location uuid is only known after the config message of the device
+        if self._service_location_uuid is None:
+            self._subscriptions.connect(self._client, [LOCAL_DISCOVERY_TOPIC])
+        else:
+            self._subscriptions.connect(self._client, local_topics(self.topic_prefix, self._features))
+
+    def _discovered(self, c):
+        # subscribe to the topics of the own service location once its uuid is known
+        self._timezone = c.get('timeZone')
+        self._service_location_id = c.get('serviceLocationId')
+        self._service_location_uuid = c.get('serviceLocationUuid')
+        self._serial_number = c.get('serialNumber')
+
+        self._subscriptions.remove(LOCAL_DISCOVERY_TOPIC)
+        for topic in local_topics(self.topic_prefix, self._features):
+            self._subscriptions.add(topic)
+
+    @property
+    def topics(self):
+        return self._subscriptions.topics
+
+    def add_topic(self, topic):
+        """Subscribe to an extra (absolute) topic, also after reconnecting."""
+        self._subscriptions.add(topic)
+
+    def remove_topic(self, topic):
+        self._subscriptions.remove(topic)
 
     def _on_disconnect(self, client, userdata, rc):
-        pass
+        if metrics.enabled:
+            metrics.inc('smappee_mqtt_connection_events_total', kind='local_standalone', event='disconnect')
 
     def _get_client_id(self):
         return f"smappeeLocalMQTT-{self._serial_number}"
 
     def _on_message(self, client, userdata, message):
+        if self._work_queue is not None:
+            # decode and apply on a worker thread, keeping the network thread free for keepalives
+            self._work_queue.put(self._handle_message, message)
+        else:
+            self._handle_message(message)
+
+    def _handle_message(self, message):
+        start, failed = time.perf_counter() if metrics.enabled else None, False
         try:
+            if self._service_location_uuid is None or not message.topic.startswith(f'{self.topic_prefix}/'):
+                # discovery: only the config of the own device (any device without serial number) is used,
+                # messages of other service locations sharing the broker are ignored
+                if message.topic.endswith('/config'):
+                    c = json.loads(message.payload)
+                    if self._service_location_uuid is None and self._serial_number in (None, c.get('serialNumber')):
+                        self._discovered(c)
+
             # realtime local power values
-            if message.topic.endswith('/realtime'):
+            elif message.topic.endswith('/realtime'):
                 self.realtime = json.loads(message.payload)
                 if self.service_location is not None:
                     self.service_location._update_realtime_data(realtime_data=self.realtime)
@@ -285,7 +543,6 @@ class SmappeeLocalMqtt(threading.Thread):
                 c = json.loads(message.payload)
                 self._timezone = c.get('timeZone')
                 self._service_location_id = c.get('serviceLocationId')
-                self._service_location_uuid = c.get('serviceLocationUuid')
                 self._serial_number = c.get('serialNumber')
             elif message.topic.endswith('channelConfig'):
                 pass
@@ -316,23 +573,27 @@ class SmappeeLocalMqtt(threading.Thread):
             elif message.topic.endswith('/sensorConfig'):
                 pass
             elif message.topic.endswith('/homeControlConfig'):
-                # switches
+                # switches (rebuilt, the retained config is received again after reconnecting)
+                switch_sensors = []
                 switches = json.loads(message.payload).get('switchActuators', [])
                 for switch in switches:
                     if switch['serialNumber'].startswith('4006'):
-                        self.switch_sensors.append({
+                        switch_sensors.append({
                             'nodeId': switch['nodeId'],
                             'name': switch['name'],
                             'serialNumber': switch['serialNumber']
                         })
+                self.switch_sensors = switch_sensors
 
                 # plugs
+                smart_plugs = []
                 plugs = json.loads(message.payload).get('smartplugActuators', [])
                 for plug in plugs:
-                    self.smart_plugs.append({
+                    smart_plugs.append({
                         'nodeId': plug['nodeId'],
                         'name': plug['name']
                     })
+                self.smart_plugs = smart_plugs
             elif message.topic.endswith('/presence'):
                 pass
             elif message.topic.endswith('/aggregated'):
@@ -374,8 +635,12 @@ class SmappeeLocalMqtt(threading.Thread):
                 print('Processing MQTT message from topic {0} with value {1}'.format(message.topic, message.payload))
 
         except Exception:
+            failed = True
             traceback.print_exc()
 
+        if start is not None:
+            record_message_metrics('local_standalone', message, start, failed)
+
     def set_actuator_state(self, service_location_id, actuator_id, state_id):
         state = None
         if state_id == 'ON_ON':
@@ -404,7 +669,7 @@ class SmappeeLocalMqtt(threading.Thread):
     def start_attempt(self):
         client = mqtt.Client(client_id='smappeeLocalMqttConnectionAttempt')
         try:
-            client.connect(host=f'smappee{self._serial_number}.local', port=config['MQTT']['local']['port'])
+            client.connect(host=local_host(self._serial_number), port=local_port(self._serial_number))
         except Exception:
             return False
 
@@ -418,7 +683,7 @@ class SmappeeLocalMqtt(threading.Thread):
 
         #  self._client.tls_set(None, cert_reqs=ssl.CERT_NONE, tls_version=ssl.PROTOCOL_TLSv1)
         try:
-            self._client.connect(host=f'smappee{self._serial_number}.local', port=config['MQTT']['local']['port'])
+            self._client.connect(host=local_host(self._serial_number), port=local_port(self._serial_number))
         except socket.gaierror as _:
             # unable to connect to local Smappee device (host unavailable)
             return
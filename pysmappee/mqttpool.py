@@ -0,0 +1,191 @@
+"""Support for sharing MQTT broker connections between service locations."""
+import threading
+import time
+import uuid
+import paho.mqtt.client as mqtt
+
+TOPIC_ROOT = 'servicelocation/'
+
+
+class SmappeeMqttPoolConnection:
+    """One broker connection routing messages to the attached SmappeeMqtt instances."""
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._lock = threading.Lock()
+
+        # attached SmappeeMqtt instances by topic prefix (servicelocation/<uuid>)
+        self._routes = {}
+        self._connected = False
+
+        # load metrics
+        self._created = time.monotonic()
+        self._messages = 0
+        self._bytes = 0
+        self._unrouted = 0
+        self._connects = 0
+        self._disconnects = 0
+
+        self.client = mqtt.Client(client_id=f'pysmappee-pool-{uuid.uuid4()}')
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_disconnect = self._on_disconnect
+
+    def __len__(self):
+        return len(self._routes)
+
+    def start(self):
+        if self._broker['username'] is not None:
+            self.client.username_pw_set(username=self._broker['username'], password=self._broker['password'])
+        if self._broker['tls']:
+            self.client.tls_set()
+        self.client.connect(host=self._broker['host'], port=self._broker['port'])
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def attach(self, mqtt_connection):
+        mqtt_connection._client = self.client
+        with self._lock:
+            self._routes = {**self._routes, mqtt_connection.topic_prefix: mqtt_connection}
+            connected = self._connected
+
+        # subscribe right away when the shared connection is already up
+        if connected:
+            mqtt_connection._on_connect(self.client, None, None, 0)
+
+    def detach(self, mqtt_connection):
+        with self._lock:
+            self._routes = {k: v for k, v in self._routes.items() if v is not mqtt_connection}
+        for topic in mqtt_connection.topics:
+            self.client.unsubscribe(topic)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        with self._lock:
+            self._connected = True
+            self._connects += 1
+            routes = list(self._routes.values())
+
+        for mqtt_connection in routes:
+            mqtt_connection._on_connect(client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected = False
+            self._disconnects += 1
+            routes = list(self._routes.values())
+
+        for mqtt_connection in routes:
+            mqtt_connection._on_disconnect(client, userdata, rc)
+
+    def _on_message(self, client, userdata, message):
+        self._messages += 1
+        self._bytes += len(message.payload)
+
+        # route on the servicelocation/<uuid> part of the topic
+        topic = message.topic
+        end = topic.find('/', len(TOPIC_ROOT))
+        mqtt_connection = self._routes.get(topic if end < 0 else topic[:end])
+        if mqtt_connection is None:
+            self._unrouted += 1
+            return
+        mqtt_connection._on_message(client, userdata, message)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._created
+        return {
+            'host': self._broker['host'],
+            'connected': self._connected,
+            'locations': len(self._routes),
+            'messages': self._messages,
+            'bytes': self._bytes,
+            'unrouted': self._unrouted,
+            'connects': self._connects,
+            'disconnects': self._disconnects,
+            'messages_per_second': self._messages / elapsed if elapsed else 0,
+        }
+
+
+class SmappeeMqttPool:
+    """Share broker connections between service locations with the same broker and credentials.
+
+    Central connections authenticate with the service location uuid and local brokers run on each
+    device, so without credentials every service location still gets a connection of its own. Only
+    credentials valid for all service locations (e.g. a partner account on the central broker) reduce
+    the number of central connections.
+    """
+
+    def __init__(self, max_locations_per_connection=100, credentials=None):
+        """
+        :param max_locations_per_connection: service locations per broker connection
+        :param credentials: (username, password) used instead of the per service location credentials
+        """
+        self._max_locations_per_connection = max_locations_per_connection
+        self._credentials = credentials
+        self._lock = threading.Lock()
+
+        # connections by broker (host, port, tls, username, password)
+        self._connections = {}
+
+    @property
+    def connections(self):
+        with self._lock:
+            return [c for connections in self._connections.values() for c in connections]
+
+    def _broker(self, mqtt_connection):
+        broker = dict(mqtt_connection.broker)
+        if self._credentials is not None and broker['username'] is not None:
+            broker['username'], broker['password'] = self._credentials
+        return broker
+
+    def attach(self, mqtt_connection):
+        broker = self._broker(mqtt_connection)
+        key = (broker['host'], broker['port'], broker['tls'], broker['username'], broker['password'])
+
+        new_connection = False
+        with self._lock:
+            connections = self._connections.setdefault(key, [])
+            connection = next((c for c in connections if len(c) < self._max_locations_per_connection), None)
+            if connection is None:
+                connection = SmappeeMqttPoolConnection(broker=broker)
+                connections.append(connection)
+                new_connection = True
+            connection.attach(mqtt_connection)
+            mqtt_connection._pool_connection = connection
+
+        if new_connection:
+            try:
+                connection.start()
+            except Exception:
+                with self._lock:
+                    connections.remove(connection)
+                raise
+        return connection
+
+    def detach(self, mqtt_connection):
+        connection = getattr(mqtt_connection, '_pool_connection', None)
+        if connection is None:
+            return
+
+        connection.detach(mqtt_connection)
+        mqtt_connection._pool_connection = None
+
+        with self._lock:
+            empty = len(connection) == 0
+            if empty:
+                for connections in self._connections.values():
+                    if connection in connections:
+                        connections.remove(connection)
+        if empty:
+            connection.stop()
+
+    def stats(self):
+        return [connection.stats() for connection in self.connections]
+
+    def stop(self):
+        for connection in self.connections:
+            connection.stop()
+        with self._lock:
+            self._connections = {}
@@ -0,0 +1,196 @@
+"""Support for recording and replaying MQTT traffic without a broker."""
+import os
+import struct
+import threading
+import time
+from .mqtt import SmappeeMqtt
+from .workqueue import SmappeeQueuedMessage
+
+MAGIC = b'SMQR\x01'
+
+# record types, a topic is written once and referenced by id afterwards
+RECORD_TOPIC = 0
+RECORD_MESSAGE = 1
+
+KINDS = ['central', 'local', 'local_standalone']
+
+_RECORD_TYPE = struct.Struct('<B')
+_TOPIC = struct.Struct('<HH')  # topic id, topic length
+_MESSAGE = struct.Struct('<dBHI')  # timestamp, kind, topic id, payload length
+
+
+def connection_kind(connection):
+    """Kind of a SmappeeMqtt (central or local) or SmappeeLocalMqtt (local_standalone) connection."""
+    return getattr(connection, '_kind', 'local_standalone')
+
+
+def _read_records(f, path, topics):
+    """Iterate the (end offset, record) pairs of an open recording, record is None for topic records.
+
+    Stops at an incomplete last record, e.g. of an interrupted recording.
+    """
+    while True:
+        record_type = f.read(_RECORD_TYPE.size)
+        if not record_type:
+            return
+        if record_type[0] == RECORD_TOPIC:
+            header = f.read(_TOPIC.size)
+            if len(header) < _TOPIC.size:
+                return
+            topic_id, length = _TOPIC.unpack(header)
+            topic = f.read(length)
+            if len(topic) < length:
+                return
+            topics[topic_id] = topic.decode()
+            yield f.tell(), None
+        elif record_type[0] == RECORD_MESSAGE:
+            header = f.read(_MESSAGE.size)
+            if len(header) < _MESSAGE.size:
+                return
+            timestamp, kind, topic_id, length = _MESSAGE.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield f.tell(), (timestamp, KINDS[kind], topics[topic_id], payload)
+        else:
+            raise ValueError(f'Unknown record type {record_type[0]} in {path}')
+
+
+def _check_magic(f, path):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'{path} is not a pysmappee MQTT recording')
+
+
+def read_records(path):
+    """Iterate the (timestamp, kind, topic, payload) records of a recording."""
+    with open(path, 'rb') as f:
+        _check_magic(f, path)
+        for _, record in _read_records(f, path, {}):
+            if record is not None:
+                yield record
+
+
+class SmappeeMqttRecorder:
+    """Append the messages received by MQTT connections to a compact binary file.
+
+    Every record holds the receive timestamp, the connection kind, the topic (written once and
+    referenced by id) and the raw payload. Recording to an existing file appends to it, dropping an
+    incomplete last record.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._connections = []
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # continue the topic ids of the existing recording, after its last complete record
+            topics, end = {}, len(MAGIC)
+            self._file = open(path, 'r+b')
+            _check_magic(self._file, path)
+            for end, _ in _read_records(self._file, path, topics):
+                pass
+            self._topics = {topic: topic_id for topic_id, topic in topics.items()}
+            self._file.truncate(end)
+            self._file.seek(end)
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, kind, topic, payload, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            topic_id = self._topics.get(topic)
+            if topic_id is None:
+                topic_id = self._topics[topic] = len(self._topics)
+                encoded = topic.encode()
+                self._file.write(_RECORD_TYPE.pack(RECORD_TOPIC) + _TOPIC.pack(topic_id, len(encoded)) + encoded)
+            self._file.write(_RECORD_TYPE.pack(RECORD_MESSAGE)
+                             + _MESSAGE.pack(timestamp, KINDS.index(kind), topic_id, len(payload)) + payload)
+
+    def attach(self, connection):
+        """Record all messages received by a SmappeeMqtt or SmappeeLocalMqtt connection."""
+        kind = connection_kind(connection)
+        on_message = connection._on_message
+
+        def _on_message(client, userdata, message):
+            self.record(kind, message.topic, message.payload)
+            on_message(client, userdata, message)
+
+        # the paho callbacks and the connection pool look up _on_message on every message
+        connection._on_message = _on_message
+        self._connections.append(connection)
+
+    def detach(self, connection):
+        if connection in self._connections:
+            del connection._on_message
+            self._connections.remove(connection)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        for connection in list(self._connections):
+            self.detach(connection)
+        with self._lock:
+            self._file.close()
+
+
+class SmappeeMqttReplayer:
+    """Feed a recording to MQTT connections through their _on_message callback."""
+
+    def __init__(self, path):
+        self._path = path
+
+    def replay(self, connections, speed=1.0, rewrite_topics=True):
+        """
+        :param connections: connection by kind (central, local, local_standalone), other kinds are skipped
+        :param speed: 1 for real time, N for N times faster, None or 0 for as fast as possible
+        :param rewrite_topics: replace the recorded servicelocation/<uuid> by the topic prefix of the connection
+        :return: dict with the replayed and skipped messages, the duration and messages per second
+        """
+        replayed, skipped = 0, 0
+        first, start = None, time.monotonic()
+
+        for timestamp, kind, topic, payload in read_records(self._path):
+            connection = connections.get(kind)
+            if connection is None:
+                skipped += 1
+                continue
+
+            if speed:
+                first = timestamp if first is None else first
+                delay = start + (timestamp - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            # a standalone local client takes the service location uuid of the recorded config
+            if rewrite_topics and kind != 'local_standalone' and topic.startswith('servicelocation/'):
+                levels = topic.split('/', 2)
+                topic = connection.topic_prefix + ('/' + levels[2] if len(levels) > 2 else '')
+
+            connection._on_message(None, None, SmappeeQueuedMessage(topic=topic, payload=payload, timestamp=timestamp))
+            replayed += 1
+
+        duration = time.monotonic() - start
+        return {
+            'messages': replayed,
+            'skipped': skipped,
+            'duration': duration,
+            'messages_per_second': replayed / duration if duration else 0,
+        }
+
+    def replay_service_location(self, service_location, speed=1.0):
+        """Replay the central and local messages into a service location, without connecting to a broker."""
+        connections = {kind: SmappeeMqtt(service_location=service_location, kind=kind,
+                                         farm=service_location.smappee_api.farm)
+                       for kind in ('central', 'local')}
+        return self.replay(connections, speed=speed)
@@ -0,0 +1,103 @@
+"""Support for bounded realtime history."""
+import math
+import threading
+import time
+from array import array
+
+
+class SmappeeRingBuffer:
+    """Fixed size history of timestamped float32 samples with one or more values each."""
+
+    def __init__(self, depth, width=1):
+        self._depth = depth
+        self._width = width
+        self._timestamps = array('d', bytes(8 * depth))
+        self._values = array('f', bytes(4 * depth * width))
+
+        # number of samples and position of the next write
+        self._size = 0
+        self._head = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def width(self):
+        return self._width
+
+    def __len__(self):
+        return self._size
+
+    def append(self, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        values = (value,) if self._width == 1 else value
+
+        with self._lock:
+            self._timestamps[self._head] = timestamp
+            offset = self._head * self._width
+            for i in range(self._width):
+                v = values[i] if i < len(values) else None
+                self._values[offset + i] = math.nan if v is None else v
+            self._head = (self._head + 1) % self._depth
+            self._size = min(self._size + 1, self._depth)
+
+    def clear(self):
+        with self._lock:
+            self._size, self._head = 0, 0
+
+    def samples(self, seconds=None, now=None):
+        """List of (timestamp, value) from old to new, optionally limited to the last seconds."""
+        with self._lock:
+            first = (self._head - self._size) % self._depth
+            positions = [(first + i) % self._depth for i in range(self._size)]
+            samples = [(self._timestamps[p], self._sample_value(p)) for p in positions]
+
+        if seconds is not None:
+            since = (time.time() if now is None else now) - seconds
+            samples = [s for s in samples if s[0] >= since]
+        return samples
+
+    def _sample_value(self, position):
+        if self._width == 1:
+            return self._values[position]
+        offset = position * self._width
+        return tuple(self._values[offset:offset + self._width])
+
+    def latest(self):
+        samples = self.samples()
+        return samples[-1] if samples else None
+
+    def _columns(self, samples):
+        # values per column without missing (NaN) values
+        if self._width == 1:
+            return [[v for _, v in samples if not math.isnan(v)]]
+        return [[v[i] for _, v in samples if not math.isnan(v[i])] for i in range(self._width)]
+
+    def _aggregate(self, samples, func):
+        result = [func(column) if column else None for column in self._columns(samples)]
+        return result[0] if self._width == 1 else tuple(result)
+
+    def min(self, seconds=None, now=None):
+        return self._aggregate(self.samples(seconds=seconds, now=now), min)
+
+    def max(self, seconds=None, now=None):
+        return self._aggregate(self.samples(seconds=seconds, now=now), max)
+
+    def mean(self, seconds=None, now=None):
+        return self._aggregate(self.samples(seconds=seconds, now=now), lambda c: sum(c) / len(c))
+
+    def downsample(self, interval, seconds=None, now=None, func='mean'):
+        """List of (bucket timestamp, value) aggregated (mean, min, max or last) per interval seconds."""
+        funcs = {
+            'mean': lambda c: sum(c) / len(c),
+            'min': min,
+            'max': max,
+            'last': lambda c: c[-1],
+        }
+
+        buckets = {}
+        for sample in self.samples(seconds=seconds, now=now):
+            buckets.setdefault(sample[0] - sample[0] % interval, []).append(sample)
+        return [(bucket, self._aggregate(samples, funcs[func])) for bucket, samples in buckets.items()]
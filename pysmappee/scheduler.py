@@ -0,0 +1,78 @@
+"""Support for running delayed and periodic jobs off the MQTT network threads."""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class SmappeeJob:
+    """Handle of a scheduled job."""
+
+    def __init__(self, func, interval=None):
+        self.func = func
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SmappeeScheduler(threading.Thread):
+    """Single timer thread running delayed and periodic jobs."""
+
+    def __init__(self, name='SmappeeScheduler'):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self._jobs = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._running = True
+
+    def call_later(self, delay, func):
+        return self._schedule(SmappeeJob(func), delay)
+
+    def call_every(self, interval, func, delay=0):
+        return self._schedule(SmappeeJob(func, interval=interval), delay)
+
+    def _schedule(self, job, delay):
+        with self._condition:
+            heapq.heappush(self._jobs, (time.monotonic() + delay, next(self._counter), job))
+            self._condition.notify()
+        return job
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._jobs or self._jobs[0][0] > time.monotonic()):
+                    self._condition.wait(timeout=self._jobs[0][0] - time.monotonic() if self._jobs else None)
+                if not self._running:
+                    return
+                due, _, job = heapq.heappop(self._jobs)
+                if job.cancelled:
+                    continue
+                if job.interval is not None:
+                    heapq.heappush(self._jobs, (due + job.interval, next(self._counter), job))
+
+            try:
+                job.func()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the scheduler shared by all MQTT connections, started on first use."""
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = SmappeeScheduler()
+            _shared_scheduler.start()
+        return _shared_scheduler
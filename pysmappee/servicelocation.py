@@ -1,16 +1,42 @@
+import asyncio
+import copy
+import functools
+import threading
+import time
+import pytz
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from .mqtt import SmappeeMqtt
 from .actuator import SmappeeActuator
 from .appliance import SmappeeAppliance
+from .config import config
+from .listeners import SmappeeListeners
 from .helper import is_smappee_solar, is_smappee_genius, is_smappee_connect, is_smappee_plus
-from .measurement import SmappeeMeasurement
+from .measurement import SmappeeMeasurement, SmappeeChannelIndex
+from .cache import SmappeeResourceCache
+from .ringbuffer import SmappeeRingBuffer
 from .sensor import SmappeeSensor
-from cachetools import TTLCache
+
+TRENDS = ['today', 'current_hour', 'last_5_minutes']
+
+# parts of a service location loaded on demand in lazy mode
+LAZY_PARTS = ('configuration', 'mqtt', 'trends')
+
+# one request per trend with the matching aggregation
+TREND_MODE_AGGREGATED = 'aggregated'
+# derive all trends from one request with 5 minute values since local midnight
+TREND_MODE_DERIVED = 'derived'
+# like derived, but only fetch the newest 5 minute values after the first request of the day
+TREND_MODE_INCREMENTAL = 'incremental'
+
+FIVE_MINUTES_MS = 5 * 60 * 1000
 
 
 class SmappeeServiceLocation(object):
 
-    def __init__(self, device_serial_number, smappee_api, service_location_id=None, local_polling=False):
+    def __init__(self, device_serial_number, smappee_api, service_location_id=None, local_polling=False, load=True,
+                 hydrate_actuators=True, trend_mode=TREND_MODE_AGGREGATED, mqtt_features=None,
+                 mqtt_pool=None, mqtt_work_queue=None, lazy=False):
         # service location details
         self._service_location_id = service_location_id
         self._device_serial_number = device_serial_number
@@ -24,9 +50,18 @@ class SmappeeServiceLocation(object):
         self.smappee_api = smappee_api
         self._local_polling = local_polling
 
-        # mqtt connections
+        # fetch actuator (connection) states through the api when loading the configuration,
+        # disable when the retained MQTT plug state messages are sufficient
+        self._hydrate_actuators = hydrate_actuators
+
+        # mqtt connections, with the subscribed features of the local broker and an optional
+        # SmappeeMqttPool sharing broker connections between service locations and an optional
+        # SmappeeWorkQueue handling incoming messages off the network thread
         self.mqtt_connection_central = None
         self.mqtt_connection_local = None
+        self._mqtt_features = mqtt_features
+        self._mqtt_pool = mqtt_pool
+        self._mqtt_work_queue = mqtt_work_queue
 
         # coordinates
         self._latitude = None
@@ -42,6 +77,12 @@ class SmappeeServiceLocation(object):
         self._sensors = {}
         self._measurements = {}
 
+        # channel index per source (CENTRAL or LOCAL), rebuilt when the measurements change
+        self._channel_indices = {}
+
+        # last applied metering configuration, to apply only the differences of a reload and for snapshots
+        self._metering_configuration = None
+
         # realtime values
         self._realtime_values = {
             'total_power': None,
@@ -56,6 +97,13 @@ class SmappeeServiceLocation(object):
             'line_voltages_h5': None,
         }
 
+        # change listeners of realtime values, measurement totals and actuator states
+        self._listeners = SmappeeListeners()
+
+        # optional ring buffers of the realtime values (by field) with their depth
+        self._history = None
+        self._history_depth = None
+
         # extracted consumption values
         self._aggregated_values = {
             'power_today': None,
@@ -69,13 +117,105 @@ class SmappeeServiceLocation(object):
             'alwasyon_last_5_minutes': None
         }
 
-        self._cache = TTLCache(maxsize=100, ttl=300)
+        # 5 minute consumption values of today by timestamp (derived and incremental trend modes)
+        self._trend_mode = trend_mode
+        self._trend_day = None
+        self._trend_buckets = {}
 
-        self.load_configuration()
+        # polled values by resource and id, sized from the number of entities once the configuration is loaded
+        self._cache = SmappeeResourceCache(name='service_location', maxsize=self._cache_capacity())
 
-        self.update_trends_and_appliance_states()
+        # lazy mode: the configuration and trends are loaded through start() or on first access of a
+        # property that depends on them, the MQTT connections are only started by start(), realtime
+        # properties (total_power, is_present, ...) are None until then
+        self._lazy = lazy
+        self._lazy_pending = set(LAZY_PARTS) if lazy else set()
+        self._lazy_loading = set()
+        self._lazy_lock = threading.RLock()
+        self._lazy_on_access = True
+        self._async_lazy_lock = None
 
-    def load_configuration(self, refresh=False):
+        if load and not lazy:
+            self.load_configuration()
+
+            self.update_trends_and_appliance_states()
+
+    @classmethod
+    async def async_create(cls, device_serial_number, smappee_api, service_location_id=None, **options):
+        # Create a service location using an AsyncSmappeeApi instance
+        sl = cls(device_serial_number=device_serial_number,
+                 smappee_api=smappee_api,
+                 service_location_id=service_location_id,
+                 load=False,
+                 **options)
+
+        if sl._lazy:
+            # loading on first access is blocking, lazy async service locations are loaded by async_start()
+            sl._lazy_on_access = False
+            return sl
+
+        await sl.async_load_configuration()
+
+        await sl.async_update_trends_and_appliance_states()
+
+        return sl
+
+    def _ensure_loaded(self, part):
+        if part not in self._lazy_pending or not self._lazy_on_access:
+            return
+
+        with self._lazy_lock:
+            # the loaders access the same properties, skip the part being loaded by this thread
+            if part not in self._lazy_pending or part in self._lazy_loading:
+                return
+            self._lazy_loading.add(part)
+            try:
+                if part == 'configuration':
+                    self.load_configuration()
+                elif part == 'mqtt':
+                    self._ensure_loaded('configuration')
+                    if not self.local_polling:
+                        self._load_mqtt_connections()
+                elif part == 'trends':
+                    self._ensure_loaded('configuration')
+                    self.update_trends_and_appliance_states()
+                self._lazy_pending.discard(part)
+            finally:
+                self._lazy_loading.discard(part)
+
+    def start(self, configuration=True, mqtt=True, trends=True):
+        """
+        Load the parts of a lazy service location. The configuration and trends are also loaded on first
+        access when not started, MQTT only connects through start() and realtime values are None until then.
+
+        :param configuration: load the metering configuration (and actuator states)
+        :param mqtt: start the MQTT connections
+        :param trends: update the trends and appliance states
+        """
+        for part, enabled in (('configuration', configuration), ('mqtt', mqtt), ('trends', trends)):
+            if enabled:
+                self._ensure_loaded(part)
+
+    async def async_start(self, configuration=True, mqtt=True, trends=True):
+        # start() for service locations using an AsyncSmappeeApi instance
+        if self._async_lazy_lock is None:
+            self._async_lazy_lock = asyncio.Lock()
+
+        async with self._async_lazy_lock:
+            if (configuration or mqtt or trends) and 'configuration' in self._lazy_pending:
+                await self.async_load_configuration()
+                self._lazy_pending.discard('configuration')
+
+            if mqtt and 'mqtt' in self._lazy_pending:
+                if not self.local_polling:
+                    await asyncio.get_running_loop().run_in_executor(None, self._load_mqtt_connections)
+                self._lazy_pending.discard('mqtt')
+
+            if trends and 'trends' in self._lazy_pending:
+                await self.async_update_trends_and_appliance_states()
+                self._lazy_pending.discard('trends')
+
+    def _load_device_capabilities(self):
         # Set solar production on 11-series (no measurements config available on non 50-series)
         if is_smappee_solar(serialnumber=self._device_serial_number):
             self.has_solar_production = True
@@ -84,6 +224,9 @@ class SmappeeServiceLocation(object):
         if is_smappee_genius(serialnumber=self._device_serial_number) or is_smappee_connect(serialnumber=self._device_serial_number):
             self.has_voltage_values = True
 
+    def load_configuration(self, refresh=False):
+        self._load_device_capabilities()
+
         if self.local_polling:
             self._service_location_name = f'Smappee {self.device_serial_number} local'
             self._service_location_uuid = 0
@@ -174,62 +317,152 @@ class SmappeeServiceLocation(object):
         else:
             # Collect metering configuration
             sl_metering_configuration = self.smappee_api.get_metering_configuration(service_location_id=self.service_location_id)
+            actuator_ids = self._load_metering_configuration(sl_metering_configuration)
+
+            # Get actuator states of the added and changed actuators
+            self._load_actuator_states(ids=actuator_ids)
+
+            # Setup MQTT connection (started separately in lazy mode)
+            if not refresh and not self._lazy:
+                self._load_mqtt_connections()
+
+    async def async_load_configuration(self, refresh=False):
+        if self.local_polling:
+            # The local API is blocking, run the regular loader in an executor
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.load_configuration, refresh=refresh)
+            )
+            return
+
+        self._load_device_capabilities()
+
+        # Collect metering configuration
+        sl_metering_configuration = await self.smappee_api.get_metering_configuration(service_location_id=self.service_location_id)
+        actuator_ids = self._load_metering_configuration(sl_metering_configuration)
+
+        # Get actuator states of the added and changed actuators
+        await self._async_load_actuator_states(ids=actuator_ids)
+
+        # Setup MQTT connection (connecting to the broker is blocking, started separately in lazy mode)
+        if not refresh and not self._lazy:
+            await asyncio.get_running_loop().run_in_executor(None, self._load_mqtt_connections)
+
+    @staticmethod
+    def _changed_entities(previous, current):
+        # entities of a metering configuration list that were added or changed and the ids that were removed
+        previous = {entity.get('id'): entity for entity in previous or []}
+        current = {entity.get('id'): entity for entity in current or []}
+        return ([entity for id, entity in current.items() if previous.get(id) != entity],
+                [id for id in previous if id not in current])
+
+    def _load_metering_configuration(self, sl_metering_configuration):
+        # returns the ids of the added and changed actuators, of which the states need to be loaded
+        previous = self._metering_configuration or {}
+        self._metering_configuration = copy.deepcopy(sl_metering_configuration)
+
+        # Service location details
+        self._service_location_name = sl_metering_configuration.get('name')
+        self._service_location_uuid = sl_metering_configuration.get('serviceLocationUuid')
+
+        # Set coordinates and timezone
+        self.latitude = sl_metering_configuration.get('lat')
+        self.longitude = sl_metering_configuration.get('lon')
+        self.timezone = sl_metering_configuration.get('timezone')
+
+        # Load appliances (unchanged entities keep their object and state)
+        appliances, removed = self._changed_entities(previous.get('appliances'), sl_metering_configuration.get('appliances'))
+        for id in removed:
+            self._appliances.pop(id, None)
+        for appliance in appliances:
+            if appliance.get('type') != 'Find me' and appliance.get('sourceType') == 'NILM':
+                self._add_appliance(id=appliance.get('id'),
+                                    name=appliance.get('name'),
+                                    type=appliance.get('type'),
+                                    source_type=appliance.get('sourceType'))
+            else:
+                # a changed appliance that no longer qualifies is dropped, as on a fresh load
+                self._appliances.pop(appliance.get('id'), None)
+
+        # Load actuators (Smappee Switches, Comfort Plugs, IO modules)
+        actuators, removed = self._changed_entities(previous.get('actuators'), sl_metering_configuration.get('actuators'))
+        for id in removed:
+            self._actuators.pop(id, None)
+        for actuator in actuators:
+            self._add_actuator(id=actuator.get('id'),
+                               name=actuator.get('name'),
+                               serialnumber=actuator.get('serialNumber') if 'serialNumber' in actuator else None,
+                               state_values=actuator.get('states'),
+                               connection_state=actuator.get('connectionState'),
+                               actuator_type=actuator.get('type'))
+
+        # Load sensors (Smappee Gas and Water)
+        sensors, removed = self._changed_entities(previous.get('sensors'), sl_metering_configuration.get('sensors'))
+        for id in removed:
+            self._sensors.pop(id, None)
+        for sensor in sensors:
+            self._add_sensor(id=sensor.get('id'),
+                             name=sensor.get('name'),
+                             channels=sensor.get('channels'))
+
+        # Set phase type
+        self.phase_type = sl_metering_configuration.get('phaseType') if 'phaseType' in sl_metering_configuration else None
+
+        # Load channel configuration
+        if 'measurements' in sl_metering_configuration:
+            measurements, removed = self._changed_entities(previous.get('measurements'),
+                                                           sl_metering_configuration.get('measurements'))
+            for id in removed:
+                self._measurements.pop(id, None)
+                self._channel_indices = {}
+            for measurement in measurements:
+                self._add_measurement(id=measurement.get('id'),
+                                      name=measurement.get('name'),
+                                      type=measurement.get('type'),
+                                      subcircuitType=measurement.get('subcircuitType') if 'subcircuitType' in measurement else None,
+                                      channels=measurement.get('channels'))
+
+                if measurement.get('type') == 'PRODUCTION':
+                    self.has_solar_production = True
+
+        self._cache.resize(self._cache_capacity())
+        return [actuator.get('id') for actuator in actuators]
+
+    def _cache_capacity(self):
+        # one entry per trend (or the trend buckets) and per polled appliance, actuator and sensor
+        return len(TRENDS) + 1 + len(self._appliances) + len(self._actuators) + len(self._sensors)
+
+    def snapshot(self):
+        """
+        Get the loaded configuration as a JSON serializable dict, None for local polling or when the
+        configuration is not loaded yet.
+        """
+        if self.local_polling or self._metering_configuration is None:
+            return None
+        return {
+            'serviceLocationId': self._service_location_id,
+            'deviceSerialNumber': self._device_serial_number,
+            'meteringConfiguration': copy.deepcopy(self._metering_configuration),
+        }
+
+    def load_snapshot(self, snapshot):
+        """
+        Rebuild the configuration from a snapshot without any API call and start the MQTT connections
+        (unless lazy), reload the configuration with load_configuration(refresh=True) to revalidate it.
+        """
+        self._lazy_pending.discard('configuration')
+        self._load_device_capabilities()
+        self._load_metering_configuration(snapshot['meteringConfiguration'])
+
+        if not self._lazy:
+            self._load_mqtt_connections()
+
+    def _load_mqtt_connections(self):
+        self.mqtt_connection_central = self.load_mqtt_connection(kind='central')
 
-            # Service location details
-            self._service_location_name = sl_metering_configuration.get('name')
-            self._service_location_uuid = sl_metering_configuration.get('serviceLocationUuid')
-
-            # Set coordinates and timezone
-            self.latitude = sl_metering_configuration.get('lat')
-            self.longitude = sl_metering_configuration.get('lon')
-            self.timezone = sl_metering_configuration.get('timezone')
-
-            # Load appliances
-            for appliance in sl_metering_configuration.get('appliances'):
-                if appliance.get('type') != 'Find me' and appliance.get('sourceType') == 'NILM':
-                    self._add_appliance(id=appliance.get('id'),
-                                        name=appliance.get('name'),
-                                        type=appliance.get('type'),
-                                        source_type=appliance.get('sourceType'))
-
-            # Load actuators (Smappee Switches, Comfort Plugs, IO modules)
-            for actuator in sl_metering_configuration.get('actuators'):
-                self._add_actuator(id=actuator.get('id'),
-                                   name=actuator.get('name'),
-                                   serialnumber=actuator.get('serialNumber') if 'serialNumber' in actuator else None,
-                                   state_values=actuator.get('states'),
-                                   connection_state=actuator.get('connectionState'),
-                                   actuator_type=actuator.get('type'))
-
-            # Load sensors (Smappee Gas and Water)
-            for sensor in sl_metering_configuration.get('sensors'):
-                self._add_sensor(id=sensor.get('id'),
-                                 name=sensor.get('name'),
-                                 channels=sensor.get('channels'))
-
-            # Set phase type
-            self.phase_type = sl_metering_configuration.get('phaseType') if 'phaseType' in sl_metering_configuration else None
-
-            # Load channel configuration
-            if 'measurements' in sl_metering_configuration:
-                for measurement in sl_metering_configuration.get('measurements'):
-                    self._add_measurement(id=measurement.get('id'),
-                                          name=measurement.get('name'),
-                                          type=measurement.get('type'),
-                                          subcircuitType=measurement.get('subcircuitType') if 'subcircuitType' in measurement else None,
-                                          channels=measurement.get('channels'))
-
-                    if measurement.get('type') == 'PRODUCTION':
-                        self.has_solar_production = True
-
-            # Setup MQTT connection
-            if not refresh:
-                self.mqtt_connection_central = self.load_mqtt_connection(kind='central')
-
-                # Only use a local MQTT broker for 20# or 50# series monitors
-                if is_smappee_plus(serialnumber=self._device_serial_number) or is_smappee_genius(serialnumber=self._device_serial_number):
-                    self.mqtt_connection_local = self.load_mqtt_connection(kind='local')
-                    self.has_reactive_value = True  # reactive only available through local MQTT
+        # Only use a local MQTT broker for 20# or 50# series monitors
+        if is_smappee_plus(serialnumber=self._device_serial_number) or is_smappee_genius(serialnumber=self._device_serial_number):
+            self.mqtt_connection_local = self.load_mqtt_connection(kind='local')
+            self.has_reactive_value = True  # reactive only available through local MQTT
 
     @property
     def service_location_id(self):
@@ -237,10 +470,12 @@ class SmappeeServiceLocation(object):
 
     @property
     def service_location_uuid(self):
+        self._ensure_loaded('configuration')
         return self._service_location_uuid
 
     @property
     def service_location_name(self):
+        self._ensure_loaded('configuration')
         return self._service_location_name
 
     @service_location_name.setter
@@ -275,6 +510,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def phase_type(self):
+        self._ensure_loaded('configuration')
         return self._phase_type
 
     @phase_type.setter
@@ -283,6 +519,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def has_solar_production(self):
+        self._ensure_loaded('configuration')
         return self._has_solar_production
 
     @has_solar_production.setter
@@ -291,6 +528,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def has_voltage_values(self):
+        self._ensure_loaded('configuration')
         return self._has_voltage_values
 
     @has_voltage_values.setter
@@ -299,6 +537,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def has_reactive_value(self):
+        self._ensure_loaded('configuration')
         return self._has_reactive_value
 
     @has_reactive_value.setter
@@ -311,6 +550,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def latitude(self):
+        self._ensure_loaded('configuration')
         return self._latitude
 
     @latitude.setter
@@ -319,6 +559,7 @@ class SmappeeServiceLocation(object):
 
     @property
     def longitude(self):
+        self._ensure_loaded('configuration')
         return self._longitude
 
     @longitude.setter
@@ -327,11 +568,13 @@ class SmappeeServiceLocation(object):
 
     @property
     def timezone(self):
+        self._ensure_loaded('configuration')
         return self._timezone
 
     @timezone.setter
     def timezone(self, timezone):
         self._timezone = timezone
+        self._cache.timezone = timezone
 
     @property
     def firmware_version(self):
@@ -351,16 +594,17 @@ class SmappeeServiceLocation(object):
 
     @property
     def appliances(self):
+        self._ensure_loaded('configuration')
         return self._appliances
 
     def _add_appliance(self, id, name, type, source_type):
-        self.appliances[id] = SmappeeAppliance(id=id,
+        self._appliances[id] = SmappeeAppliance(id=id,
                                                name=name,
                                                type=type,
                                                source_type=source_type)
 
     def update_appliance_state(self, id, delta=1440):
-        if f"appliance_{id}" in self._cache:
+        if ('appliance', id) in self._cache:
             return
 
         end = datetime.utcnow()
@@ -370,70 +614,134 @@ class SmappeeServiceLocation(object):
                                              appliance_id=id,
                                              start=start,
                                              end=end)
-        self._cache[f"appliance_{id}"] = events
+        self._apply_appliance_events(id=id, events=events)
+
+    async def async_update_appliance_state(self, id, delta=1440):
+        if ('appliance', id) in self._cache:
+            return
+
+        end = datetime.utcnow()
+        start = end - timedelta(minutes=delta)
+
+        events = await self.smappee_api.get_events(service_location_id=self.service_location_id,
+                                                   appliance_id=id,
+                                                   start=start,
+                                                   end=end)
+        self._apply_appliance_events(id=id, events=events)
+
+    def _apply_appliance_events(self, id, events):
+        self._cache.set('appliance', id, events[0] if events else None)
         if events:
             power = abs(events[0].get('activePower'))
-            self.appliances[id].power = power
+            self._appliances[id].power = power
             if 'state' in events[0]:
                 # program appliance
-                self.appliances[id].state = events[0].get('state') > 0
+                self._appliances[id].state = events[0].get('state') > 0
             else:
                 # delta appliance
-                self.appliances[id].state = events[0].get('activePower') > 0
+                self._appliances[id].state = events[0].get('activePower') > 0
 
     @property
     def actuators(self):
+        self._ensure_loaded('configuration')
         return self._actuators
 
     def _add_actuator(self, id, name, serialnumber, state_values, connection_state, actuator_type):
-        self.actuators[id] = SmappeeActuator(id=id,
+        self._actuators[id] = SmappeeActuator(id=id,
                                              name=name,
                                              serialnumber=serialnumber,
                                              state_values=state_values,
                                              connection_state=connection_state,
                                              type=actuator_type)
 
-        if not self.local_polling:
-            # Get actuator state
-            state = self.smappee_api.get_actuator_state(service_location_id=self.service_location_id,
-                                                        actuator_id=id)
-            self.actuators.get(id).state = state
+    def _load_actuator_states(self, ids=None):
+        ids = list(self._actuators) if ids is None else [id for id in ids if id in self._actuators]
+        if not self._hydrate_actuators or not ids:
+            return
+
+        max_workers = min(config['HTTP']['max_workers'], 2 * len(ids))
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix=f'SmappeeActuatorStates_{self.service_location_id}') as executor:
+            # Get actuator state and connection state (COMFORT_PLUG is always UNREACHABLE)
+            states = {id: executor.submit(self.smappee_api.get_actuator_state,
+                                          service_location_id=self.service_location_id,
+                                          actuator_id=id) for id in ids}
+            connection_states = {id: executor.submit(self.smappee_api.get_actuator_connection_state,
+                                                     service_location_id=self.service_location_id,
+                                                     actuator_id=id) for id in ids}
+            results = {id: (states[id].result(), connection_states[id].result()) for id in ids}
+
+        for id, (state, connection_state) in results.items():
+            self._apply_actuator_states(id=id, state=state, connection_state=connection_state)
+
+    async def _async_load_actuator_states(self, ids=None):
+        ids = list(self._actuators) if ids is None else [id for id in ids if id in self._actuators]
+        if not self._hydrate_actuators or not ids:
+            return
+
+        results = await asyncio.gather(*[
+            asyncio.gather(
+                self.smappee_api.get_actuator_state(service_location_id=self.service_location_id,
+                                                    actuator_id=id),
+                self.smappee_api.get_actuator_connection_state(service_location_id=self.service_location_id,
+                                                               actuator_id=id)
+            ) for id in ids
+        ])
+
+        for id, (state, connection_state) in zip(ids, results):
+            self._apply_actuator_states(id=id, state=state, connection_state=connection_state)
 
-            # Get actuator connection state (COMFORT_PLUG is always UNREACHABLE)
-            connection_state = self.smappee_api.get_actuator_connection_state(service_location_id=self.service_location_id,
-                                                                              actuator_id=id)
-            connection_state = connection_state.replace('"', '')
-            self.actuators.get(id).connection_state = connection_state
+    def _apply_actuator_states(self, id, state, connection_state):
+        self._actuators.get(id).state = state
+        self._actuators.get(id).connection_state = connection_state.replace('"', '')
 
     def set_actuator_state(self, id, state, since=None, api=True):
-        if id in self.actuators:
+        if id in self._actuators:
             if api:
                 self.smappee_api.set_actuator_state(service_location_id=self.service_location_id,
                                                     actuator_id=id,
                                                     state_id=state)
-            self.actuators.get(id).state = state
+            self._actuators.get(id).state = state
+
+            if self._listeners:
+                self._listeners.notify(('actuator', id, 'state'), self._actuators.get(id).state)
 
     def set_actuator_connection_state(self, id, connection_state, since=None):
-        if id in self.actuators:
-            self.actuators.get(id).connection_state = connection_state
+        if id in self._actuators:
+            self._actuators.get(id).connection_state = connection_state
+
+            if self._listeners:
+                self._listeners.notify(('actuator', id, 'connection_state'), connection_state)
 
     @property
     def sensors(self):
+        self._ensure_loaded('configuration')
         return self._sensors
 
     def _add_sensor(self, id, name, channels):
-        self.sensors[id] = SmappeeSensor(id, name, channels)
+        self._sensors[id] = SmappeeSensor(id, name, channels)
 
     @property
     def measurements(self):
+        self._ensure_loaded('configuration')
         return self._measurements
 
     def _add_measurement(self, id, name, type, subcircuitType, channels):
-        self.measurements[id] = SmappeeMeasurement(id=id,
+        self._measurements[id] = SmappeeMeasurement(id=id,
                                                    name=name,
                                                    type=type,
                                                    subcircuit_type=subcircuitType,
                                                    channels=channels)
+        if self._history is not None:
+            self._measurements[id].enable_history(depth=self._history_depth)
+        self._channel_indices = {}
+
+    def _channel_index(self, source='CENTRAL'):
+        channel_index = self._channel_indices.get(source)
+        if channel_index is None:
+            channel_index = SmappeeChannelIndex(measurements=list(self._measurements.values()), source=source)
+            self._channel_indices[source] = channel_index
+        return channel_index
 
     @property
     def total_power(self):
@@ -515,94 +823,281 @@ class SmappeeServiceLocation(object):
     def line_voltages_h5(self, values):
         self._realtime_values['line_voltages_h5'] = values
 
+    def add_listener(self, field, callback, min_interval=0, deadband=0):
+        """
+        Call callback(value) when a realtime value (e.g. total_power or phase_voltages) changes.
+
+        :param min_interval: minimum seconds between two calls, changes in between are coalesced
+        :param deadband: minimum change of a numeric value
+        :return: function to remove the listener
+        """
+        return self._listeners.add(('realtime', field), callback, min_interval=min_interval, deadband=deadband)
+
+    def add_measurement_listener(self, id, callback, field='active', min_interval=0, deadband=0):
+        """Call callback(value) when the active, reactive or current total of a measurement changes."""
+        return self._listeners.add(('measurement', id, field), callback, min_interval=min_interval, deadband=deadband)
+
+    def add_actuator_listener(self, id, callback, field='state', min_interval=0):
+        """Call callback(value) when the state or connection_state of an actuator changes."""
+        return self._listeners.add(('actuator', id, field), callback, min_interval=min_interval)
+
+    def _notify_listeners(self, fields, measurement_fields):
+        for key in self._listeners.keys():
+            if key[0] == 'realtime' and key[1] in fields:
+                self._listeners.notify(key, self._realtime_values.get(key[1]))
+            elif key[0] == 'measurement' and key[2] in measurement_fields and key[1] in self._measurements:
+                measurement = self._measurements.get(key[1])
+                total = {
+                    'active': measurement.active_total,
+                    'reactive': measurement.reactive_total,
+                    'current': measurement.current_total,
+                }.get(key[2])
+                self._listeners.notify(key, total)
+
+    def enable_history(self, depth=3600):
+        """Keep the last depth samples of every realtime value and measurement total."""
+        self._history = {}
+        self._history_depth = depth
+        for measurement in self._measurements.values():
+            measurement.enable_history(depth=depth)
+
+    def disable_history(self):
+        self._history = None
+        self._history_depth = None
+        for measurement in self._measurements.values():
+            measurement.disable_history()
+
+    def history(self, field):
+        """Ring buffer of a realtime value (e.g. total_power), None if not (yet) available."""
+        if self._history is None:
+            return None
+        return self._history.get(field)
+
+    def _record_history(self, fields, timestamp):
+        for field in fields:
+            value = self._realtime_values.get(field)
+            if value is None:
+                continue
+
+            width = len(value) if isinstance(value, list) else 1
+            buffer = self._history.get(field)
+            if buffer is None or buffer.width != width:
+                buffer = SmappeeRingBuffer(depth=self._history_depth, width=width)
+                self._history[field] = buffer
+            buffer.append(value, timestamp=timestamp)
+
     def load_mqtt_connection(self, kind):
         mqtt_connection = SmappeeMqtt(service_location=self,
                                       kind=kind,
-                                      farm=self.smappee_api.farm)
+                                      farm=self.smappee_api.farm,
+                                      features=self._mqtt_features,
+                                      pool=self._mqtt_pool,
+                                      work_queue=self._mqtt_work_queue)
         mqtt_connection.start()
         return mqtt_connection
 
     def _update_power_data(self, power_data):
         # use incoming power data (through central MQTT connection)
+        timestamp = time.time()
+        fields = ['total_power', 'solar_power', 'alwayson']
         self.total_power = power_data.get('consumptionPower')
         self.solar_power = power_data.get('solarPower')
         self.alwayson = power_data.get('alwaysOn')
 
         if 'phaseVoltageData' in power_data:
+            fields += ['phase_voltages', 'phase_voltages_h3', 'phase_voltages_h5']
             self.phase_voltages = [pv / 10 for pv in power_data.get('phaseVoltageData')]
             self.phase_voltages_h3 = power_data.get('phaseVoltageH3Data')
             self.phase_voltages_h5 = power_data.get('phaseVoltageH5Data')
 
         if 'lineVoltageData' in power_data:
+            fields += ['line_voltages', 'line_voltages_h3', 'line_voltages_h5']
             self.line_voltages = [lv / 10 for lv in power_data.get('lineVoltageData')]
             self.line_voltages_h3 = power_data.get('lineVoltageH3Data')
             self.line_voltages_h5 = power_data.get('lineVoltageH5Data')
 
+        if self._history is not None:
+            self._record_history(fields=fields, timestamp=timestamp)
+
+        channel_index = self._channel_index(source='CENTRAL')
         if 'activePowerData' in power_data:
-            active_power_data = power_data.get('activePowerData')
-            for _, measurement in self.measurements.items():
-                measurement.update_active(active=active_power_data)
+            channel_index.update('active', power_data.get('activePowerData'), timestamp=timestamp)
 
         if 'reactivePowerData' in power_data:
-            reactive_power_data = power_data.get('reactivePowerData')
-            for _, measurement in self.measurements.items():
-                measurement.update_reactive(reactive=reactive_power_data)
+            channel_index.update('reactive', power_data.get('reactivePowerData'), timestamp=timestamp)
 
         if 'currentData' in power_data:
-            current_data = power_data.get('currentData')
-            for _, measurement in self.measurements.items():
-                measurement.update_current(current=current_data)
+            channel_index.update('current', power_data.get('currentData'), timestamp=timestamp)
+
+        if self._listeners:
+            measurement_fields = [f for f, k in [('active', 'activePowerData'),
+                                                 ('reactive', 'reactivePowerData'),
+                                                 ('current', 'currentData')] if k in power_data]
+            self._notify_listeners(fields=fields, measurement_fields=measurement_fields)
 
     def _update_realtime_data(self, realtime_data):
         # Use incoming realtime data (through local MQTT connection)
+        timestamp = time.time()
         self.total_power = realtime_data.get('totalPower')
         self.total_reactive_power = realtime_data.get('totalReactivePower')
         self.phase_voltages = [v.get('voltage', 0) for v in realtime_data.get('voltages')]
 
+        if self._history is not None:
+            self._record_history(fields=['total_power', 'total_reactive_power', 'phase_voltages'], timestamp=timestamp)
+
         active_power_data, current_data = {}, {}
         for channel_power in realtime_data.get('channelPowers'):
             active_power_data[channel_power.get('publishIndex')] = channel_power.get('power')
             current_data[channel_power.get('publishIndex')] = channel_power.get('current') / 10
 
         # update channel data
-        for _, measurement in self.measurements.items():
-            measurement.update_active(active=active_power_data, source='LOCAL')
-            measurement.update_current(current=current_data, source='LOCAL')
+        channel_index = self._channel_index(source='LOCAL')
+        channel_index.update('active', active_power_data, timestamp=timestamp)
+        channel_index.update('current', current_data, timestamp=timestamp)
+
+        if self._listeners:
+            self._notify_listeners(fields=['total_power', 'total_reactive_power', 'phase_voltages'],
+                                   measurement_fields=['active', 'current'])
 
     @property
     def aggregated_values(self):
+        self._ensure_loaded('trends')
         return self._aggregated_values
 
+    @property
+    def trend_mode(self):
+        return self._trend_mode
+
+    def update_trend_consumptions(self):
+        if self._trend_mode == TREND_MODE_AGGREGATED:
+            for trend in TRENDS:
+                self.update_active_consumptions(trend=trend)
+            return
+
+        if ('trend', 'buckets') in self._cache:
+            return
+
+        start, end, day = self._trend_buckets_window()
+        consumption_result = self.smappee_api.get_consumption(service_location_id=self.service_location_id,
+                                                              start=start,
+                                                              end=end,
+                                                              aggregation=1)
+        self._apply_trend_buckets(day=day, end=end, consumption_result=consumption_result)
+
+    async def async_update_trend_consumptions(self):
+        if self._trend_mode == TREND_MODE_AGGREGATED:
+            await asyncio.gather(*[self.async_update_active_consumptions(trend=trend) for trend in TRENDS])
+            return
+
+        if ('trend', 'buckets') in self._cache:
+            return
+
+        start, end, day = self._trend_buckets_window()
+        consumption_result = await self.smappee_api.get_consumption(service_location_id=self.service_location_id,
+                                                                    start=start,
+                                                                    end=end,
+                                                                    aggregation=1)
+        self._apply_trend_buckets(day=day, end=end, consumption_result=consumption_result)
+
+    def _trend_buckets_window(self):
+        tz = pytz.timezone(self._timezone) if self._timezone else pytz.UTC
+        end = datetime.now(tz)
+        day = tz.localize(datetime(end.year, end.month, end.day))
+
+        if self._trend_mode == TREND_MODE_INCREMENTAL and self._trend_buckets and self._trend_day == day:
+            # refetch the newest (possibly incomplete) bucket onwards
+            start = max(self._trend_buckets)
+        else:
+            start = day
+        return start, end, day
+
+    def _apply_trend_buckets(self, day, end, consumption_result):
+        self._cache.set('trend', 'buckets')
+
+        if self._trend_mode != TREND_MODE_INCREMENTAL or self._trend_day != day:
+            self._trend_buckets = {}
+        self._trend_day = day
+
+        for block in consumption_result.get('consumptions'):
+            self._trend_buckets[block.get('timestamp')] = block
+
+        day_ms = int(day.timestamp() * 1e3)
+        hour_ms = int(end.replace(minute=0, second=0, microsecond=0).timestamp() * 1e3)
+        end_ms = int(end.timestamp() * 1e3)
+
+        timestamps = sorted(ts for ts in self._trend_buckets if ts >= day_ms)
+        if not timestamps:
+            return
+
+        # the last 5 minutes value is the newest completed bucket
+        completed = [ts for ts in timestamps if ts + FIVE_MINUTES_MS <= end_ms]
+        trend_timestamps = {
+            'today': timestamps,
+            'current_hour': [ts for ts in timestamps if ts >= hour_ms],
+            'last_5_minutes': completed[-1:] or timestamps[-1:],
+        }
+
+        for trend, trend_ts in trend_timestamps.items():
+            blocks = [self._trend_buckets[ts] for ts in trend_ts]
+            self._aggregated_values[f'power_{trend}'] = self._sum_blocks(blocks, 'consumption')
+            self._aggregated_values[f'solar_{trend}'] = self._sum_blocks(blocks, 'solar')
+            always_on = self._sum_blocks(blocks, 'alwaysOn')
+            self._aggregated_values[f'alwayson_{trend}'] = always_on * 12 if always_on is not None else None
+
+    @staticmethod
+    def _sum_blocks(blocks, key):
+        values = [block.get(key) for block in blocks if block.get(key) is not None]
+        return sum(values) if values else None
+
     def update_active_consumptions(self, trend='today'):
+        if ('trend', trend) in self._cache:
+            return
+
+        start, end, aggtype = self._trend_window(trend=trend)
+        consumption_result = self.smappee_api.get_consumption(service_location_id=self.service_location_id,
+                                                              start=start,
+                                                              end=end,
+                                                              aggregation=aggtype)
+        self._apply_active_consumptions(trend=trend, consumption_result=consumption_result)
+
+    async def async_update_active_consumptions(self, trend='today'):
+        if ('trend', trend) in self._cache:
+            return
+
+        start, end, aggtype = self._trend_window(trend=trend)
+        consumption_result = await self.smappee_api.get_consumption(service_location_id=self.service_location_id,
+                                                                    start=start,
+                                                                    end=end,
+                                                                    aggregation=aggtype)
+        self._apply_active_consumptions(trend=trend, consumption_result=consumption_result)
+
+    @staticmethod
+    def _trend_window(trend):
         params = {
             'today': {'aggtype': 3, 'delta': 1440},
             'current_hour': {'aggtype': 2, 'delta': 60},
             'last_5_minutes': {'aggtype': 1, 'delta': 9}
         }
 
-        if f'total_consumption_{trend}' in self._cache:
-            return
-
         end = datetime.utcnow()
         start = end - timedelta(minutes=params.get(trend).get('delta'))
+        return start, end, params.get(trend).get('aggtype')
 
-        consumption_result = self.smappee_api.get_consumption(service_location_id=self.service_location_id,
-                                                              start=start,
-                                                              end=end,
-                                                              aggregation=params.get(trend).get('aggtype'))
-        self._cache[f'total_consumption_{trend}'] = consumption_result
+    def _apply_active_consumptions(self, trend, consumption_result):
+        consumptions = consumption_result['consumptions']
+        self._cache.set('trend', trend, consumptions[0] if consumptions else None)
 
-        if consumption_result['consumptions']:
-            self.aggregated_values[f'power_{trend}'] = consumption_result.get('consumptions')[0].get('consumption')
-            self.aggregated_values[f'solar_{trend}'] = consumption_result.get('consumptions')[0].get('solar')
-            self.aggregated_values[f'alwayson_{trend}'] = consumption_result.get('consumptions')[0].get('alwaysOn') * 12
+        if consumptions:
+            self._aggregated_values[f'power_{trend}'] = consumption_result.get('consumptions')[0].get('consumption')
+            self._aggregated_values[f'solar_{trend}'] = consumption_result.get('consumptions')[0].get('solar')
+            self._aggregated_values[f'alwayson_{trend}'] = consumption_result.get('consumptions')[0].get('alwaysOn') * 12
 
     def update_todays_actuator_consumptions(self, aggtype=3, delta=1440):
         end = datetime.utcnow()
         start = end - timedelta(minutes=delta)
 
-        for id, actuator in self.actuators.items():
-            if f'actuator_{id}_consumption_today' in self._cache:
+        for id in list(self._actuators):
+            if ('actuator_consumption', id) in self._cache:
                 continue
 
             consumption_result = self.smappee_api.get_switch_consumption(service_location_id=self.service_location_id,
@@ -610,17 +1105,36 @@ class SmappeeServiceLocation(object):
                                                                          start=start,
                                                                          end=end,
                                                                          aggregation=aggtype)
-            self._cache[f'actuator_{id}_consumption_today'] = consumption_result
+            self._apply_actuator_consumption(id=id, consumption_result=consumption_result)
+
+    async def async_update_todays_actuator_consumptions(self, aggtype=3, delta=1440):
+        end = datetime.utcnow()
+        start = end - timedelta(minutes=delta)
+
+        async def update(id):
+            consumption_result = await self.smappee_api.get_switch_consumption(service_location_id=self.service_location_id,
+                                                                               switch_id=id,
+                                                                               start=start,
+                                                                               end=end,
+                                                                               aggregation=aggtype)
+            self._apply_actuator_consumption(id=id, consumption_result=consumption_result)
 
-            if consumption_result['records']:
-                actuator.consumption_today = consumption_result.get('records')[0].get('active')
+        await asyncio.gather(*[update(id) for id in list(self._actuators)
+                               if ('actuator_consumption', id) not in self._cache])
+
+    def _apply_actuator_consumption(self, id, consumption_result):
+        active = consumption_result.get('records')[0].get('active') if consumption_result['records'] else None
+        self._cache.set('actuator_consumption', id, active)
+
+        if consumption_result['records']:
+            self._actuators[id].consumption_today = active
 
     def update_todays_sensor_consumptions(self, aggtype=3, delta=1440):
         end = datetime.utcnow()
         start = end - timedelta(minutes=delta)
 
-        for id, sensor in self.sensors.items():
-            if f'sensor_{id}_consumption_today' in self._cache:
+        for id in list(self._sensors):
+            if ('sensor_consumption', id) in self._cache:
                 continue
 
             consumption_result = self.smappee_api.get_sensor_consumption(service_location_id=self.service_location_id,
@@ -628,21 +1142,43 @@ class SmappeeServiceLocation(object):
                                                                          start=start,
                                                                          end=end,
                                                                          aggregation=aggtype)
-            self._cache[f'sensor_{id}_consumption_today'] = consumption_result
+            self._apply_sensor_consumption(id=id, consumption_result=consumption_result)
+
+    async def async_update_todays_sensor_consumptions(self, aggtype=3, delta=1440):
+        end = datetime.utcnow()
+        start = end - timedelta(minutes=delta)
+
+        async def update(id):
+            consumption_result = await self.smappee_api.get_sensor_consumption(service_location_id=self.service_location_id,
+                                                                               sensor_id=id,
+                                                                               start=start,
+                                                                               end=end,
+                                                                               aggregation=aggtype)
+            self._apply_sensor_consumption(id=id, consumption_result=consumption_result)
+
+        await asyncio.gather(*[update(id) for id in list(self._sensors)
+                               if ('sensor_consumption', id) not in self._cache])
 
-            if consumption_result['records']:
-                sensor.update_today_values(record=consumption_result.get('records')[0])
+    def _apply_sensor_consumption(self, id, consumption_result):
+        self._cache.set('sensor_consumption', id, consumption_result['records'][0] if consumption_result['records'] else None)
 
-                if 'temperature' in consumption_result.get('records')[0]:
-                    sensor.temperature = consumption_result.get('records')[0].get('temperature')
+        if consumption_result['records']:
+            sensor = self._sensors[id]
+            sensor.update_today_values(record=consumption_result.get('records')[0])
 
-                if 'humidity' in consumption_result.get('records')[0]:
-                    sensor.humidity = consumption_result.get('records')[0].get('humidity')
+            if 'temperature' in consumption_result.get('records')[0]:
+                sensor.temperature = consumption_result.get('records')[0].get('temperature')
 
-                if 'battery' in consumption_result.get('records')[0]:
-                    sensor.battery = consumption_result.get('records')[0].get('battery')
+            if 'humidity' in consumption_result.get('records')[0]:
+                sensor.humidity = consumption_result.get('records')[0].get('humidity')
+
+            if 'battery' in consumption_result.get('records')[0]:
+                sensor.battery = consumption_result.get('records')[0].get('battery')
 
     def update_trends_and_appliance_states(self, ):
+        # a lazy service location needs its configuration
+        self._ensure_loaded('configuration')
+
         if self.local_polling and is_smappee_genius(serialnumber=self._device_serial_number):
             pass
         elif self.local_polling:
@@ -652,18 +1188,32 @@ class SmappeeServiceLocation(object):
                 self._realtime_values['total_power'] = tp
 
             # Solar power
-            if self.has_solar_production:
+            if self._has_solar_production:
                 sp = self.smappee_api.active_power(solar=True)
                 if sp is not None:
                     self._realtime_values['solar_power'] = sp
         else:
             # update trend consumptions
-            self.update_active_consumptions(trend='today')
-            self.update_active_consumptions(trend='current_hour')
-            self.update_active_consumptions(trend='last_5_minutes')
+            self.update_trend_consumptions()
             self.update_todays_sensor_consumptions()
             self.update_todays_actuator_consumptions()
 
             # update appliance states
-            for appliance_id, _ in self.appliances.items():
+            for appliance_id, _ in self._appliances.items():
                 self.update_appliance_state(id=appliance_id)
+
+        self._lazy_pending.discard('trends')
+
+    async def async_update_trends_and_appliance_states(self):
+        if self.local_polling:
+            # The local API is blocking, run the regular update in an executor
+            await asyncio.get_running_loop().run_in_executor(None, self.update_trends_and_appliance_states)
+            return
+
+        # update trend consumptions and appliance states concurrently
+        await asyncio.gather(
+            self.async_update_trend_consumptions(),
+            self.async_update_todays_sensor_consumptions(),
+            self.async_update_todays_actuator_consumptions(),
+            *[self.async_update_appliance_state(id=appliance_id) for appliance_id in list(self._appliances)]
+        )
@@ -1,12 +1,23 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .servicelocation import SmappeeServiceLocation
 
+# format version of configuration snapshots
+SNAPSHOT_VERSION = 1
+
 
 class Smappee:
 
-    def __init__(self, api, serialnumber=None):
+    def __init__(self, api, serialnumber=None, **options):
         """
         :param api:
         :param serialNumber:
+        :param options: passed to every SmappeeServiceLocation (hydrate_actuators, trend_mode, mqtt_features, lazy)
         """
         # shared api instance
         self.smappee_api = api
@@ -15,33 +26,238 @@ class Smappee:
         self._serialnumber = serialnumber
         self._local_polling = serialnumber is not None
 
-        # service locations accessible from user
+        # service location options
+        self._service_location_options = options
+
+        # service locations accessible from user, replaced (copy-on-write) under the lock so a snapshot
+        # revalidation never changes the dict being iterated by a poll
         self._service_locations = {}
+        self._service_locations_lock = threading.Lock()
+
+        # service locations that failed to load by id (with the raised exception)
+        self._failed_service_locations = {}
+
+        # background revalidation of a loaded snapshot
+        self._revalidation = None
+
+    def _loadable_service_locations(self, locations):
+        # known service locations are refreshed, new ones are only created if the serialnumber is known
+        return [service_location for service_location in locations['serviceLocations']
+                if service_location.get('serviceLocationId') in self._service_locations
+                or 'deviceSerialNumber' in service_location]
+
+    def _load_service_location(self, service_location, refresh):
+        if service_location.get('serviceLocationId') in self._service_locations:
+            # refresh the configuration
+            sl = self._service_locations.get(service_location.get('serviceLocationId'))
+            sl.load_configuration(refresh=refresh)
+            return sl
+
+        # Create service location object
+        return SmappeeServiceLocation(service_location_id=service_location.get('serviceLocationId'),
+                                      device_serial_number=service_location.get('deviceSerialNumber'),
+                                      smappee_api=self.smappee_api,
+                                      **self._service_location_options)
+
+    def _service_location_loaded(self, service_location_id, sl, error, done, total, progress_callback):
+        if error is None:
+            # Add sl object
+            self._set_service_location(service_location_id, sl)
+            self._failed_service_locations.pop(service_location_id, None)
+        else:
+            self._failed_service_locations[service_location_id] = error
+
+        if progress_callback is not None:
+            progress_callback(done, total, service_location_id, error)
+
+    def _set_service_location(self, service_location_id, sl):
+        with self._service_locations_lock:
+            service_locations = dict(self._service_locations)
+            service_locations[service_location_id] = sl
+            self._service_locations = service_locations
+
+    def _prune_service_locations(self, locations):
+        # stop and remove known service locations that are no longer part of the account
+        ids = {service_location.get('serviceLocationId') for service_location in locations['serviceLocations']}
+        with self._service_locations_lock:
+            removed = [sl for sl_id, sl in self._service_locations.items() if sl_id not in ids]
+            self._service_locations = {sl_id: sl for sl_id, sl in self._service_locations.items() if sl_id in ids}
+
+        for sl in removed:
+            for connection in (sl.mqtt_connection_central, sl.mqtt_connection_local):
+                if connection is not None:
+                    connection.stop()
+
+    def load_service_locations(self, refresh=False, max_workers=1, progress_callback=None, prune=False):
+        """
+        :param refresh: reload the configuration of known service locations
+        :param max_workers: number of service locations loaded in parallel
+        :param progress_callback: called as (done, total, service_location_id, error) after each location
+        :param prune: remove known service locations that are no longer part of the account
+        """
+        service_locations = self.smappee_api.get_service_locations()
+        if prune:
+            self._prune_service_locations(service_locations)
+        locations = self._loadable_service_locations(service_locations)
+        total = len(locations)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers),
+                                thread_name_prefix='SmappeeServiceLocationLoader') as executor:
+            futures = {executor.submit(self._load_service_location, service_location, refresh):
+                       service_location.get('serviceLocationId') for service_location in locations}
+
+            for done, future in enumerate(as_completed(futures), start=1):
+                sl, error = None, future.exception()
+                if error is None:
+                    sl = future.result()
+                else:
+                    # a failing service location does not abort loading the others
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                self._service_location_loaded(futures[future], sl, error, done, total, progress_callback)
+
+    async def async_load_service_locations(self, refresh=False, max_concurrency=10, progress_callback=None,
+                                           prune=False):
+        """
+        Load all service locations using an AsyncSmappeeApi instance.
+
+        :param refresh: reload the configuration of known service locations
+        :param max_concurrency: number of service locations loaded at the same time
+        :param progress_callback: called as (done, total, service_location_id, error) after each location
+        :param prune: remove known service locations that are no longer part of the account
+        """
+        service_locations = await self.smappee_api.get_service_locations()
+        if prune:
+            self._prune_service_locations(service_locations)
+        locations = self._loadable_service_locations(service_locations)
+        total, done = len(locations), 0
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def load(service_location):
+            nonlocal done
+            service_location_id = service_location.get('serviceLocationId')
+            sl, error = None, None
+            async with semaphore:
+                try:
+                    if service_location_id in self._service_locations:
+                        sl = self._service_locations.get(service_location_id)
+                        await sl.async_load_configuration(refresh=refresh)
+                    else:
+                        sl = await SmappeeServiceLocation.async_create(
+                            service_location_id=service_location_id,
+                            device_serial_number=service_location.get('deviceSerialNumber'),
+                            smappee_api=self.smappee_api,
+                            **self._service_location_options
+                        )
+                except Exception as e:
+                    # a failing service location does not abort loading the others
+                    traceback.print_exc()
+                    error = e
 
-    def load_service_locations(self, refresh=False):
-        locations = self.smappee_api.get_service_locations()
-        for service_location in locations['serviceLocations']:
-            if service_location.get('serviceLocationId') in self._service_locations:
-                # refresh the configuration
-                sl = self.service_locations.get(service_location.get('serviceLocationId'))
-                sl.load_configuration(refresh=refresh)
-            elif 'deviceSerialNumber' in service_location:
-                # Create service location object if the serialnumber is known
-                sl = SmappeeServiceLocation(service_location_id=service_location.get('serviceLocationId'),
-                                            device_serial_number=service_location.get('deviceSerialNumber'),
-                                            smappee_api=self.smappee_api)
-
-                # Add sl object
-                self.service_locations[service_location.get('serviceLocationId')] = sl
+            done += 1
+            self._service_location_loaded(service_location_id, sl, error, done, total, progress_callback)
+
+        await asyncio.gather(*[load(service_location) for service_location in locations])
+
+    def save_snapshot(self, path):
+        """Write the configuration of the loaded service locations to a JSON snapshot file."""
+        sl_snapshots = [sl.snapshot() for sl in list(self.service_locations.values())]
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'created': time.time(),
+            'serviceLocations': [sl_snapshot for sl_snapshot in sl_snapshots if sl_snapshot is not None],
+        }
+
+        # replace the previous snapshot atomically
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_snapshot(path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            traceback.print_exc()
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def _load_snapshot_service_locations(self, snapshot):
+        for sl_snapshot in snapshot['serviceLocations']:
+            service_location_id = sl_snapshot.get('serviceLocationId')
+            if service_location_id in self._service_locations:
+                continue
+            sl = SmappeeServiceLocation(service_location_id=service_location_id,
+                                        device_serial_number=sl_snapshot.get('deviceSerialNumber'),
+                                        smappee_api=self.smappee_api,
+                                        load=False,
+                                        **self._service_location_options)
+            sl.load_snapshot(sl_snapshot)
+            self._set_service_location(service_location_id, sl)
+
+    def load_snapshot(self, path, revalidate=True, max_workers=1):
+        """
+        Create the service locations from a snapshot file written by save_snapshot, without any API call.
+
+        :param path: snapshot file
+        :param revalidate: reload the service locations in a background thread, applying only the differences
+         and removing the service locations that are no longer part of the account
+        :param max_workers: number of service locations revalidated in parallel
+        :return: False when the snapshot is missing or unreadable, service locations should then be loaded
+         with load_service_locations
+        """
+        snapshot = self._read_snapshot(path)
+        if snapshot is None:
+            return False
+
+        self._load_snapshot_service_locations(snapshot)
+
+        if revalidate:
+            self._revalidation = threading.Thread(target=self.load_service_locations,
+                                                  kwargs={'refresh': True, 'max_workers': max_workers, 'prune': True},
+                                                  name='SmappeeSnapshotRevalidation',
+                                                  daemon=True)
+            self._revalidation.start()
+        return True
+
+    async def async_load_snapshot(self, path, revalidate=True, max_concurrency=10):
+        """
+        load_snapshot for an AsyncSmappeeApi instance, the revalidation runs as a task on the running loop.
+
+        :return: False when the snapshot is missing or unreadable
+        """
+        snapshot = self._read_snapshot(path)
+        if snapshot is None:
+            return False
+
+        # starting the MQTT connections is blocking
+        await asyncio.get_running_loop().run_in_executor(None, self._load_snapshot_service_locations, snapshot)
+
+        if revalidate:
+            self._revalidation = asyncio.create_task(
+                self.async_load_service_locations(refresh=True, max_concurrency=max_concurrency, prune=True)
+            )
+        return True
+
+    @property
+    def revalidation(self):
+        """Thread (or task with an AsyncSmappeeApi) revalidating the last loaded snapshot."""
+        return self._revalidation
 
     def load_local_service_location(self):
         # Create service location object
         sl = SmappeeServiceLocation(device_serial_number=self._serialnumber,
                                     smappee_api=self.smappee_api,
-                                    local_polling=self._local_polling)
+                                    local_polling=self._local_polling,
+                                    **self._service_location_options)
 
         # Add sl object
-        self.service_locations[sl.service_location_id] = sl
+        self._set_service_location(sl.service_location_id, sl)
 
     @property
     def local_polling(self):
@@ -51,6 +267,14 @@ class Smappee:
     def service_locations(self):
         return self._service_locations
 
+    @property
+    def failed_service_locations(self):
+        return self._failed_service_locations
+
     def update_trends_and_appliance_states(self):
-        for _, sl in self.service_locations.items():
+        for sl in list(self.service_locations.values()):
             sl.update_trends_and_appliance_states()
+
+    async def async_update_trends_and_appliance_states(self):
+        await asyncio.gather(*[sl.async_update_trends_and_appliance_states()
+                               for sl in list(self.service_locations.values())])
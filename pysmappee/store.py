@@ -0,0 +1,176 @@
+"""Support for persisting immutable Smappee consumption data."""
+import json
+import sqlite3
+import threading
+import time
+
+# length of a bucket in milliseconds per aggregation, longer periods are rounded up
+BUCKET_MS = {
+    1: 5 * 60 * 1000,
+    2: 60 * 60 * 1000,
+    3: 24 * 60 * 60 * 1000,
+    4: 31 * 24 * 60 * 60 * 1000,
+    5: 92 * 24 * 60 * 60 * 1000,
+}
+DEFAULT_BUCKET_MS = 366 * 24 * 60 * 60 * 1000
+
+
+class SmappeeConsumptionStore:
+    """SQLite store of completed consumption buckets.
+
+    Buckets are kept per service location, entity ('location', 'sensor/<id>' or 'switch/<id>'),
+    aggregation and timestamp. Next to the buckets the store keeps the time ranges it knows all
+    completed buckets of, so only the missing (or still open) part of a range goes to the network.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'service_location_id TEXT, entity TEXT, aggregation INTEGER, timestamp INTEGER, record TEXT, '
+                'PRIMARY KEY (service_location_id, entity, aggregation, timestamp))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS coverage ('
+                'service_location_id TEXT, entity TEXT, aggregation INTEGER, start INTEGER, end INTEGER)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS coverage_key ON coverage (service_location_id, entity, aggregation)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS envelopes ('
+                'service_location_id TEXT, entity TEXT, aggregation INTEGER, envelope TEXT, '
+                'PRIMARY KEY (service_location_id, entity, aggregation))'
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def plan(self, service_location_id, entity, aggregation, start, end):
+        """
+        Get the stored records of an inclusive range in milliseconds and the (start, end) ranges that
+        still have to be fetched, with an exclusive end.
+
+        Like the API, the records are the buckets overlapping the range, including the bucket in
+        progress at start.
+        """
+        key = (str(service_location_id), entity, aggregation)
+        bucket_ms = BUCKET_MS.get(aggregation, DEFAULT_BUCKET_MS)
+        with self._lock:
+            covered = self._db.execute(
+                'SELECT start, end FROM coverage WHERE service_location_id=? AND entity=? AND aggregation=? '
+                'AND end > ? AND start <= ? ORDER BY start',
+                key + (start, end)
+            ).fetchall()
+            records = [json.loads(r) for r, in self._db.execute(
+                'SELECT record FROM records WHERE service_location_id=? AND entity=? AND aggregation=? '
+                'AND timestamp > ? AND timestamp <= ? ORDER BY timestamp',
+                key + (start - bucket_ms, end)
+            )]
+
+        # only the last bucket starting before the range overlaps it (buckets can be shorter than bucket_ms)
+        earlier = [record for record in records if record.get('timestamp') < start]
+        records = earlier[-1:] + records[len(earlier):]
+
+        missing, position = [], start
+        for covered_start, covered_end in covered:
+            if covered_start > position:
+                missing.append((position, covered_start))
+            position = max(position, covered_end)
+        if position <= end:
+            missing.append((position, end + 1))
+
+        return records, missing
+
+    def envelope(self, service_location_id, entity, aggregation, records_key):
+        """Last response of an entity and aggregation without its records, to answer from the store."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT envelope FROM envelopes WHERE service_location_id=? AND entity=? AND aggregation=?',
+                (str(service_location_id), entity, aggregation)
+            ).fetchone()
+        envelope = json.loads(row[0]) if row is not None else {'serviceLocationId': service_location_id}
+        envelope.pop(records_key, None)
+        return envelope
+
+    def save(self, service_location_id, entity, aggregation, start, end, records, now=None, envelope=None):
+        """
+        Store the completed buckets of a fetched inclusive range in milliseconds, with the other keys of
+        the response (envelope) if given.
+        """
+        now = int(time.time() * 1e3) if now is None else now
+        bucket_ms = BUCKET_MS.get(aggregation, DEFAULT_BUCKET_MS)
+
+        # a bucket starting before this moment has ended
+        stable_until = min(end + 1, now - bucket_ms)
+
+        key = (str(service_location_id), entity, aggregation)
+        with self._lock, self._db:
+            if envelope is not None:
+                self._db.execute('INSERT OR REPLACE INTO envelopes VALUES (?, ?, ?, ?)',
+                                 key + (json.dumps(envelope),))
+            if stable_until <= start:
+                return
+
+            # records are kept by the bucket they cover, which can start before the range
+            self._db.executemany(
+                'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                [key + (record.get('timestamp'), json.dumps(record)) for record in records
+                 if start - bucket_ms < record.get('timestamp') < stable_until]
+            )
+
+            # merge with overlapping and adjacent ranges
+            overlapping = self._db.execute(
+                'SELECT rowid, start, end FROM coverage WHERE service_location_id=? AND entity=? AND aggregation=? '
+                'AND end >= ? AND start <= ?',
+                key + (start, stable_until)
+            ).fetchall()
+            for rowid, covered_start, covered_end in overlapping:
+                start, stable_until = min(start, covered_start), max(stable_until, covered_end)
+                self._db.execute('DELETE FROM coverage WHERE rowid=?', (rowid,))
+            self._db.execute('INSERT INTO coverage VALUES (?, ?, ?, ?, ?)', key + (start, stable_until))
+
+    def _save_result(self, service_location_id, entity, aggregation, start, end, records_key, records, result):
+        fetched = result.get(records_key) or []
+        envelope = {k: v for k, v in result.items() if k != records_key}
+        self.save(service_location_id, entity, aggregation, start, end, fetched, envelope=envelope)
+
+        result[records_key] = self.merge(records, fetched)
+        return result
+
+    def fetch(self, service_location_id, entity, aggregation, start, end, records_key, fetch):
+        """
+        Get a consumption response for an inclusive range in milliseconds, serving completed buckets from
+        the store and requesting the missing part with fetch(start, end).
+        """
+        records, missing = self.plan(service_location_id, entity, aggregation, start, end)
+        if not missing:
+            return dict(self.envelope(service_location_id, entity, aggregation, records_key), **{records_key: records})
+
+        # a single request from the first to the last missing bucket
+        fetch_start, fetch_end = missing[0][0], missing[-1][1] - 1
+        result = fetch(fetch_start, fetch_end)
+        return self._save_result(service_location_id, entity, aggregation, fetch_start, fetch_end, records_key,
+                                 records, result)
+
+    async def async_fetch(self, service_location_id, entity, aggregation, start, end, records_key, fetch):
+        """Same as fetch, for a coroutine function fetch(start, end)."""
+        records, missing = self.plan(service_location_id, entity, aggregation, start, end)
+        if not missing:
+            return dict(self.envelope(service_location_id, entity, aggregation, records_key), **{records_key: records})
+
+        fetch_start, fetch_end = missing[0][0], missing[-1][1] - 1
+        result = await fetch(fetch_start, fetch_end)
+        return self._save_result(service_location_id, entity, aggregation, fetch_start, fetch_end, records_key,
+                                 records, result)
+
+    @staticmethod
+    def merge(stored, fetched):
+        # fetched records replace stored ones with the same timestamp
+        records = {record.get('timestamp'): record for record in stored}
+        records.update({record.get('timestamp'): record for record in fetched})
+        return [records[timestamp] for timestamp in sorted(records)]
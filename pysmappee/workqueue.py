@@ -0,0 +1,192 @@
+"""Support for handling MQTT messages off the paho network thread."""
+import collections
+import threading
+import time
+import traceback
+import zlib
+
+OVERFLOW_DROP_SUPERSEDED = 'drop_superseded'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_BLOCK = 'block'
+
+# realtime topics of which only the latest frame matters
+CONFLATED_TOPICS = ('/power', '/realtime')
+
+
+class SmappeeQueuedMessage:
+    """Raw MQTT message as handed from the network thread to a worker."""
+
+    __slots__ = ('topic', 'payload', 'timestamp')
+
+    def __init__(self, topic, payload, timestamp):
+        self.topic = topic
+        self.payload = payload
+        self.timestamp = timestamp
+
+
+class _Lane:
+    # FIFO of [handler, message] entries handled by one worker thread, dropped entries are set to None
+    def __init__(self):
+        self.entries = collections.deque()
+        self.size = 0
+        self.condition = threading.Condition()
+
+        # pending entries of conflated topics by topic
+        self.latest = {}
+
+        # metrics, updated under the condition lock
+        self.enqueued = 0
+        self.processed = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.overflow = 0
+        self.max_wait = 0
+
+
+class SmappeeWorkQueue:
+    """Bounded queue between the MQTT network thread and one or more worker threads.
+
+    Messages of a topic are always handled by the same worker, in order. When the queue is full, only
+    realtime frames (topics ending with one of the conflated topics) are dropped, config and actuator
+    messages are always queued.
+    """
+
+    def __init__(self, maxsize=1000, workers=1, overflow=OVERFLOW_DROP_SUPERSEDED, conflated_topics=CONFLATED_TOPICS):
+        """
+        :param maxsize: number of queued messages before the overflow policy applies
+        :param workers: number of worker threads
+        :param overflow: drop_superseded (replace a queued frame of the same topic, else drop the new frame),
+         drop_oldest (drop the oldest queued frame), drop_newest (drop the new frame) or block
+        :param conflated_topics: topic suffixes of realtime frames that may be dropped
+        """
+        if overflow not in (OVERFLOW_DROP_SUPERSEDED, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK):
+            raise ValueError(f'Unknown overflow policy {overflow}')
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._conflated_topics = tuple(conflated_topics)
+        self._lanes = [_Lane() for _ in range(max(1, workers))]
+        self._lane_maxsize = max(1, maxsize // len(self._lanes))
+        self._running = True
+
+        # depth over all lanes, the other metrics are kept by each lane
+        self._max_depth = 0
+        self._max_depth_lock = threading.Lock()
+
+        self._workers = [threading.Thread(target=self._run, args=(lane,), name=f'SmappeeWorkQueue-{i}', daemon=True)
+                         for i, lane in enumerate(self._lanes)]
+        for worker in self._workers:
+            worker.start()
+
+    def _lane(self, topic):
+        if len(self._lanes) == 1:
+            return self._lanes[0]
+        return self._lanes[zlib.crc32(topic.encode()) % len(self._lanes)]
+
+    def _conflated(self, topic):
+        return topic.endswith(self._conflated_topics)
+
+    def put(self, handler, message):
+        """Queue a paho message to be handled as handler(message) by a worker thread."""
+        topic = message.topic
+        queued = SmappeeQueuedMessage(topic=topic, payload=message.payload, timestamp=time.time())
+        conflated = self._conflated(topic)
+        lane = self._lane(topic)
+
+        with lane.condition:
+            if lane.size >= self._lane_maxsize:
+                if self._overflow == OVERFLOW_BLOCK:
+                    while self._running and lane.size >= self._lane_maxsize:
+                        lane.condition.wait()
+                elif not conflated:
+                    # config and actuator messages are never dropped
+                    lane.overflow += 1
+                elif self._overflow == OVERFLOW_DROP_NEWEST:
+                    lane.dropped += 1
+                    return
+                elif self._overflow == OVERFLOW_DROP_SUPERSEDED:
+                    entry = lane.latest.get(topic)
+                    if entry is None:
+                        lane.dropped += 1
+                    else:
+                        entry[1] = queued
+                        lane.superseded += 1
+                    return
+                elif not self._drop_oldest(lane):
+                    lane.overflow += 1
+
+            entry = [handler, queued]
+            lane.entries.append(entry)
+            lane.size += 1
+            if conflated:
+                lane.latest[topic] = entry
+            lane.enqueued += 1
+            lane.condition.notify_all()
+
+        depth = self.depth
+        with self._max_depth_lock:
+            self._max_depth = max(self._max_depth, depth)
+
+    def _drop_oldest(self, lane):
+        for entry in lane.entries:
+            if entry[0] is not None and self._conflated(entry[1].topic):
+                self._remove(lane, entry)
+                lane.dropped += 1
+                return True
+        return False
+
+    def _remove(self, lane, entry):
+        if lane.latest.get(entry[1].topic) is entry:
+            del lane.latest[entry[1].topic]
+        entry[0] = None
+        lane.size -= 1
+
+    def _run(self, lane):
+        while True:
+            with lane.condition:
+                while self._running and not lane.entries:
+                    lane.condition.wait()
+                if not self._running:
+                    return
+                entry = lane.entries.popleft()
+                handler, message = entry
+                if handler is None:
+                    continue
+                self._remove(lane, entry)
+                lane.condition.notify_all()
+
+            wait = time.time() - message.timestamp
+            try:
+                handler(message)
+            except Exception:
+                traceback.print_exc()
+
+            with lane.condition:
+                lane.processed += 1
+                lane.max_wait = max(lane.max_wait, wait)
+
+    @property
+    def depth(self):
+        return sum(lane.size for lane in self._lanes)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'max_depth': self._max_depth,
+            'maxsize': self._maxsize,
+            'workers': len(self._workers),
+            'enqueued': sum(lane.enqueued for lane in self._lanes),
+            'processed': sum(lane.processed for lane in self._lanes),
+            'superseded': sum(lane.superseded for lane in self._lanes),
+            'dropped': sum(lane.dropped for lane in self._lanes),
+            'overflow': sum(lane.overflow for lane in self._lanes),
+            'max_wait': max(lane.max_wait for lane in self._lanes),
+        }
+
+    def stop(self):
+        self._running = False
+        for lane in self._lanes:
+            with lane.condition:
+                lane.condition.notify_all()
+        for worker in self._workers:
+            worker.join()
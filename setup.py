@@ -12,7 +12,7 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/smappee/pysmappee",
-    packages=setuptools.find_packages(exclude=['test']),
+    packages=setuptools.find_packages(exclude=['test', 'benchmarks']),
     license='MIT',
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -26,6 +26,10 @@ setuptools.setup(
         "pytz>=2019.3",
         "requests>=2.23.0",
         "requests-oauthlib>=1.3.0",
-        "schedule>=1.1.0",
     ],
+    extras_require={
+        "async": [
+            "aiohttp>=3.7.0",
+        ],
+    },
 )
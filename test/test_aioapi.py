@@ -0,0 +1,72 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from pysmappee.aioapi import AsyncSmappeeApi
+from pysmappee.config import config
+
+FARM = 99
+
+
+def run(app, test, monkeypatch):
+    monkeypatch.setitem(config['HTTP'], 'backoff_factor', 0)
+
+    async def main():
+        async with TestServer(app) as server:
+            monkeypatch.setitem(config['API_URL'], FARM, {
+                'servicelocation_url': str(server.make_url('/servicelocation')),
+                'token_url': str(server.make_url('/oauth2/token')),
+            })
+            async with AsyncSmappeeApi('id', 'secret', token={'access_token': 'a', 'refresh_token': 'r'},
+                                       farm=FARM) as api:
+                return await test(api)
+    return asyncio.run(main())
+
+
+def test_server_errors_are_retried(monkeypatch):
+    calls = []
+
+    async def service_locations(request):
+        calls.append(request)
+        if len(calls) < 3:
+            return web.Response(status=503)
+        return web.json_response({'serviceLocations': []})
+
+    app = web.Application()
+    app.router.add_get('/servicelocation', service_locations)
+    result = run(app, lambda api: api.get_service_locations(), monkeypatch)
+    assert result == {'serviceLocations': []}
+    assert len(calls) == 3
+
+
+def test_read_timeout(monkeypatch):
+    monkeypatch.setitem(config['HTTP'], 'retries', 0)
+    monkeypatch.setitem(config['HTTP'], 'timeouts', dict(config['HTTP']['timeouts'], service_locations=(1, 0.05)))
+
+    async def service_locations(request):
+        await asyncio.sleep(1)
+        return web.json_response({'serviceLocations': []})
+
+    async def test(api):
+        try:
+            await api.get_service_locations()
+        except asyncio.TimeoutError:
+            return 'timeout'
+
+    app = web.Application()
+    app.router.add_get('/servicelocation', service_locations)
+    assert run(app, test, monkeypatch) == 'timeout'
+
+
+def test_refresh_keeps_refresh_token_when_not_rotated(monkeypatch):
+    async def token(request):
+        return web.json_response({'access_token': 'b', 'expires_in': 3600})
+
+    async def test(api):
+        await api.refresh_tokens()
+        return api.token
+
+    app = web.Application()
+    app.router.add_post('/oauth2/token', token)
+    refreshed = run(app, test, monkeypatch)
+    assert refreshed['access_token'] == 'b'
+    assert refreshed['refresh_token'] == 'r'
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import pytz
+
+from pysmappee import cache as cache_module
+from pysmappee.cache import SmappeeResourceCache
+from pysmappee.config import config
+
+
+class FrozenClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def local(timezone, *args):
+    return pytz.timezone(timezone).localize(datetime(*args)).timestamp()
+
+
+def test_expires_at_bucket_boundaries(monkeypatch):
+    # a TTL long enough for the boundaries to apply
+    monkeypatch.setitem(config['CACHE'], 'ttl', {'trend': 2 * 86400, 'appliance': 60})
+    brussels = SmappeeResourceCache('test', timezone='Europe/Brussels')
+
+    now = local('Europe/Brussels', 2024, 3, 15, 10, 47, 30)
+    assert brussels.expires('trend', 'last_5_minutes', now=now) == local('Europe/Brussels', 2024, 3, 15, 10, 50)
+    assert brussels.expires('trend', 'buckets', now=now) == local('Europe/Brussels', 2024, 3, 15, 10, 50)
+    assert brussels.expires('trend', 'current_hour', now=now) == local('Europe/Brussels', 2024, 3, 15, 11)
+    assert brussels.expires('trend', 'today', now=now) == local('Europe/Brussels', 2024, 3, 16)
+    # values without a bucket only have a TTL
+    assert brussels.expires('appliance', 1, now=now) == now + 60
+
+    # a value stored on a boundary belongs to the next bucket
+    now = local('Europe/Brussels', 2024, 3, 15, 11)
+    assert brussels.expires('trend', 'last_5_minutes', now=now) == now + 300
+    assert brussels.expires('trend', 'current_hour', now=now) == now + 3600
+
+    # the day of the daylight saving time change has 23 hours
+    now = local('Europe/Brussels', 2024, 3, 31, 0, 30)
+    assert brussels.expires('trend', 'today', now=now) == local('Europe/Brussels', 2024, 4, 1)
+    assert brussels.expires('trend', 'today', now=now) - now == 22.5 * 3600
+
+    # hours start on the half hour UTC in India
+    kolkata = SmappeeResourceCache('test', timezone='Asia/Kolkata')
+    now = local('Asia/Kolkata', 2024, 3, 15, 23, 10)
+    assert kolkata.expires('trend', 'current_hour', now=now) == local('Asia/Kolkata', 2024, 3, 16)
+    assert kolkata.expires('trend', 'today', now=now) == local('Asia/Kolkata', 2024, 3, 16)
+
+    # UTC without a timezone
+    now = local('UTC', 2024, 3, 15, 23, 10)
+    assert SmappeeResourceCache('test').expires('trend', 'today', now=now) == local('UTC', 2024, 3, 16)
+
+
+def test_evicts_the_entries_expiring_first(monkeypatch):
+    monkeypatch.setitem(config['CACHE'], 'ttl', {'trend': 2 * 86400, 'appliance': 300})
+    clock = FrozenClock(local('Europe/Brussels', 2024, 3, 15, 10, 47, 30))
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = SmappeeResourceCache('test', maxsize=2, timezone='Europe/Brussels')
+
+    cache.set('trend', 'today', value=1)
+    cache.set('trend', 'last_5_minutes', value=2)
+    cache.set('appliance', 1, value=3)
+    assert cache.get('trend', 'last_5_minutes') is None
+    assert (cache.get('trend', 'today'), cache.get('appliance', 1)) == (1, 3)
+
+    clock.now += 60
+    cache.set('appliance', 2, value=4)
+    assert cache.get('appliance', 1) is None
+    assert (cache.get('trend', 'today'), cache.get('appliance', 2)) == (1, 4)
+
+    # expired entries make way before evicting others
+    clock.now += 300
+    cache.set('appliance', 3, value=5)
+    assert (cache.get('trend', 'today'), cache.get('appliance', 3)) == (1, 5)
+    assert cache.stats()['evictions'] == 2
+    assert cache.stats()['expirations'] == 1
+
+
+def test_stats(monkeypatch):
+    clock = FrozenClock(local('Europe/Brussels', 2024, 3, 15, 10, 47, 30))
+    monkeypatch.setattr(cache_module, 'time', clock)
+    cache = SmappeeResourceCache('test', maxsize=10, timezone='Europe/Brussels')
+
+    cache.set('trend', 'last_5_minutes')
+    cache.set('trend', 'today')
+    assert ('trend', 'last_5_minutes') in cache
+    assert ('trend', 'current_hour') not in cache
+
+    # the 5 minute bucket ends
+    clock.now = local('Europe/Brussels', 2024, 3, 15, 10, 50)
+    assert ('trend', 'last_5_minutes') not in cache
+    assert ('trend', 'today') in cache
+
+    assert cache.stats() == {
+        'size': 1,
+        'maxsize': 10,
+        'hits': 2,
+        'misses': 2,
+        'evictions': 0,
+        'expirations': 1,
+    }
@@ -0,0 +1,134 @@
+import queue
+import threading
+from pysmappee.fleet import ConsistentHashRing, SmappeeFleet, _run_shard
+from pysmappee.servicelocation import SmappeeServiceLocation
+
+
+def test_ring_add_shard_only_moves_keys_to_the_new_shard():
+    ring = ConsistentHashRing(shards=[0, 1, 2])
+    before = {key: ring.get(key) for key in range(1000)}
+
+    ring.add(3)
+    after = {key: ring.get(key) for key in range(1000)}
+
+    moved = [key for key in before if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == 3 for key in moved)
+
+
+def test_ring_remove_shard_only_moves_keys_of_that_shard():
+    ring = ConsistentHashRing(shards=[0, 1, 2, 3])
+    before = {key: ring.get(key) for key in range(1000)}
+
+    ring.remove(1)
+    after = {key: ring.get(key) for key in range(1000)}
+
+    assert ring.shards == [0, 2, 3]
+    for key in before:
+        if before[key] == 1:
+            assert after[key] != 1
+        else:
+            assert after[key] == before[key]
+
+
+class FakeApi:
+    instances = []
+
+    def __init__(self, token_updater=None, token=None, **kwargs):
+        self.token = token
+        self.token_updater = token_updater
+        self.farm = 1
+        self.instances.append(self)
+
+    def get_metering_configuration(self, service_location_id):
+        return {'name': f'sl{service_location_id}', 'serviceLocationUuid': f'uuid-{service_location_id}',
+                'timezone': 'Europe/Brussels', 'appliances': [], 'actuators': [], 'sensors': [], 'measurements': []}
+
+    def get_consumption(self, service_location_id, start, end, aggregation):
+        return {'consumptions': [{'timestamp': 0, 'consumption': service_location_id, 'solar': 0, 'alwaysOn': 1}]}
+
+
+def test_shard_starts_service_locations_and_streams_deltas(monkeypatch):
+    monkeypatch.setattr(SmappeeServiceLocation, '_load_mqtt_connections', lambda sl: None)
+    commands, deltas = queue.Queue(), queue.Queue()
+    for service_location_id in (1, 2, 3):
+        commands.put(('add', service_location_id, '5010000001'))
+    commands.put(('token', None, {'access_token': 'new'}))
+
+    shard = threading.Thread(target=_run_shard,
+                             args=(0, FakeApi, {'token': {'access_token': 'old'}}, {'hydrate_actuators': False},
+                                   commands, deltas, 0.01, None, 2))
+    shard.start()
+
+    added, states = set(), {}
+    while len(added) < 3 or len(states) < 3:
+        kind, _, data = deltas.get(timeout=5)
+        assert kind != 'failed', data
+        if kind == 'added':
+            added.add(data)
+        elif kind == 'delta':
+            for service_location_id, delta in data.items():
+                states.setdefault(service_location_id, {}).update(delta)
+
+    commands.put(('stop', None, None))
+    shard.join(timeout=5)
+
+    assert added == {1, 2, 3}
+    assert states[2]['aggregated_values']['power_today'] == 2
+    assert FakeApi.instances[-1].token == {'access_token': 'new'}
+
+
+class FakeProcess:
+    started = []
+
+    def __init__(self, target, args, name, daemon):
+        self.args = args
+
+    def start(self):
+        self.started.append(self)
+
+    def join(self, timeout=None):
+        pass
+
+
+def test_refreshed_token_reaches_running_and_new_shards(monkeypatch):
+    fleet = SmappeeFleet({'client_id': 'id', 'client_secret': 'secret', 'token': {'access_token': 'old'}}, shards=2)
+    monkeypatch.setattr(fleet._context, 'Process', FakeProcess)
+    updated = []
+    fleet._token_updater = updated.append
+    fleet.start(service_locations={})
+
+    token = {'access_token': 'new', 'refresh_token': 'rotated'}
+    fleet._deltas.put(('token', 0, token))
+    assert fleet._commands[1].get(timeout=5) == ('token', None, token)
+    assert fleet._commands[0].empty()
+
+    fleet.add_shard()
+    # args are (shard, api_class, api_kwargs, ...)
+    assert FakeProcess.started[-1].args[2]['token'] == token
+    fleet.stop()
+    assert updated == [token]
+
+
+def test_removed_service_locations_are_dropped_from_the_state(monkeypatch):
+    fleet = SmappeeFleet({'client_id': 'id', 'client_secret': 'secret', 'token': {'access_token': 'old'}}, shards=2)
+    monkeypatch.setattr(fleet._context, 'Process', FakeProcess)
+    fleet.start(service_locations={})
+
+    fleet.add_service_location(1, '5010000001')
+    fleet.add_service_location(2, '5010000002')
+    shard_1, shard_2 = fleet.service_locations[1], fleet.service_locations[2]
+    fleet._deltas.put(('failed', shard_2, (2, 'error')))
+
+    # 1 moved to another shard before the old shard reported its removal, 2 was removed
+    with fleet._lock:
+        fleet._service_locations[1] = ('5010000001', 'other')
+        fleet._states[1] = {'total_power': 100}
+    fleet._deltas.put(('removed', shard_1, 1))
+    with fleet._lock:
+        fleet._service_locations.pop(2)
+    fleet._deltas.put(('removed', shard_2, 2))
+
+    fleet.stop()
+    assert fleet.state() == {1: {'total_power': 100}}
+    assert fleet.failed_service_locations == {}
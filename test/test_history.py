@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+
+from pysmappee.config import config
+from pysmappee.history import DAY_MS, SmappeeHistoryDownloader
+
+HOUR_MS = 60 * 60 * 1000
+
+
+class FakeApi:
+
+    def __init__(self, block=None):
+        self.calls = []
+        self._block = block
+
+    def _to_milliseconds(self, time):
+        return time
+
+    def get_consumption(self, service_location_id, start, end, aggregation):
+        self.calls.append((start, end))
+        if self._block is not None and start > 0:
+            self._block.wait()
+        # hourly records overlapping the range, both ends are inclusive
+        first = start // HOUR_MS * HOUR_MS
+        return {'consumptions': [{'timestamp': ts, 'consumption': ts // HOUR_MS}
+                                 for ts in reversed(range(first, end + 1, HOUR_MS))]}
+
+
+def hourly(monkeypatch):
+    monkeypatch.setitem(config['HISTORY'], 'chunk_days', {2: 1})
+    monkeypatch.setitem(config['HISTORY'], 'requests_per_second', 0)
+
+
+def test_chunk_boundaries_and_dedup(monkeypatch):
+    hourly(monkeypatch)
+    assert SmappeeHistoryDownloader.chunks(0, 3 * DAY_MS - 1, 2) == [
+        (0, DAY_MS), (DAY_MS, 2 * DAY_MS), (2 * DAY_MS, 3 * DAY_MS - 1)]
+
+    api = FakeApi()
+    records = list(SmappeeHistoryDownloader(api).consumption(1, 0, 3 * DAY_MS, 2))
+    assert sorted(api.calls) == [(0, DAY_MS), (DAY_MS, 2 * DAY_MS), (2 * DAY_MS, 3 * DAY_MS)]
+    # the shared boundary records are yielded once, in order
+    assert [r['timestamp'] for r in records] == list(range(0, 3 * DAY_MS + 1, HOUR_MS))
+
+
+def test_resume_from_checkpoint(monkeypatch, tmp_path):
+    hourly(monkeypatch)
+    monkeypatch.setitem(config['HISTORY'], 'checkpoint_interval', 3600)
+    path = str(tmp_path / 'checkpoints.json')
+
+    records = SmappeeHistoryDownloader(FakeApi(), checkpoint_path=path).consumption(1, 0, 3 * DAY_MS, 2)
+    first = []
+    for record in records:
+        first.append(record['timestamp'])
+        if record['timestamp'] == DAY_MS + HOUR_MS:
+            break
+    records.close()
+
+    # the first chunk is finished, the throttled checkpoint is written on close
+    with open(path) as f:
+        assert json.load(f) == {f'1/location/2/0-{3 * DAY_MS}': {'end': DAY_MS, 'last_timestamp': DAY_MS}}
+
+    api = FakeApi()
+    rest = [r['timestamp'] for r in SmappeeHistoryDownloader(api, checkpoint_path=path).consumption(1, 0, 3 * DAY_MS, 2)]
+    assert sorted(api.calls)[0] == (DAY_MS + 1, 2 * DAY_MS + 1)
+    # the bucket overlapping the resumed start was yielded by the first run
+    assert rest == list(range(DAY_MS + HOUR_MS, 3 * DAY_MS + 1, HOUR_MS))
+    assert first[:-1] + rest == list(range(0, 3 * DAY_MS + 1, HOUR_MS))
+
+
+def test_early_close_does_not_wait_for_pending_chunks(monkeypatch):
+    hourly(monkeypatch)
+    block = threading.Event()
+    api = FakeApi(block=block)
+
+    records = SmappeeHistoryDownloader(api, max_workers=2).consumption(1, 0, 10 * DAY_MS, 2)
+    assert next(records)['timestamp'] == 0
+    started = time.monotonic()
+    records.close()
+    assert time.monotonic() - started < 1
+
+    block.set()
+    # only the chunks already running are fetched, the queued ones are cancelled
+    assert len(api.calls) <= 3
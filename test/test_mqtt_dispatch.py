@@ -0,0 +1,92 @@
+from pysmappee.mqtt import SmappeeMqtt, TopicDispatcher
+from pysmappee.workqueue import SmappeeQueuedMessage
+
+
+class FakeServiceLocation:
+    service_location_uuid = 'uuid'
+    device_serial_number = '5010000001'
+
+
+IGNORED = ['/powerquality', '/tracking', '/homeassistant/heartbeat', '/sensorConfig', '/homeControlConfig',
+           '/aggregated', '/trigger', '/trigger/appliance', '/triggerpush', '/triggervalue', '/h1vector', '/nilm',
+           '/homeassistant/event', '/homeassistant/trigger/etc', '/scheduler']
+
+# (topic relative to servicelocation/<uuid>, registered topic, match, handler)
+TABLE = [
+    ('/power', '/power', 'exact', '_handle_power'),
+    ('/realtime', '/realtime', 'exact', '_handle_realtime'),
+    ('/config', '/config', 'exact', '_handle_config'),
+    ('/presence', '/presence', 'exact', '_handle_presence'),
+    ('', '', 'exact', '_handle_controllable_node'),
+    ('/plug/1/state', '/plug/', 'prefix', '_handle_plug'),
+    ('/plug/12/connectionState', '/plug/', 'prefix', '_handle_plug'),
+    ('/etc/led', '/etc/', 'prefix', '_ignore'),
+    ('/outputmodule/1/state', '/outputmodule/', 'prefix', '_ignore'),
+] + [(topic, topic, 'exact', '_ignore') for topic in IGNORED]
+
+
+def test_every_registered_topic_resolves_to_its_handler():
+    connection = SmappeeMqtt(service_location=FakeServiceLocation(), kind='central', farm=1)
+    dispatcher = connection._dispatcher
+
+    for topic, _, _, handler in TABLE:
+        assert dispatcher.resolve(topic).__name__ == handler, topic
+
+    # the table covers all registrations
+    registered = {(topic, 'exact') for topic in dispatcher._exact}
+    registered |= {(topic, 'prefix') for topic, _ in dispatcher._prefixes}
+    registered |= {(topic, 'wildcard') for topic, _ in dispatcher._wildcards}
+    assert registered == {(registered_topic, match) for _, registered_topic, match, _ in TABLE}
+
+    # unknown topics and topics that only share the start of an exact topic
+    for topic in ['/unknown', '/powerquality/1', '/plug', '/etc']:
+        assert dispatcher.resolve(topic) is None, topic
+
+
+def test_first_match_wins():
+    dispatcher = TopicDispatcher()
+    dispatcher.register('/plug/1/state', 'exact')
+    dispatcher.register('/plug/', 'prefix', match='prefix')
+    dispatcher.register('/plug/1/', 'longer prefix', match='prefix')
+    dispatcher.register('/plug/+/state', 'wildcard', match='wildcard')
+    dispatcher.register('/+/+/state', 'second wildcard', match='wildcard')
+    dispatcher.register('/switch/#', 'third wildcard', match='wildcard')
+
+    # exact before prefix, longest prefix first, prefixes before wildcards
+    assert dispatcher.resolve('/plug/1/state') == 'exact'
+    assert dispatcher.resolve('/plug/1/connectionState') == 'longer prefix'
+    assert dispatcher.resolve('/plug/2/state') == 'prefix'
+
+    # wildcards in registration order
+    assert dispatcher.resolve('/switch/2/state') == 'second wildcard'
+    assert dispatcher.resolve('/switch/2/connectionState') == 'third wildcard'
+    assert dispatcher.resolve('/switch') == 'third wildcard'
+
+    # registering a topic again replaces its handler, unregistering falls through to the next match
+    dispatcher.register('/plug/', 'new prefix', match='prefix')
+    assert dispatcher.resolve('/plug/2/state') == 'new prefix'
+    dispatcher.unregister('/plug/', match='prefix')
+    assert dispatcher.resolve('/plug/2/state') == 'wildcard'
+    dispatcher.unregister('/plug/1/state')
+    assert dispatcher.resolve('/plug/1/state') == 'longer prefix'
+
+
+def test_config_with_a_new_uuid_refreshes_the_topic_prefix():
+    class ServiceLocation(FakeServiceLocation):
+        firmware_version = None
+        _service_location_uuid = 'uuid'
+        _service_location_id = 1
+        is_present = None
+
+        @property
+        def service_location_uuid(self):
+            return self._service_location_uuid
+
+    service_location = ServiceLocation()
+    connection = SmappeeMqtt(service_location=service_location, kind='central', farm=1)
+    connection._handle_message(SmappeeQueuedMessage(
+        'servicelocation/uuid/config', b'{"serviceLocationUuid": "new-uuid", "serviceLocationId": 1}', 0))
+    assert service_location.service_location_uuid == 'new-uuid'
+
+    connection._handle_message(SmappeeQueuedMessage('servicelocation/new-uuid/presence', b'{"value": true}', 0))
+    assert service_location.is_present is True
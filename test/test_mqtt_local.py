@@ -0,0 +1,59 @@
+import json
+from pysmappee.mqtt import SmappeeLocalMqtt, LOCAL_DISCOVERY_TOPIC
+from pysmappee.workqueue import SmappeeQueuedMessage
+
+
+class FakeClient:
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    def unsubscribe(self, topic):
+        self.unsubscribed.append(topic)
+
+
+def device_messages(index, plugs):
+    prefix = f'servicelocation/uuid-{index}'
+    config = {'serviceLocationId': index, 'serviceLocationUuid': f'uuid-{index}',
+              'serialNumber': f'501000000{index}', 'timeZone': 'Europe/Brussels'}
+    home_control = {'switchActuators': [], 'smartplugActuators': [{'nodeId': p, 'name': f'Plug {p}'} for p in plugs]}
+    return [
+        SmappeeQueuedMessage(f'{prefix}/config', json.dumps(config).encode(), 0),
+        SmappeeQueuedMessage(f'{prefix}/homeControlConfig', json.dumps(home_control).encode(), 0),
+        SmappeeQueuedMessage(f'{prefix}/plug/{plugs[0]}/state', b'{"value": "ON"}', 0),
+    ]
+
+
+def test_local_client_only_follows_its_own_device_on_a_shared_broker():
+    client = SmappeeLocalMqtt(serial_number='5010000002')
+    client._client = FakeClient()
+    client._on_connect(client._client, None, None, 0)
+    assert client.topics == [LOCAL_DISCOVERY_TOPIC]
+
+    # retained messages of three devices, twice as after a reconnect
+    for _ in range(2):
+        for index in (1, 2, 3):
+            for message in device_messages(index, plugs=[index * 10, index * 10 + 1]):
+                client._handle_message(message)
+
+    assert client.topic_prefix == 'servicelocation/uuid-2'
+    assert client._serial_number == '5010000002'
+    assert LOCAL_DISCOVERY_TOPIC not in client.topics
+    assert all(topic.startswith('servicelocation/uuid-2/') for topic in client.topics)
+    assert client.smart_plugs == [{'nodeId': 20, 'name': 'Plug 20'}, {'nodeId': 21, 'name': 'Plug 21'}]
+    assert client.actuators_state == {20: 'ON'}
+
+
+def test_local_client_without_serial_number_follows_the_first_device():
+    client = SmappeeLocalMqtt()
+    client._client = FakeClient()
+    client._on_connect(client._client, None, None, 0)
+    for index in (1, 2):
+        for message in device_messages(index, plugs=[index]):
+            client._handle_message(message)
+
+    assert client._serial_number == '5010000001'
+    assert client.smart_plugs == [{'nodeId': 1, 'name': 'Plug 1'}]
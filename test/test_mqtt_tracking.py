@@ -0,0 +1,72 @@
+from pysmappee.mqtt import SmappeeMqtt
+
+
+class FakeServiceLocation:
+    service_location_uuid = 'uuid'
+    service_location_id = 1
+    device_serial_number = '5010000001'
+
+
+class FakeJob:
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeScheduler:
+
+    def __init__(self):
+        self.jobs = []
+
+    def call_every(self, interval, callback):
+        self.jobs.append(FakeJob())
+        return self.jobs[-1]
+
+    def call_later(self, delay, callback):
+        self.jobs.append(FakeJob())
+        return self.jobs[-1]
+
+
+class FakeClient:
+
+    def __init__(self, on_publish=None):
+        self.published = []
+        self.on_publish = on_publish
+
+    def publish(self, topic, payload):
+        self.published.append(topic)
+        if self.on_publish is not None:
+            self.on_publish()
+
+    def subscribe(self, topic):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+def test_tracking_run_during_stop_does_not_schedule_the_restore():
+    scheduler = FakeScheduler()
+    connection = SmappeeMqtt(service_location=FakeServiceLocation(), kind='central', farm=1, scheduler=scheduler)
+    connection._client = FakeClient()
+    connection._on_connect(connection._client, None, None, 0)
+    assert len(scheduler.jobs) == 2
+
+    connection._publish_tracking()
+    assert 'tracking_restore' in connection._jobs
+
+    # the connection stops while a tracking run publishes
+    connection._client.on_publish = connection.stop
+    connection._publish_tracking()
+    assert connection._jobs == {}
+    assert all(job.cancelled for job in scheduler.jobs)
+    assert len(scheduler.jobs) == 3
+
+    # a reconnect schedules the jobs again
+    connection._client.on_publish = None
+    connection._on_connect(connection._client, None, None, 0)
+    connection._publish_tracking()
+    assert sorted(connection._jobs) == ['heartbeat', 'tracking', 'tracking_restore']
@@ -0,0 +1,41 @@
+from pysmappee.mqtt import SmappeeMqtt
+from pysmappee.mqttpool import SmappeeMqttPool, SmappeeMqttPoolConnection
+
+
+class FakeServiceLocation:
+
+    def __init__(self, index):
+        self.service_location_uuid = f'uuid-{index}'
+        self.device_serial_number = f'501000000{index}'
+
+
+def connections(pool, kind='central'):
+    mqtt_connections = [SmappeeMqtt(service_location=FakeServiceLocation(index), kind=kind, farm=1, pool=pool)
+                        for index in (1, 2)]
+    for mqtt_connection in mqtt_connections:
+        pool.attach(mqtt_connection)
+    return mqtt_connections
+
+
+def test_service_locations_share_a_client_with_pool_credentials(monkeypatch):
+    monkeypatch.setattr(SmappeeMqttPoolConnection, 'start', lambda self: None)
+    pool = SmappeeMqttPool(credentials=('partner', 'secret'))
+
+    first, second = connections(pool)
+    assert len(pool.connections) == 1
+    assert first._client is second._client
+    assert pool.stats()[0]['locations'] == 2
+
+    pool.detach(first)
+    assert len(pool.connections) == 1 and pool.stats()[0]['locations'] == 1
+
+
+def test_service_locations_do_not_share_a_client_by_default(monkeypatch):
+    monkeypatch.setattr(SmappeeMqttPoolConnection, 'start', lambda self: None)
+
+    # central connections authenticate per service location, local brokers run per device
+    for kind in ('central', 'local'):
+        pool = SmappeeMqttPool()
+        first, second = connections(pool, kind=kind)
+        assert len(pool.connections) == 2
+        assert first._client is not second._client
@@ -0,0 +1,45 @@
+import os
+
+from pysmappee.recorder import SmappeeMqttRecorder, SmappeeMqttReplayer, read_records
+
+
+class FakeConnection:
+    topic_prefix = 'servicelocation/uuid'
+
+    def __init__(self):
+        self.messages = []
+
+    def _on_message(self, client, userdata, message):
+        self.messages.append((message.topic, message.payload))
+
+
+def test_record_truncate_append_replay(tmp_path):
+    path = str(tmp_path / 'recording.smqr')
+    with SmappeeMqttRecorder(path) as recorder:
+        recorder.record('local_standalone', 'servicelocation/a/realtime', b'1', timestamp=1)
+        recorder.record('local_standalone', 'servicelocation/a/presence', b'22', timestamp=2)
+        recorder.record('local_standalone', 'servicelocation/a/realtime', b'333', timestamp=3)
+
+    # an interrupted recording cuts the last message short
+    os.truncate(path, os.path.getsize(path) - 2)
+    assert [r[3] for r in read_records(path)] == [b'1', b'22']
+
+    # cut a new topic record short as well
+    with SmappeeMqttRecorder(path) as recorder:
+        recorder.record('local_standalone', 'servicelocation/a/config', b'4', timestamp=4)
+    os.truncate(path, os.path.getsize(path) - 30)
+    assert [r[3] for r in read_records(path)] == [b'1', b'22']
+
+    with SmappeeMqttRecorder(path) as recorder:
+        recorder.record('local_standalone', 'servicelocation/a/realtime', b'5', timestamp=5)
+        recorder.record('local_standalone', 'servicelocation/a/config', b'6', timestamp=6)
+
+    connection = FakeConnection()
+    result = SmappeeMqttReplayer(path).replay({'local_standalone': connection}, speed=None)
+    assert result['messages'] == 4
+    assert connection.messages == [
+        ('servicelocation/a/realtime', b'1'),
+        ('servicelocation/a/presence', b'22'),
+        ('servicelocation/a/realtime', b'5'),
+        ('servicelocation/a/config', b'6'),
+    ]
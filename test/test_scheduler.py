@@ -0,0 +1,53 @@
+import threading
+import time
+import pytest
+from pysmappee.scheduler import SmappeeScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = SmappeeScheduler()
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+    scheduler.join(timeout=1)
+
+
+def test_jobs_run_in_order_of_their_due_time(scheduler):
+    calls, done = [], threading.Event()
+    scheduler.call_later(0.06, lambda: (calls.append('c'), done.set()))
+    scheduler.call_later(0.02, lambda: calls.append('a'))
+    scheduler.call_later(0.04, lambda: calls.append('b'))
+
+    assert done.wait(timeout=1)
+    assert calls == ['a', 'b', 'c']
+
+
+def test_cancelled_job_does_not_run(scheduler):
+    calls, done = [], threading.Event()
+    job = scheduler.call_later(0.02, lambda: calls.append('cancelled'))
+    scheduler.call_later(0.04, done.set)
+    job.cancel()
+
+    assert done.wait(timeout=1)
+    assert calls == []
+
+
+def test_call_every_repeats_until_cancelled(scheduler):
+    calls = []
+    job = scheduler.call_every(0.01, lambda: calls.append(time.monotonic()))
+    time.sleep(0.1)
+    job.cancel()
+    count = len(calls)
+    time.sleep(0.05)
+
+    assert count >= 3
+    assert len(calls) <= count + 1
+    assert calls == sorted(calls)
+
+
+def test_failing_job_does_not_stop_the_scheduler(scheduler, capsys):
+    done = threading.Event()
+    scheduler.call_later(0, lambda: 1 / 0)
+    scheduler.call_later(0.01, done.set)
+    assert done.wait(timeout=1)
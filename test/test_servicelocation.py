@@ -0,0 +1,267 @@
+import copy
+from datetime import datetime
+import pytz
+from pysmappee import servicelocation as servicelocation_module
+from pysmappee.servicelocation import (SmappeeServiceLocation, TREND_MODE_AGGREGATED, TREND_MODE_DERIVED,
+                                       TREND_MODE_INCREMENTAL)
+
+
+def metering_configuration(appliances):
+    return {
+        'name': 'Home',
+        'serviceLocationUuid': 'uuid',
+        'timezone': 'Europe/Brussels',
+        'appliances': appliances,
+        'actuators': [],
+        'sensors': [],
+        'measurements': [],
+    }
+
+
+def appliance(id, name='Fridge', type='Refrigerator', source_type='NILM'):
+    return {'id': id, 'name': name, 'type': type, 'sourceType': source_type}
+
+
+def service_location(configuration, smappee_api=None, **options):
+    sl = SmappeeServiceLocation(device_serial_number='5010000001', smappee_api=smappee_api, service_location_id=1,
+                                load=False, **options)
+    sl._load_metering_configuration(copy.deepcopy(configuration))
+    return sl
+
+
+def test_reload_applies_appliance_differences():
+    sl = service_location(metering_configuration([appliance(1), appliance(2), appliance(3), appliance(4)]))
+    unchanged = sl.appliances[4]
+
+    reloaded = metering_configuration([
+        appliance(2, name='Freezer'),  # changed
+        appliance(3, source_type='CT'),  # changed, no longer a NILM appliance
+        appliance(4),  # unchanged
+    ])  # 1 is removed
+    sl._load_metering_configuration(copy.deepcopy(reloaded))
+
+    assert sorted(sl.appliances) == [2, 4]
+    assert sl.appliances[2].name == 'Freezer'
+    assert sl.appliances[4] is unchanged
+
+    fresh = service_location(reloaded)
+    assert {id: a.name for id, a in sl.appliances.items()} == {id: a.name for id, a in fresh.appliances.items()}
+
+
+def test_reload_drops_appliance_changed_to_find_me():
+    sl = service_location(metering_configuration([appliance(1)]))
+    sl._load_metering_configuration(metering_configuration([appliance(1, type='Find me')]))
+    assert sl.appliances == {}
+
+
+class CountingApi:
+    farm = 1
+
+    def __init__(self):
+        self.calls = []
+
+    def get_metering_configuration(self, service_location_id):
+        self.calls.append('metering_configuration')
+        return metering_configuration([appliance(1)])
+
+    def get_consumption(self, service_location_id, start, end, aggregation):
+        self.calls.append(('consumption', aggregation))
+        return {'consumptions': [{'timestamp': 0, 'consumption': 10, 'solar': 2, 'alwaysOn': 1}]}
+
+    def get_events(self, service_location_id, appliance_id, start, end):
+        self.calls.append('events')
+        return [{'activePower': 50}]
+
+
+def test_lazy_service_location_loads_once_on_first_access(monkeypatch):
+    monkeypatch.setattr(SmappeeServiceLocation, '_load_mqtt_connections', lambda sl: None)
+    api = CountingApi()
+    sl = SmappeeServiceLocation(device_serial_number='5010000001', smappee_api=api, service_location_id=1,
+                                lazy=True)
+    assert api.calls == []
+
+    assert sl.aggregated_values['power_today'] == 10
+    assert sorted(api.calls, key=str) == sorted(['metering_configuration', ('consumption', 1), ('consumption', 2),
+                                                 ('consumption', 3), 'events'], key=str)
+
+    calls = len(api.calls)
+    assert sl.aggregated_values['power_current_hour'] == 10
+    assert sl.appliances[1].power == 50
+    assert sl.service_location_uuid == 'uuid'
+    assert len(api.calls) == calls
+
+
+BRUSSELS = pytz.timezone('Europe/Brussels')
+FIVE_MINUTES_MS = 5 * 60 * 1000
+
+
+def brussels_ms(*args):
+    return int(BRUSSELS.localize(datetime(*args)).timestamp() * 1e3)
+
+
+def to_ms(time):
+    # like SmappeeApi._to_milliseconds, the incremental window starts at a bucket timestamp
+    if isinstance(time, int):
+        return time
+    if time.tzinfo is None:
+        time = pytz.UTC.localize(time)
+    return int(time.timestamp() * 1e3)
+
+
+class FrozenDatetime(datetime):
+    frozen = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen.astimezone(tz) if tz is not None else cls.frozen.replace(tzinfo=None)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.frozen.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+class BucketsApi:
+    """5 minute buckets of the day, aggregated the way the cloud does for hourly and daily values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.calls = []
+
+    def get_consumption(self, service_location_id, start, end, aggregation):
+        start, end = to_ms(start), to_ms(end)
+        self.calls.append((start, aggregation))
+        if aggregation == 1:
+            return {'consumptions': [b for b in self.buckets if start <= b['timestamp'] <= end]}
+
+        hour = brussels_ms(2024, 3, 15, 10) if aggregation == 2 else brussels_ms(2024, 3, 15)
+        blocks = [b for b in self.buckets if hour <= b['timestamp'] <= end]
+        return {'consumptions': [{'timestamp': hour,
+                                  **{key: sum(b[key] for b in blocks) for key in ('consumption', 'solar', 'alwaysOn')}}]}
+
+
+def buckets(until, changed=None):
+    # yesterday's last bucket, then every 5 minutes of today up to and including the bucket of until
+    result = [{'timestamp': brussels_ms(2024, 3, 14, 23, 55), 'consumption': 1000, 'solar': 1000, 'alwaysOn': 1000}]
+    for i, ts in enumerate(range(brussels_ms(2024, 3, 15), until + 1, FIVE_MINUTES_MS)):
+        result.append({'timestamp': ts, 'consumption': i, 'solar': 2 * i, 'alwaysOn': 1})
+    if changed is not None:
+        result[-2]['consumption'] = changed
+    return result
+
+
+def trend_values(monkeypatch, trend_mode, api, now):
+    FrozenDatetime.frozen = now
+    monkeypatch.setattr(servicelocation_module, 'datetime', FrozenDatetime)
+    sl = service_location(metering_configuration([]), smappee_api=api, trend_mode=trend_mode)
+    sl.update_trend_consumptions()
+    return sl
+
+
+def test_trend_buckets(monkeypatch):
+    now = BRUSSELS.localize(datetime(2024, 3, 15, 10, 47, 30))
+    today = buckets(until=brussels_ms(2024, 3, 15, 10, 45))
+
+    for trend_mode in (TREND_MODE_DERIVED, TREND_MODE_INCREMENTAL):
+        api = BucketsApi(today)
+        sl = trend_values(monkeypatch, trend_mode, api, now)
+        assert api.calls == [(brussels_ms(2024, 3, 15), 1)]
+
+        # sums from local midnight, 10:45 is the incomplete bucket of 10:47:30
+        values = sl.aggregated_values
+        assert values['power_today'] == sum(range(130))
+        assert values['solar_today'] == 2 * sum(range(130))
+        assert values['alwayson_today'] == 130 * 12
+        assert values['power_current_hour'] == sum(range(120, 130))
+        assert values['alwayson_current_hour'] == 10 * 12
+        # the newest completed bucket is 10:40
+        assert values['power_last_5_minutes'] == 128
+        assert values['solar_last_5_minutes'] == 256
+        assert values['alwayson_last_5_minutes'] == 12
+
+        aggregated = trend_values(monkeypatch, TREND_MODE_AGGREGATED, BucketsApi(today), now)
+        assert values == aggregated.aggregated_values
+
+
+def test_incremental_trend_buckets_refetch_from_the_newest_bucket(monkeypatch):
+    api = BucketsApi(buckets(until=brussels_ms(2024, 3, 15, 10, 45)))
+    sl = trend_values(monkeypatch, TREND_MODE_INCREMENTAL, api, BRUSSELS.localize(datetime(2024, 3, 15, 10, 47, 30)))
+
+    # the 10:45 bucket completed with a different value, 10:50 started
+    now = BRUSSELS.localize(datetime(2024, 3, 15, 10, 52, 30))
+    FrozenDatetime.frozen = now
+    api.buckets = buckets(until=brussels_ms(2024, 3, 15, 10, 50), changed=500)
+    sl._cache.clear()
+    sl.update_trend_consumptions()
+    assert api.calls[-1] == (brussels_ms(2024, 3, 15, 10, 45), 1)
+
+    assert sl.aggregated_values['power_today'] == sum(range(129)) + 500 + 130
+    assert sl.aggregated_values['power_last_5_minutes'] == 500
+
+    for trend_mode in (TREND_MODE_DERIVED, TREND_MODE_AGGREGATED):
+        assert sl.aggregated_values == trend_values(monkeypatch, trend_mode, BucketsApi(api.buckets),
+                                                    now).aggregated_values
+
+
+def actuator(id, name='Plug'):
+    return {'id': id, 'name': name, 'type': 'COMFORT_PLUG', 'connectionState': 'CONNECTED',
+            'states': [{'id': 'ON_ON', 'name': 'on', 'current': True}, {'id': 'OFF_OFF', 'name': 'off', 'current': False}]}
+
+
+class ActuatorsApi:
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.calls = []
+
+    def get_metering_configuration(self, service_location_id):
+        return copy.deepcopy(self.configuration)
+
+    def get_actuator_state(self, service_location_id, actuator_id):
+        self.calls.append(('state', actuator_id))
+        return 'ON_ON'
+
+    def get_actuator_connection_state(self, service_location_id, actuator_id):
+        self.calls.append(('connection_state', actuator_id))
+        return '"CONNECTED"'
+
+
+def test_revalidating_a_snapshot_only_hydrates_changed_actuators(monkeypatch):
+    monkeypatch.setattr(SmappeeServiceLocation, '_load_mqtt_connections', lambda sl: None)
+    configuration = dict(metering_configuration([]), actuators=[actuator(1), actuator(2), actuator(3)])
+    api = ActuatorsApi(configuration)
+    sl = SmappeeServiceLocation(device_serial_number='5010000001', smappee_api=api, service_location_id=1,
+                                load=False)
+    sl.load_snapshot({'meteringConfiguration': copy.deepcopy(configuration)})
+
+    # an unchanged configuration makes no actuator requests
+    sl.load_configuration(refresh=True)
+    assert api.calls == []
+
+    api.configuration = dict(configuration, actuators=[actuator(1), actuator(2, name='Lamp'), actuator(4)])
+    sl.load_configuration(refresh=True)
+    assert sorted(api.calls) == [('connection_state', 2), ('connection_state', 4), ('state', 2), ('state', 4)]
+    assert sorted(sl.actuators) == [1, 2, 4]
+
+    # a first load hydrates all actuators
+    api.calls = []
+    fresh = SmappeeServiceLocation(device_serial_number='5010000001', smappee_api=api, service_location_id=1,
+                                   load=False)
+    fresh.load_configuration(refresh=True)
+    assert sorted(api.calls) == [(kind, id) for kind in ('connection_state', 'state') for id in (1, 2, 4)]
+
+
+def test_lazy_service_location_only_connects_mqtt_on_start(monkeypatch):
+    started = []
+    monkeypatch.setattr(SmappeeServiceLocation, '_load_mqtt_connections', lambda sl: started.append(sl))
+    api = CountingApi()
+    sl = SmappeeServiceLocation(device_serial_number='5010000001', smappee_api=api, service_location_id=1,
+                                lazy=True)
+
+    assert sl.total_power is None
+    assert sl.is_present is None
+    assert sl.phase_voltages is None
+    assert started == [] and api.calls == []
+
+    sl.start(trends=False)
+    assert started == [sl]
+    assert api.calls == ['metering_configuration']
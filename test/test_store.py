@@ -0,0 +1,86 @@
+import asyncio
+import time
+from pysmappee.store import SmappeeConsumptionStore
+
+FIVE_MINUTES = 5 * 60 * 1000
+# a past moment aligned on a 5 minute bucket
+BASE = (1600000000000 // FIVE_MINUTES + 1) * FIVE_MINUTES
+
+
+class FakeApi:
+    """Answers like the cloud API: every bucket overlapping [from, to], in an envelope with extra keys."""
+
+    def __init__(self, now=None):
+        self.calls = []
+        self.now = now
+
+    def records(self, start, end):
+        first = start // FIVE_MINUTES * FIVE_MINUTES
+        last = min(end, self.now) if self.now is not None else end
+        return [{'timestamp': ts, 'consumption': ts // FIVE_MINUTES % 100}
+                for ts in range(first, last + 1, FIVE_MINUTES)]
+
+    def fetch(self, start, end):
+        self.calls.append((start, end))
+        return {'serviceLocationId': 1, 'consumptions': self.records(start, end), 'unit': 'Wh'}
+
+    async def async_fetch(self, start, end):
+        await asyncio.sleep(0)
+        return self.fetch(start, end)
+
+
+def get(store, api, start, end):
+    return store.fetch(service_location_id=1, entity='location', aggregation=1, start=start, end=end,
+                       records_key='consumptions', fetch=api.fetch)
+
+
+def test_full_hit_matches_network_response():
+    store, api = SmappeeConsumptionStore(':memory:'), FakeApi()
+    # an unaligned start, the API includes the bucket in progress at start
+    start, end = BASE + 1000, BASE + 12 * FIVE_MINUTES
+
+    fetched = get(store, api, start, end)
+    assert fetched['consumptions'][0]['timestamp'] == BASE
+
+    cached = get(store, api, start, end)
+    assert len(api.calls) == 1
+    assert cached == fetched
+    assert cached['unit'] == 'Wh'
+
+
+def test_partial_hit_fetches_only_the_gap():
+    store, api = SmappeeConsumptionStore(':memory:'), FakeApi()
+    get(store, api, BASE, BASE + 12 * FIVE_MINUTES - 1)
+
+    result = get(store, api, BASE, BASE + 24 * FIVE_MINUTES - 1)
+    assert api.calls[1] == (BASE + 12 * FIVE_MINUTES, BASE + 24 * FIVE_MINUTES - 1)
+    assert result['consumptions'] == api.records(BASE, BASE + 24 * FIVE_MINUTES - 1)
+
+
+def test_incomplete_bucket_is_not_saved():
+    now = int(time.time() * 1e3)
+    store, api = SmappeeConsumptionStore(':memory:'), FakeApi(now=now)
+    start = now // FIVE_MINUTES * FIVE_MINUTES - 6 * FIVE_MINUTES
+    get(store, api, start, now)
+
+    records, missing = store.plan(1, 'location', 1, start, now)
+    assert missing and missing[-1][1] == now + 1
+    # the bucket in progress (and the one that may still be updated) is not stored
+    assert records[-1]['timestamp'] < now - FIVE_MINUTES
+
+    get(store, api, start, now)
+    assert api.calls[1][0] == missing[0][0] > start
+
+
+def test_async_fetch():
+    store, api = SmappeeConsumptionStore(':memory:'), FakeApi()
+    start, end = BASE, BASE + 6 * FIVE_MINUTES
+
+    async def fetch():
+        return await store.async_fetch(service_location_id=1, entity='location', aggregation=1, start=start,
+                                       end=end, records_key='consumptions', fetch=api.async_fetch)
+
+    first = asyncio.run(fetch())
+    second = asyncio.run(fetch())
+    assert len(api.calls) == 1
+    assert first == second == api.fetch(start, end)
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from pysmappee.aioapi import AsyncSmappeeApi
+from pysmappee.api import SmappeeApi, authenticated
+from pysmappee.config import config
+
+FARM = 99
+
+
+class Api(SmappeeApi):
+    """SmappeeApi with a call rejecting the initial access token and a counted, slow refresh."""
+
+    def __init__(self, token):
+        self.updated = []
+        SmappeeApi.__init__(self, 'id', 'secret', token=token, token_updater=self.updated.append, session=object())
+        self.refreshes = 0
+        self._oauth.refresh_token = self._refresh
+
+    def _refresh(self, token_url, timeout):
+        self.refreshes += 1
+        time.sleep(0.1)
+        return {'access_token': f'new{self.refreshes}', 'refresh_token': 'r', 'expires_at': time.time() + 3600}
+
+    @authenticated
+    def call(self):
+        if self._oauth.access_token == 'old':
+            response = requests.Response()
+            response.status_code = 401
+            raise requests.HTTPError(response=response)
+        return self._oauth.access_token
+
+
+def test_concurrent_401s_share_one_refresh():
+    api = Api(token={'access_token': 'old', 'refresh_token': 'r', 'token_type': 'Bearer'})
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(api.call())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert api.refreshes == 1
+    assert results == ['new1'] * 10
+    assert len(api.updated) == 1
+
+
+def test_token_is_renewed_before_it_expires():
+    api = Api(token={'access_token': 'valid', 'refresh_token': 'r', 'token_type': 'Bearer',
+                     'expires_at': time.time() + config['HTTP']['token_refresh_margin'] / 2})
+    assert api.call() == 'new1'
+    assert api.call() == 'new1'
+    assert api.refreshes == 1
+
+
+def run(token, test, monkeypatch):
+    refreshes, calls = [], []
+
+    async def token_endpoint(request):
+        refreshes.append(request)
+        await asyncio.sleep(0.05)
+        return web.json_response({'access_token': 'new', 'expires_in': 3600})
+
+    async def service_locations(request):
+        calls.append(request)
+        if request.headers['Authorization'] != 'Bearer new':
+            return web.Response(status=401)
+        return web.json_response({'serviceLocations': []})
+
+    app = web.Application()
+    app.router.add_post('/oauth2/token', token_endpoint)
+    app.router.add_get('/servicelocation', service_locations)
+
+    async def main():
+        async with TestServer(app) as server:
+            monkeypatch.setitem(config['API_URL'], FARM, {
+                'servicelocation_url': str(server.make_url('/servicelocation')),
+                'token_url': str(server.make_url('/oauth2/token')),
+            })
+            async with AsyncSmappeeApi('id', 'secret', token=token, farm=FARM) as api:
+                return await test(api)
+    return asyncio.run(main()), refreshes, calls
+
+
+def test_async_concurrent_401s_share_one_refresh(monkeypatch):
+    async def test(api):
+        return await asyncio.gather(*[api.get_service_locations() for _ in range(10)])
+
+    results, refreshes, calls = run({'access_token': 'old', 'refresh_token': 'r'}, test, monkeypatch)
+    assert len(refreshes) == 1
+    assert len(calls) == 20
+    assert results == [{'serviceLocations': []}] * 10
+
+
+def test_async_token_is_renewed_before_it_expires(monkeypatch):
+    async def test(api):
+        return await api.get_service_locations()
+
+    token = {'access_token': 'old', 'refresh_token': 'r', 'expires_at': time.time() + 10}
+    result, refreshes, calls = run(token, test, monkeypatch)
+    assert result == {'serviceLocations': []}
+    assert len(refreshes) == 1
+    # renewed before the request, so no rejected round trip
+    assert len(calls) == 1
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from pysmappee.workqueue import (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST,
+                                 OVERFLOW_DROP_SUPERSEDED, SmappeeQueuedMessage, SmappeeWorkQueue)
+
+
+class BlockedHandler:
+    """Handle messages once released, the first message keeps the worker busy until then."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.handled = []
+
+    def __call__(self, message):
+        self.started.set()
+        self.released.wait(5)
+        self.handled.append((message.topic, message.payload))
+
+
+def message(topic, payload):
+    return SmappeeQueuedMessage(topic=topic, payload=payload, timestamp=None)
+
+
+def busy_queue(overflow):
+    # a single lane of capacity 1, with its worker busy on a first message
+    queue = SmappeeWorkQueue(maxsize=1, workers=1, overflow=overflow)
+    handler = BlockedHandler()
+    queue.put(handler, message('a/power', b'busy'))
+    assert handler.started.wait(5)
+    return queue, handler
+
+
+def drain(queue, handler, processed):
+    handler.released.set()
+    deadline = time.monotonic() + 5
+    while queue.stats()['processed'] < processed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    queue.stop()
+    return queue.stats()
+
+
+def test_drop_superseded():
+    queue, handler = busy_queue(OVERFLOW_DROP_SUPERSEDED)
+    queue.put(handler, message('a/power', b'1'))
+    queue.put(handler, message('a/power', b'2'))
+    queue.put(handler, message('b/power', b'3'))
+    queue.put(handler, message('a/config', b'4'))
+
+    stats = drain(queue, handler, 3)
+    assert handler.handled == [('a/power', b'busy'), ('a/power', b'2'), ('a/config', b'4')]
+    assert (stats['superseded'], stats['dropped'], stats['overflow']) == (1, 1, 1)
+    assert stats['enqueued'] == 3
+
+
+def test_drop_oldest():
+    queue, handler = busy_queue(OVERFLOW_DROP_OLDEST)
+    queue.put(handler, message('a/power', b'1'))
+    queue.put(handler, message('b/power', b'2'))
+    queue.put(handler, message('a/config', b'3'))
+    queue.put(handler, message('b/power', b'4'))
+
+    stats = drain(queue, handler, 3)
+    # the oldest frame makes way, config messages are kept
+    assert handler.handled == [('a/power', b'busy'), ('a/config', b'3'), ('b/power', b'4')]
+    assert (stats['superseded'], stats['dropped'], stats['overflow']) == (0, 2, 1)
+
+
+def test_drop_newest():
+    queue, handler = busy_queue(OVERFLOW_DROP_NEWEST)
+    queue.put(handler, message('a/power', b'1'))
+    queue.put(handler, message('a/power', b'2'))
+    queue.put(handler, message('a/config', b'3'))
+
+    stats = drain(queue, handler, 3)
+    assert handler.handled == [('a/power', b'busy'), ('a/power', b'1'), ('a/config', b'3')]
+    assert (stats['superseded'], stats['dropped'], stats['overflow']) == (0, 1, 1)
+
+
+def test_block():
+    queue, handler = busy_queue(OVERFLOW_BLOCK)
+    queue.put(handler, message('a/power', b'1'))
+    producer = threading.Thread(target=queue.put, args=(handler, message('a/power', b'2')))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+
+    handler.released.set()
+    producer.join(5)
+    stats = drain(queue, handler, 3)
+    assert handler.handled == [('a/power', b'busy'), ('a/power', b'1'), ('a/power', b'2')]
+    assert (stats['superseded'], stats['dropped'], stats['overflow']) == (0, 0, 0)
+    assert stats['max_depth'] == 1